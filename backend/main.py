@@ -3,14 +3,22 @@ sunyuDX-flow Backend API
 S-BASE方式の完全実装版
 """
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
+from sqlalchemy import insert, update, bindparam, func
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.orm import Session
 import pandas as pd
+import numpy as np
 import openpyxl
+import xlrd
+import csv
+import io
+import tempfile
 from datetime import datetime
 import uuid
 import os
@@ -18,13 +26,17 @@ from pathlib import Path
 import json
 import re
 import requests
+from xml.etree.ElementTree import iterparse
+from openpyxl.chartsheet import Chartsheet
+from openpyxl.utils.cell import range_boundaries
+from openpyxl.xml.constants import SHEET_MAIN_NS
 from dotenv import load_dotenv
 
 # 環境変数読み込み
 load_dotenv()
 
 # Database imports
-from database import get_db, engine
+from database import get_db, engine, SessionLocal
 from models import (
     Project as ProjectModel,
     Estimate as EstimateModel,
@@ -35,9 +47,19 @@ from models import (
     EstimateImport as EstimateImportModel,
     EstimateLine as EstimateLineModel,
     Attachment as AttachmentModel,
+    ImportJob as ImportJobModel,
+    HeaderTemplate as HeaderTemplateModel,
     Base
 )
 import hashlib
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import threading
+import fcntl
+import socket
+import time
+import logging
 
 # FastAPIアプリケーション
 app = FastAPI(
@@ -81,8 +103,203 @@ async def health_check_db():
 # ディレクトリ設定
 UPLOAD_DIR = Path("uploads")
 OUTPUT_DIR = Path("outputs")
+PARSE_CACHE_DIR = Path(os.getenv("PARSE_CACHE_DIR", "cache/parse"))
+BLOB_DIR = UPLOAD_DIR / "blobs"  # 内容アドレス（SHA256）のファイル置き場
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
+PARSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+(BLOB_DIR / "tmp").mkdir(parents=True, exist_ok=True)
+
+# アップロード上限（バイト）と読み込み単位
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_FILE_SIZE", str(50 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# 保存しないアップロード（解析のみ）をメモリに置く上限（超えた分は一時ファイルへ退避）
+UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# =====================================
+# インポート処理のログ・計測
+# =====================================
+# シート単位の詳細ログは DEBUG（既定では出さない）、インポートごとの要約は INFO
+# IMPORT_LOG_LEVEL=DEBUG で従来の詳細な解析ログを出力する
+
+IMPORT_LOG_LEVEL = os.getenv("IMPORT_LOG_LEVEL", "INFO").upper()
+
+logger = logging.getLogger("sunyudx.import")
+logger.setLevel(IMPORT_LOG_LEVEL)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+
+
+class ImportTrace:
+    """
+    インポート1回分の計測スパン
+    処理段階（ブック読込・結合セル解決・ヘッダー検出・行抽出・分類・DB登録・コミット）ごとに
+    所要時間(ms)と行数・セル数を記録する
+    """
+
+    def __init__(self):
+        self.spans = []
+
+    def start(self, stage: str, **attrs) -> dict:
+        """スパン開始（finish に渡すレコードを返す）"""
+        return {'stage': stage, **attrs, '_t0': time.perf_counter()}
+
+    def finish(self, span: dict, **counts) -> dict:
+        """スパン終了（rows / cells 等の件数を付けて記録）"""
+        span['ms'] = round((time.perf_counter() - span.pop('_t0')) * 1000, 2)
+        span.update(counts)
+        self.spans.append(span)
+        logger.debug("span %s", span)
+        return span
+
+    def extend(self, spans: list):
+        """別プロセス（シート並列解析）で記録したスパンを追加"""
+        self.spans.extend(spans)
+
+    def summary(self) -> dict:
+        """段階ごとの合計: {stage: {'ms', 'spans', 'rows', 'cells'}}"""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span['stage'], {'ms': 0.0, 'spans': 0, 'rows': 0, 'cells': 0})
+            total['ms'] = round(total['ms'] + span['ms'], 2)
+            total['spans'] += 1
+            total['rows'] += span.get('rows', 0)
+            total['cells'] += span.get('cells', 0)
+        return totals
+
+    def log_summary(self, label: str):
+        """段階ごとの所要時間を INFO で1行出力"""
+        parts = [
+            f"{stage}={t['ms']:.1f}ms(rows={t['rows']}, cells={t['cells']})"
+            for stage, t in self.summary().items()
+        ]
+        logger.info("[計測] %s: %s", label, ' '.join(parts))
+
+
+# =====================================
+# 解析のリソース上限（時間・セル数・シート数・メモリ）とキャンセル
+# =====================================
+# 書式だけが最終行・最終列まで伸びたブック等で、解析がリクエスト内で長時間・大量メモリを使わないよう
+# 解析中に協調的に上限を確認し、超えたら reason=budget_exceeded で打ち切る（0 で無制限）
+
+IMPORT_MAX_SECONDS = float(os.getenv("IMPORT_MAX_SECONDS", "300"))
+IMPORT_MAX_CELLS = int(os.getenv("IMPORT_MAX_CELLS", "50000000"))
+IMPORT_MAX_SHEETS = int(os.getenv("IMPORT_MAX_SHEETS", "200"))
+# メモリはインポート単位ではなくプロセス全体の RSS 増加量で見る（プロセス単位の歯止め）
+# 同じワーカープロセスで並行するインポート（リクエストのスレッドプール・IMPORT_JOB_WORKERS のジョブ）の
+# 増加分も合算されるため、並行数 × 1件あたりの想定メモリより大きく設定する
+IMPORT_MAX_MEMORY_MB = int(os.getenv("IMPORT_MAX_MEMORY_MB", "2048"))
+
+# 時間・メモリ・キャンセルはこのセル数ごとに確認（毎セル確認するとオーバーヘッドになるため）
+BUDGET_CHECK_INTERVAL_CELLS = 50000
+# シート並列解析で結果を待つ間、キャンセル・時間を確認する間隔（秒）
+BUDGET_POLL_SECONDS = 0.5
+
+
+def current_rss_bytes() -> Optional[int]:
+    """現在の常駐メモリ（/proc が無い環境では None → メモリ上限は確認しない）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class BudgetExceeded(Exception):
+    """解析のリソース上限超過（kind: time / cells / sheets / memory）"""
+
+    def __init__(self, kind: str, limit, used):
+        super().__init__(kind, limit, used)
+        self.kind = kind
+        self.limit = limit
+        self.used = used
+
+    def __str__(self):
+        labels = {'time': '解析時間(秒)', 'cells': 'セル数', 'sheets': 'シート数', 'memory': 'メモリ(MB)'}
+        return f"解析の上限を超えました: {labels.get(self.kind, self.kind)} {self.used} > {self.limit}"
+
+
+class ImportCancelled(Exception):
+    """取込のキャンセル要求"""
+
+    def __str__(self):
+        return "取込がキャンセルされました"
+
+
+class ParseBudget:
+    """
+    インポート1回分のリソース上限
+    解析処理が charge（読んだセル数）・check を呼び、上限超過で BudgetExceeded、
+    キャンセル要求（cancel_event）で ImportCancelled を送出する
+    cancel_event は is_set() を持つもの（threading.Event、取込ジョブは ImportJobCancelSignal）
+    プロセスプールのワーカーへ渡す場合 cancel_event は渡らない（キャンセルは親プロセスで確認）
+    """
+
+    def __init__(
+        self,
+        max_seconds: Optional[float] = None,
+        max_cells: Optional[int] = None,
+        max_sheets: Optional[int] = None,
+        max_memory_mb: Optional[int] = None,
+        cancel_event=None,
+    ):
+        self.max_seconds = IMPORT_MAX_SECONDS if max_seconds is None else max_seconds
+        self.max_cells = IMPORT_MAX_CELLS if max_cells is None else max_cells
+        self.max_sheets = IMPORT_MAX_SHEETS if max_sheets is None else max_sheets
+        self.max_memory_mb = IMPORT_MAX_MEMORY_MB if max_memory_mb is None else max_memory_mb
+        self.cancel_event = cancel_event
+        # 別プロセスでも同じ期限になるよう壁時計で持つ
+        self.started_at = time.time()
+        self.cells = 0
+        self._unchecked_cells = 0
+        self._rss_base = current_rss_bytes()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['cancel_event'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # メモリはワーカープロセス自身の増加分で見る
+        self._rss_base = current_rss_bytes()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def check(self):
+        """
+        キャンセル・経過時間・メモリ増加量を確認
+        メモリは開始時からのプロセス RSS の増加量（同じプロセスで並行するインポートの分も含む）
+        """
+        if self.cancelled:
+            raise ImportCancelled()
+        elapsed = time.time() - self.started_at
+        if self.max_seconds and elapsed > self.max_seconds:
+            raise BudgetExceeded('time', self.max_seconds, round(elapsed, 1))
+        if self.max_memory_mb and self._rss_base is not None:
+            grown_mb = (current_rss_bytes() - self._rss_base) / 1024 / 1024
+            if grown_mb > self.max_memory_mb:
+                raise BudgetExceeded('memory', self.max_memory_mb, round(grown_mb, 1))
+
+    def check_sheets(self, count: int):
+        if self.max_sheets and count > self.max_sheets:
+            raise BudgetExceeded('sheets', self.max_sheets, count)
+
+    def charge(self, cells: int):
+        """読んだセル数を加算（一定数ごとに check も行う）"""
+        self.cells += cells
+        if self.max_cells and self.cells > self.max_cells:
+            raise BudgetExceeded('cells', self.max_cells, self.cells)
+        self._unchecked_cells += cells
+        if self._unchecked_cells >= BUDGET_CHECK_INTERVAL_CELLS:
+            self._unchecked_cells = 0
+            self.check()
+
 
 # =====================================
 # データモデル (Pydantic)
@@ -216,77 +433,281 @@ simple_budgets_db: Dict[str, dict] = {}
 # ユーティリティ関数
 # =====================================
 
-def analyze_excel_file(file_path: Path) -> List[EstimateBreakdown]:
+async def save_upload_file(file: UploadFile, dest: Path, max_bytes: int = MAX_UPLOAD_SIZE) -> tuple:
     """
-    Excelファイルを解析して内訳明細を抽出
-    S-BASE方式: 全シートをスキャンして自動抽出
+    アップロードをチャンク単位でディスクへ書き出す（全体をメモリに載せない）
+    書き込みと同時にSHA256を計算し、上限を超えた時点で中断して413を返す
+    戻り値: (SHA256の16進文字列, バイト数)
     """
-    breakdowns = []
-    
+    sha256 = hashlib.sha256()
+    size = 0
     try:
-        # openpyxlでExcelを開く
-        wb = openpyxl.load_workbook(file_path, data_only=True)
-        
-        # 全シートをスキャン
-        for sheet_name in wb.sheetnames:
-            sheet = wb[sheet_name]
-            
-            # キーワード検索: 「金額」「合計」「小計」を含む行を探す
-            for row_idx, row in enumerate(sheet.iter_rows(min_row=1, max_row=100), start=1):
-                for cell in row:
-                    if cell.value and isinstance(cell.value, str):
-                        # 「○○工」や「○○費」などを検索
-                        if any(keyword in cell.value for keyword in ['工', '費', '作業']):
-                            # 同じ行の金額を探す
-                            amount = None
-                            for amt_cell in row:
-                                if isinstance(amt_cell.value, (int, float)) and amt_cell.value > 1000:
-                                    amount = float(amt_cell.value)
-                                    break
-                            
-                            if amount:
-                                breakdown = EstimateBreakdown(
-                                    id=str(uuid.uuid4()),
-                                    sheet_name=sheet_name,
-                                    item_name=str(cell.value),
-                                    amount=amount
-                                )
-                                breakdowns.append(breakdown)
-                                break  # 同じ行で複数ヒットしないように
-        
-        # 重複を除去
-        seen = set()
-        unique_breakdowns = []
-        for b in breakdowns:
-            key = (b.sheet_name, b.item_name, b.amount)
+        with open(dest, "wb") as f:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"ファイルサイズが上限（{max_bytes / (1024 * 1024):.1f}MB）を超えています"
+                    )
+                sha256.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        dest.unlink(missing_ok=True)
+        raise
+    return sha256.hexdigest(), size
+
+
+async def spool_upload_file(file: UploadFile, max_bytes: int = MAX_UPLOAD_SIZE) -> tuple:
+    """
+    アップロードを SpooledTemporaryFile に読み込む（UPLOAD_SPOOL_MAX_BYTES 以下はディスクに書かない）
+    save_upload_file と同じく SHA256 を計算し、上限を超えた時点で413を返す
+    呼び出し側は使い終わったら close すること（一時ファイルに退避していても close で消える）
+    戻り値: (先頭に戻したファイルオブジェクト, SHA256の16進文字列, バイト数)
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES)
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"ファイルサイズが上限（{max_bytes / (1024 * 1024):.1f}MB）を超えています"
+                )
+            sha256.update(chunk)
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, sha256.hexdigest(), size
+
+
+# =====================================
+# アップロードファイルの保存（内容アドレス・重複排除）
+# =====================================
+# ファイルは SHA256 をキーに uploads/blobs/ab/cd/<sha256><拡張子> へ保存する
+# 同じ内容のファイルは1つだけ保存し、EstimateImport / Attachment / 実行中の
+# ImportJob の storage_path からの参照数が0になった時点で削除する
+# （拡張子を残すのは openpyxl がパスの拡張子で形式を判定するため）
+
+# 保存処理中（まだDBに参照が無い）のファイルの仮押さえ
+# uvicorn の複数ワーカー（別プロセス）で共有するため、ファイルごとのロックファイル
+# （<保存パス>.lock）のロックで表す: 仮押さえは共有ロック、削除は排他ロック（取れなければ削除しない）
+# lockf（POSIX レコードロック）はプロセス単位で fork 先に引き継がれないため、シート解析の
+# プロセスプールが仮押さえを持ち続けることはない。同じプロセス内の仮押さえは件数で数える
+# このプロセスの仮押さえ: 保存パス → [共有ロック中のファイル記述子, 件数]
+_blob_pins: Dict[str, list] = {}
+_blob_lock = threading.Lock()
+
+
+def _forget_blob_pins_after_fork():
+    """fork 先は親のロックを引き継がないため、引き継いだ仮押さえの記録と記述子を捨てる"""
+    for fd, _ in _blob_pins.values():
+        os.close(fd)
+    _blob_pins.clear()
+
+
+os.register_at_fork(after_in_child=_forget_blob_pins_after_fork)
+
+
+def blob_lock_path(path) -> str:
+    """保存ファイルのロックファイルのパス"""
+    return f"{path}.lock"
+
+
+def lock_blob(path, mode: int) -> Optional[int]:
+    """
+    ロックファイルをロックして記述子を返す（LOCK_NB 指定で取れなければ None）
+    ロック待ちの間に削除側がロックファイルを消した場合は作り直して取り直す
+    """
+    lock_path = blob_lock_path(path)
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, mode)
+        except OSError:
+            os.close(fd)
+            if mode & fcntl.LOCK_NB:
+                return None
+            raise
+        try:
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def blob_path(file_hash: str, suffix: str = '') -> Path:
+    """SHA256 に対応する保存パス（2階層のサブディレクトリで1ディレクトリのファイル数を抑える）"""
+    return BLOB_DIR / file_hash[:2] / file_hash[2:4] / f"{file_hash}{suffix.lower()}"
+
+
+def put_blob_file(tmp_path: Path, file_hash: str, suffix: str = '') -> tuple:
+    """
+    一時ファイルを内容アドレスの保存先へ移動
+    既に同じ内容のファイルがあれば一時ファイルを削除してそれを使う
+    戻り値: (保存パス, 既存ファイルを再利用したか)
+    """
+    dest = blob_path(file_hash, suffix)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    # 共有ロックを取ってから存在確認する（他プロセスが削除中なら削除が終わるまで待つ）
+    with _blob_lock:
+        pin = _blob_pins.get(str(dest))
+        if pin is None:
+            _blob_pins[str(dest)] = [lock_blob(dest, fcntl.LOCK_SH), 1]
+        else:
+            pin[1] += 1
+    if dest.exists():
+        tmp_path.unlink(missing_ok=True)
+        return dest, True
+    os.replace(tmp_path, dest)
+    return dest, False
+
+
+async def store_upload_file(file: UploadFile) -> tuple:
+    """
+    アップロードを内容アドレスの保存先へストリーム保存
+    呼び出し側は DB に参照を登録した後（または不要になった時）に release_blob を呼ぶこと
+    戻り値: (保存パス, SHA256, バイト数)
+    """
+    tmp_path = BLOB_DIR / "tmp" / uuid.uuid4().hex
+    file_hash, size = await save_upload_file(file, tmp_path)
+    path, _ = put_blob_file(tmp_path, file_hash, Path(file.filename or '').suffix)
+    return path, file_hash, size
+
+
+def blob_ref_count(db: Session, path) -> int:
+    """保存ファイルを参照しているレコード数"""
+    path = str(path)
+    return (
+        db.query(EstimateImportModel).filter(EstimateImportModel.storage_path == path).count()
+        + db.query(AttachmentModel).filter(AttachmentModel.storage_path == path).count()
+        + db.query(ImportJobModel).filter(
+            ImportJobModel.storage_path == path,
+            ImportJobModel.status.in_(IMPORT_JOB_ACTIVE_STATUSES)
+        ).count()
+    )
+
+
+def release_blob(db: Session, path):
+    """
+    保存処理の仮押さえを解除し、どこからも参照されていなければファイルを削除
+    """
+    path = str(path)
+    with _blob_lock:
+        pin = _blob_pins.get(path)
+        if pin is not None:
+            pin[1] -= 1
+            if pin[1] == 0:
+                os.close(pin[0])
+                del _blob_pins[path]
+    remove_blob_if_unreferenced(db, path)
+
+
+def remove_blob_if_unreferenced(db: Session, path) -> bool:
+    """
+    どのプロセスも仮押さえしておらず、どのレコードからも参照されていなければファイルを削除
+    戻り値: 削除したか
+    """
+    path = str(path)
+    with _blob_lock:
+        # lockf は同じプロセスのロック同士では競合しないため、このプロセスの仮押さえは件数で見る
+        if path in _blob_pins or not os.path.exists(path):
+            return False
+        fd = lock_blob(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if fd is None:
+            return False  # 他プロセスの保存処理が仮押さえ中
+        try:
+            if blob_ref_count(db, path) > 0:
+                return False
+            try:
+                os.remove(path)
+            except OSError:
+                return False
+            # ロック待ちの保存処理はロックファイルの作り直しを検知して取り直す
+            os.remove(blob_lock_path(path))
+            return True
+        finally:
+            os.close(fd)
+
+
+# 旧アップロードAPI（/api/estimate/upload）の内訳サマリー
+# 各シートの先頭 BREAKDOWN_SCAN_ROWS 行で、キーワードを含む文字列セルと BREAKDOWN_MIN_AMOUNT を超える
+# 数値セルが同じ行にあれば (セルの文字列, 行で最初の該当数値) を拾う（取込の明細抽出とは別の判定）
+BREAKDOWN_KEYWORDS = ['工', '費', '作業']
+BREAKDOWN_MIN_AMOUNT = 1000
+BREAKDOWN_SCAN_ROWS = 100
+BREAKDOWN_MAX_ITEMS = 10
+
+
+def scan_breakdown_rows(wb) -> list:
+    """ブックの各シート先頭行から内訳候補 {'sheet_name', 'item_name', 'amount'} を拾う（重複除去・最大件数まで）"""
+    items = []
+    seen = set()
+    for sheet_name in wb.sheetnames:
+        sheet = wb[sheet_name]
+        if isinstance(sheet, Chartsheet):
+            continue
+        for row in sheet.iter_rows(min_row=1, max_row=BREAKDOWN_SCAN_ROWS, values_only=True):
+            amount = next((
+                float(v) for v in row
+                if isinstance(v, (int, float)) and not isinstance(v, bool) and v > BREAKDOWN_MIN_AMOUNT
+            ), None)
+            if amount is None:
+                continue
+            item_name = next((
+                v for v in row
+                if isinstance(v, str) and any(keyword in v for keyword in BREAKDOWN_KEYWORDS)
+            ), None)
+            if item_name is None:
+                continue
+            key = (sheet_name, item_name, amount)
             if key not in seen:
                 seen.add(key)
-                unique_breakdowns.append(b)
-        
-        return unique_breakdowns[:10]  # 最大10件
-        
-    except Exception as e:
-        print(f"Excel解析エラー: {e}")
-        return []
+                items.append({'sheet_name': sheet_name, 'item_name': item_name, 'amount': amount})
+    return items[:BREAKDOWN_MAX_ITEMS]
+
+
+def analyze_excel_file(source, file_hash: str) -> List[EstimateBreakdown]:
+    """
+    Excelファイルを解析して内訳明細を抽出
+    S-BASE方式: 全シートをスキャンして自動抽出
+    ブックは取込と同じ読込バックエンド（open_workbook）で開き、結果は解析キャッシュに
+    <SHA256>_breakdowns のキーで保存する
+    source: ファイルパスまたはバイナリのファイルオブジェクト
+    """
+    cache_key = f"{file_hash}_breakdowns"
+    items = parse_cache_get(cache_key)
+    if items is None:
+        try:
+            wb = open_workbook(source, detect_workbook_reader(source))
+            try:
+                items = scan_breakdown_rows(wb)
+            finally:
+                wb.close()
+        except Exception as e:
+            logger.warning("Excel解析エラー: %s", e)
+            return []
+        parse_cache_put(cache_key, items)
+
+    return [EstimateBreakdown(id=str(uuid.uuid4()), **item) for item in items]
 
 def classify_cost_item(item_name: str, amount: float) -> str:
     """
     AIによる原価分類（簡易版）
     本番環境ではClaude APIを使用
     """
-    item_lower = item_name.lower()
-    
-    # キーワードベースの分類
-    if any(word in item_lower for word in ['材料', '資材', '管', 'パイプ', 'コンクリート']):
-        return 'material'
-    elif any(word in item_lower for word in ['労務', '人工', '作業員', '技術者']):
-        return 'labor'
-    elif any(word in item_lower for word in ['機械', '重機', 'リース', 'クレーン']):
-        return 'equipment'
-    elif any(word in item_lower for word in ['外注', '下請', '業者']):
-        return 'subcontract'
-    else:
-        return 'expense'
+    return COST_ITEM_CLASSIFIER.classify(item_name)
 
 def generate_estimate_pdf(budget: Budget) -> Path:
     """
@@ -427,25 +848,22 @@ async def root():
 async def upload_estimate(file: UploadFile = File(...)):
     """
     見積書Excelをアップロードして解析
+    ファイルは保存しないため、ディスクに書かずメモリ上（大きいものは一時ファイル）で解析する
     """
     try:
-        # ファイル保存
-        file_path = UPLOAD_DIR / f"{uuid.uuid4()}_{file.filename}"
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
-        
-        # Excel解析
-        breakdowns = analyze_excel_file(file_path)
-        
-        # 一時ファイル削除
-        file_path.unlink()
-        
+        spool, file_hash, _ = await spool_upload_file(file)
+        try:
+            breakdowns = await run_in_threadpool(analyze_excel_file, spool, file_hash)
+        finally:
+            spool.close()
+
         return {
             "status": "success",
             "breakdowns": [b.dict() for b in breakdowns]
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"解析エラー: {str(e)}")
 
@@ -472,6 +890,21 @@ HEADER_SYNONYMS = {
 }
 
 
+# ヘッダー正規化テーブル（全角英数→半角 + 記号除去を1回の translate で行う）
+# 変換後の英数字は除去対象記号に含まれないため、逐次処理と同じ結果になる
+_HEADER_TRANSLATE_TABLE = str.maketrans(
+    'ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ０１２３４５６７８９',
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789',
+    '()（）【】[]「」『』〔〕<>＜＞{}｛｝：:・_-－ー／/\\＼、。，,.;；!！?？#＃*＊@＠~～^＾+＋=＝|｜'
+)
+_WHITESPACE_RE = re.compile(r'\s+')
+# 単位記号・通貨記号（順序に意味があるため逐次置換）
+_HEADER_UNIT_PATTERNS = ['㎥', '㎡', 'm3', 'm2', 'M3', 'M2', '円', '¥', '￥',
+                         '税込', '税抜', '込', '抜', 'kg', 'KG', 't', 'T',
+                         '本', '個', '台', '式', '人', '日', '回', '枚', '件',
+                         'm', 'M', 'ℓ', 'L', '号', '番']
+
+
 def normalize_header_text(text) -> str:
     """
     ヘッダーセル文字列を正規化（contains判定用）
@@ -485,31 +918,104 @@ def normalize_header_text(text) -> str:
     s = str(text).strip()
     if not s:
         return ''
+    return _normalize_header_str(s)
 
-    # 全角英数→半角
-    trans_table = str.maketrans(
-        'ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ０１２３４５６７８９',
-        'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
-    )
-    s = s.translate(trans_table)
 
-    # 記号を除去（より多くの記号に対応）
-    remove_chars = '()（）【】[]「」『』〔〕<>＜＞{}｛｝：:・_-－ー／/\\＼、。，,.;；!！?？#＃*＊@＠~～^＾+＋=＝|｜'
-    for c in remove_chars:
-        s = s.replace(c, '')
+@lru_cache(maxsize=8192)
+def _normalize_header_str(s: str) -> str:
+    """normalize_header_text の本体（同じセル文字列は再計算しない）"""
+    s = _WHITESPACE_RE.sub('', s.translate(_HEADER_TRANSLATE_TABLE))
+    for p in _HEADER_UNIT_PATTERNS:
+        if p in s:
+            s = s.replace(p, '')
+    return s.lower()
 
-    # 空白除去（全角・半角・タブ・改行）
-    s = re.sub(r'\s+', '', s)
 
-    # 単位記号・通貨記号を除去
-    unit_patterns = ['㎥', '㎡', 'm3', 'm2', 'M3', 'M2', '円', '¥', '￥',
-                     '税込', '税抜', '込', '抜', 'kg', 'KG', 't', 'T',
-                     '本', '個', '台', '式', '人', '日', '回', '枚', '件',
-                     'm', 'M', 'ℓ', 'L', '号', '番']
-    for p in unit_patterns:
-        s = s.replace(p, '')
+# 数値セルの文字列表現（str(int) / str(float)）
+_PLAIN_NUMBER_RE = re.compile(r'[-+]?[0-9][0-9.]*(?:[eE][-+]?[0-9]+)?')
+
+
+class HeaderMatcher:
+    """
+    ヘッダー同義語のコンパイル済みマッチャー
+    同義語は構築時に1回だけ正規化し、フィールドごとに
+    - 同義語 ⊂ セル: 同義語の正規表現 alternation（1回の search）
+    - セル ⊂ 同義語: 同義語の全部分文字列の集合（1回の set 参照）
+    で双方向 contains 判定を行う。セル1つにつき正規化は1回
+    """
+
+    def __init__(self, synonyms: dict):
+        self.fields = list(synonyms.keys())
+        self._patterns = {}
+        self._substrings = {}
+        for field, words in synonyms.items():
+            normalized = {normalize_header_text(w) for w in words}
+            if '' in normalized:
+                # 空文字の同義語は何にでも含まれる（従来の判定と同じ）
+                self._patterns[field] = re.compile('')
+            else:
+                self._patterns[field] = re.compile(
+                    '|'.join(re.escape(w) for w in sorted(normalized, key=len, reverse=True))
+                ) if normalized else None
+            self._substrings[field] = {
+                w[i:j] for w in normalized for i in range(len(w)) for j in range(i + 1, len(w) + 1)
+            }
+        self.match_field = lru_cache(maxsize=8192)(self._match_field)
+        # 数字を含む同義語も、数値の文字（. + - e）だけの同義語も無ければ、数値だけのセルはどのフィールドにも一致しない
+        # （ヘッダー判定はデータ行にも行うため、キャッシュに載らない数値セルの判定を省けるようにする）
+        words = [normalize_header_text(w) for ws in synonyms.values() for w in ws]
+        self.numbers_never_match = all(
+            w and not set(w) <= set('.+-e') and not any(c.isdigit() for c in w) for w in words
+        )
+
+    def is_plain_number(self, text: str) -> bool:
+        """どのフィールドにも一致しないと分かっている数値だけのセル（"1234", "1.5e-05" 等）か"""
+        return self.numbers_never_match and _PLAIN_NUMBER_RE.fullmatch(text) is not None
+
+    def matches(self, normalized: str, field: str) -> bool:
+        """正規化済みテキストがフィールドの同義語と双方向 contains で一致するか"""
+        if not normalized:
+            return False
+        pattern = self._patterns.get(field)
+        if pattern is not None and pattern.search(normalized):
+            return True
+        return normalized in self._substrings.get(field, ())
+
+    def _match_field(self, text: str) -> Optional[str]:
+        """セル文字列が該当する最初のフィールド名（HEADER_SYNONYMS の定義順）"""
+        normalized = normalize_header_text(text)
+        if not normalized:
+            return None
+        for field in self.fields:
+            if self.matches(normalized, field):
+                return field
+        return None
+
+
+HEADER_MATCHER = HeaderMatcher(HEADER_SYNONYMS)
 
-    return s.lower()
+
+# 数値正規化テーブル
+# 全角数字・記号→半角 と 通貨記号・カンマ除去を1回の translate で行う
+# （"，" は半角カンマに変換後に除去されるため直接削除）
+_NUMBER_TRANSLATE_TABLE = str.maketrans(
+    '０１２３４５６７８９．－＋',
+    '0123456789.-+',
+    '，¥￥$＄円€\\,、'
+)
+# 単位文字（順序に意味があるため逐次置換。除去で新たな一致が生じ得る）
+_NUMBER_UNIT_PATTERNS = [
+    '㎡', '㎥', 'm2', 'm3', 'M2', 'M3',  # 面積・体積
+    'km', 'cm', 'mm', 'm', 'ｍ', 'M',     # 長さ
+    'kg', 'KG', 'Kg', 't', 'T', 'g',       # 重さ
+    'ℓ', 'L', 'l', 'ml', 'ML',             # 容量
+    '個', '本', '台', '件', '人', '回', '日', '時間', '枚', '組', '箇所', '基', '棟', '戸',  # 数量単位
+    'セット', 'SET', 'set', 'ケース', 'ロット',
+]
+# 単位文字のいずれかを含むか（含まない大半の値は単位除去を丸ごと省略）
+_NUMBER_UNIT_CHARS_RE = re.compile(
+    '[' + re.escape(''.join(sorted({c for p in _NUMBER_UNIT_PATTERNS for c in p}))) + ']'
+)
 
 
 def normalize_number(value) -> Optional[float]:
@@ -525,23 +1031,19 @@ def normalize_number(value) -> Optional[float]:
     s = str(value).strip()
     if not s:
         return None
+    return _normalize_number_str(s)
 
-    # 全角数字・記号→半角
-    trans_table = str.maketrans('０１２３４５６７８９．，－＋', '0123456789.,-+')
-    s = s.translate(trans_table)
-
-    # 空白除去（全角・半角）- 最初に実行
-    s = re.sub(r'\s+', '', s)
 
-    # 通貨記号除去
-    for currency in ['¥', '￥', '$', '＄', '円', '€', '\\']:
-        s = s.replace(currency, '')
-
-    # カンマ除去
-    s = s.replace(',', '').replace('、', '')
+@lru_cache(maxsize=4096)
+def _normalize_number_str(s: str) -> Optional[float]:
+    """
+    normalize_number の文字列処理本体
+    見積書は "1式" や同じ単価が繰り返し出るため、文字列単位でメモ化する
+    """
+    # 全角→半角・通貨記号/カンマ除去（1パス）→ 空白除去
+    s = _WHITESPACE_RE.sub('', s.translate(_NUMBER_TRANSLATE_TABLE))
 
     # 括弧で囲まれた負数を処理 (123) -> -123
-    s = s.strip()
     if s.startswith('(') and s.endswith(')'):
         s = '-' + s[1:-1]
     # 全角括弧も対応
@@ -557,17 +1059,11 @@ def normalize_number(value) -> Optional[float]:
     # 漢数字の一を1に
     s = s.replace('一', '1')
 
-    # 単位文字を除去（より網羅的に）
-    unit_patterns = [
-        '㎡', '㎥', 'm2', 'm3', 'M2', 'M3',  # 面積・体積
-        'km', 'cm', 'mm', 'm', 'ｍ', 'M',     # 長さ
-        'kg', 'KG', 'Kg', 't', 'T', 'g',       # 重さ
-        'ℓ', 'L', 'l', 'ml', 'ML',             # 容量
-        '個', '本', '台', '件', '人', '回', '日', '時間', '枚', '組', '箇所', '基', '棟', '戸',  # 数量単位
-        'セット', 'SET', 'set', 'ケース', 'ロット',
-    ]
-    for unit in unit_patterns:
-        s = s.replace(unit, '')
+    # 単位文字を除去
+    if _NUMBER_UNIT_CHARS_RE.search(s):
+        for unit in _NUMBER_UNIT_PATTERNS:
+            if unit in s:
+                s = s.replace(unit, '')
 
     # 空白除去（最終）
     s = s.strip()
@@ -588,22 +1084,463 @@ def find_header_column(header_text: str, field: str) -> bool:
     ヘッダーテキストが指定フィールドの同義語に該当するか判定（contains方式）
     正規化後のテキストで部分一致を行う
     """
-    normalized = normalize_header_text(header_text)
-    if not normalized:
-        return False
+    return HEADER_MATCHER.matches(normalize_header_text(header_text), field)
 
-    for synonym in HEADER_SYNONYMS.get(field, []):
-        syn_normalized = normalize_header_text(synonym)
-        # 双方向でcontains判定
-        if syn_normalized in normalized or normalized in syn_normalized:
-            return True
-    return False
+
+# =====================================
+# ブック読込（リーダーバックエンド）
+# =====================================
+# parse_excel_to_lines / parse_sheet が使うのは openpyxl のブック・シートの次の部分だけ:
+#   ブック: sheetnames / wb[シート名] / close()
+#   シート: iter_rows(min_row, max_row, max_col, values_only=True) / max_column / sheet_state
+#           と get_merged_ranges（結合範囲）
+# .xls・CSV はこのインターフェースを持つラッパー（ReaderWorkbook / ReaderSheet）で読む
+# 読込元はファイルパスのほか、先頭へ seek できるバイナリのファイルオブジェクト
+# （メモリ上・SpooledTemporaryFile のアップロード）も受け付ける
+
+READER_OPENPYXL = 'openpyxl'  # 通常モード（全セルを読み込む。小さいブックは結合セル取得の再走査が無い分速い）
+READER_OPENPYXL_READ_ONLY = 'openpyxl_read_only'  # 読み取り専用（ストリーミング）
+READER_XLRD = 'xlrd'  # 旧形式 .xls
+READER_CSV = 'csv'  # CSV / TSV
+WORKBOOK_READERS = [READER_OPENPYXL, READER_OPENPYXL_READ_ONLY, READER_XLRD, READER_CSV]
+
+# この大きさ以下の .xlsx は openpyxl の通常モードで開く（超えるものは読み取り専用）
+OPENPYXL_FULL_MAX_BYTES = int(os.getenv("OPENPYXL_FULL_MAX_BYTES", str(64 * 1024)))
+
+# ファイル先頭のマジックバイト
+_ZIP_MAGIC = b'PK\x03\x04'  # .xlsx / .xlsm
+_OLE2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'  # .xls（BIFF8）
+
+
+class UnsupportedWorkbookFormat(ValueError):
+    """対応していないファイル形式"""
+
+
+def is_workbook_path(source) -> bool:
+    """読込元がファイルパスか（False ならバイナリのファイルオブジェクト）"""
+    return isinstance(source, (str, os.PathLike))
+
+
+def workbook_source_name(source) -> str:
+    """ログ表示用の読込元の名前"""
+    if is_workbook_path(source):
+        return Path(source).name
+    return str(getattr(source, 'name', None) or '<memory>')
+
+
+def read_source_head(source, size: int) -> bytes:
+    """読込元の先頭 size バイト（ファイルオブジェクトは先頭に戻しておく）"""
+    if is_workbook_path(source):
+        with open(source, 'rb') as f:
+            return f.read(size)
+    source.seek(0)
+    head = source.read(size)
+    source.seek(0)
+    return head
+
+
+def source_size(source) -> int:
+    """読込元のバイト数"""
+    if is_workbook_path(source):
+        return os.path.getsize(source)
+    size = source.seek(0, os.SEEK_END)
+    source.seek(0)
+    return size
+
+
+def detect_workbook_reader(source) -> str:
+    """マジックバイトとファイルサイズから読込バックエンドを選ぶ（拡張子は見ない）"""
+    head = read_source_head(source, 4096)
+    if head.startswith(_ZIP_MAGIC):
+        if source_size(source) <= OPENPYXL_FULL_MAX_BYTES:
+            return READER_OPENPYXL
+        return READER_OPENPYXL_READ_ONLY
+    if head.startswith(_OLE2_MAGIC):
+        return READER_XLRD
+    # テキスト（NUL を含まない）なら CSV / TSV として読む
+    if head and b'\x00' not in head:
+        return READER_CSV
+    raise UnsupportedWorkbookFormat("対応していないファイル形式です（.xlsx / .xlsm / .xls / .csv / .tsv）")
+
+
+def open_workbook(source, reader: str):
+    """読込バックエンドでブックを開く（openpyxl は Workbook、それ以外は ReaderWorkbook）"""
+    if not is_workbook_path(source):
+        source.seek(0)
+    if reader == READER_OPENPYXL:
+        return openpyxl.load_workbook(source, data_only=True, read_only=False)
+    if reader == READER_OPENPYXL_READ_ONLY:
+        return openpyxl.load_workbook(source, data_only=True, read_only=True)
+    if reader == READER_XLRD:
+        return XlrdWorkbook(source)
+    if reader == READER_CSV:
+        return CsvWorkbook(source)
+    raise ValueError(f"不明な読込バックエンド: {reader}")
+
+
+class ReaderSheet:
+    """openpyxl 以外のシート（openpyxl の読み取り専用シートと同じ形で行を返す）"""
+
+    sheet_state = 'visible'
+    max_row: Optional[int] = None
+    max_column: Optional[int] = None
+
+    def __init__(self, title: str):
+        self.title = title
+
+    def _rows(self):
+        """先頭行から順に、行のセル値のリスト（空セルは None）を返す"""
+        raise NotImplementedError
+
+    def iter_rows(self, min_row: int = 1, max_row: Optional[int] = None, max_col: Optional[int] = None,
+                  values_only: bool = True):
+        """min_row〜max_row 行目のセル値タプル（列は max_col まで None で埋める。values_only のみ対応）"""
+        width = max_col or self.max_column or 0
+        for row_idx, values in enumerate(self._rows(), start=1):
+            if max_row is not None and row_idx > max_row:
+                return
+            if row_idx < min_row:
+                continue
+            values = values[:width]
+            yield tuple(values) + (None,) * (width - len(values))
+
+    def merged_ranges(self) -> list:
+        """結合範囲 (min_row, min_col, max_row, max_col) のリスト"""
+        return []
+
+
+class ReaderWorkbook:
+    """ReaderSheet のブック（sheetnames / wb[シート名] / close() を openpyxl と揃える）"""
+
+    def __init__(self, sheets: list):
+        self._sheets = {sheet.title: sheet for sheet in sheets}
+
+    @property
+    def sheetnames(self) -> list:
+        return list(self._sheets)
+
+    def __getitem__(self, name: str) -> ReaderSheet:
+        return self._sheets[name]
+
+    def close(self):
+        pass
+
+
+class XlrdSheet(ReaderSheet):
+    """xlrd のシート（.xls）。日付・真偽値・エラー・整数値は openpyxl と同じ型に変換する"""
+
+    def __init__(self, book, sheet):
+        super().__init__(sheet.name)
+        self._book = book
+        self._sheet = sheet
+        self.max_row = sheet.nrows
+        self.max_column = sheet.ncols
+        self.sheet_state = 'visible' if sheet.visibility == 0 else 'hidden'
+
+    def _cell_value(self, ctype: int, value):
+        if ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+            return None
+        if ctype == xlrd.XL_CELL_NUMBER:
+            return int(value) if value.is_integer() else value
+        if ctype == xlrd.XL_CELL_DATE:
+            try:
+                return xlrd.xldate.xldate_as_datetime(value, self._book.datemode)
+            except xlrd.xldate.XLDateError:
+                return value
+        if ctype == xlrd.XL_CELL_BOOLEAN:
+            return bool(value)
+        if ctype == xlrd.XL_CELL_ERROR:
+            return xlrd.error_text_from_code.get(value)
+        return value
+
+    def _rows(self):
+        for rowx in range(self._sheet.nrows):
+            yield [
+                self._cell_value(ctype, value)
+                for ctype, value in zip(self._sheet.row_types(rowx), self._sheet.row_values(rowx))
+            ]
+
+    def merged_ranges(self) -> list:
+        # xlrd は 0 始まり・終端を含まない (rlo, rhi, clo, chi)
+        return [(rlo + 1, clo + 1, rhi, chi) for rlo, rhi, clo, chi in self._sheet.merged_cells]
+
+
+class XlrdWorkbook(ReaderWorkbook):
+    """xlrd で開いた .xls ブック（結合セルを取るため formatting_info=True で開く）"""
+
+    def __init__(self, source):
+        if is_workbook_path(source):
+            self._book = xlrd.open_workbook(str(source), formatting_info=True)
+        else:
+            self._book = xlrd.open_workbook(file_contents=source.read(), formatting_info=True)
+        super().__init__([XlrdSheet(self._book, sheet) for sheet in self._book.sheets()])
+
+    def close(self):
+        self._book.release_resources()
+
+
+class CsvSheet(ReaderSheet):
+    """CSV / TSV ファイル1つを1シートとして読む（行は読むたびにファイルから順に読む）"""
+
+    def __init__(self, source, title: str):
+        super().__init__(title)
+        self._source = source
+        head = read_source_head(source, 64 * 1024)
+        self._encoding = detect_text_encoding(head)
+        first_line = head.decode(self._encoding, errors='replace').split('\n', 1)[0]
+        self._delimiter = '\t' if first_line.count('\t') > first_line.count(',') else ','
+        # 列数・行数は1回読んで数える（parse_sheet は max_column を読込列数に使う）
+        self.max_row = 0
+        self.max_column = 0
+        for values in self._rows():
+            self.max_row += 1
+            self.max_column = max(self.max_column, len(values))
+
+    def _rows(self):
+        if is_workbook_path(self._source):
+            with open(self._source, encoding=self._encoding, errors='replace', newline='') as f:
+                for values in csv.reader(f, delimiter=self._delimiter):
+                    yield [self._cell_value(v) for v in values]
+            return
+        # ファイルオブジェクトは閉じずに返す（TextIOWrapper は破棄時に下のファイルを閉じるため detach する）
+        self._source.seek(0)
+        f = io.TextIOWrapper(self._source, encoding=self._encoding, errors='replace', newline='')
+        try:
+            for values in csv.reader(f, delimiter=self._delimiter):
+                yield [self._cell_value(v) for v in values]
+        finally:
+            f.detach()
+
+    @staticmethod
+    def _cell_value(text: str):
+        """空文字は空セル、数値だけのセルは数値（Excel で開いた場合と同じ）"""
+        text = text.strip()
+        if not text:
+            return None
+        if _PLAIN_NUMBER_RE.fullmatch(text):
+            return float(text) if any(c in text for c in '.eE') else int(text)
+        return text
+
+
+class CsvWorkbook(ReaderWorkbook):
+    """CSV / TSV のブック（シートは1つ）"""
+
+    def __init__(self, source):
+        super().__init__([CsvSheet(source, 'CSV')])
+
+
+def detect_text_encoding(head: bytes) -> str:
+    """CSV の文字コード（BOM 付き UTF-8 / UTF-8 / それ以外は Shift_JIS 系として cp932）"""
+    if head.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # 先頭だけ読んだため末尾で文字が切れている場合は UTF-8 とみなす
+        if e.start < len(head) - 3:
+            return 'cp932'
+    return 'utf-8'
+
+
+# シート並列解析のプロセス数（1 = リクエストスレッドで逐次解析）
+EXCEL_PARSE_WORKERS = max(1, int(os.getenv("EXCEL_PARSE_WORKERS", "1")))
+
+_parse_pool: Optional[ProcessPoolExecutor] = None
 
 
-def parse_excel_to_lines(file_path: Path) -> dict:
+def get_parse_pool() -> ProcessPoolExecutor:
+    """シート解析用プロセスプール（初回呼び出し時に作成、以降は共有）"""
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=EXCEL_PARSE_WORKERS)
+    return _parse_pool
+
+
+def parse_sheets_in_worker(
+    file_path: str, sheet_names: list, reader: str, templates=None, budget=None, diagnostics: bool = False
+) -> list:
+    """
+    プロセスプールのワーカーで同じブックの複数シートを解析（シート順の結果リストを返す）
+    シートオブジェクトは受け渡せないため、ワーカー側でブックを開き、担当シートを解析したら閉じる
+    （取込後に削除される保存ファイルのハンドルや、ブックのメモリをワーカーに残さない）
+    budget はワーカー側の複製（期限・メモリはワーカーで確認、読んだセル数は cells_visited で返す）
+    """
+    trace = ImportTrace()
+    load_span = trace.start('workbook_load', worker=os.getpid())
+    wb = open_workbook(Path(file_path), reader)
+    trace.finish(load_span, sheets=len(wb.sheetnames))
+    load_spans = trace.spans  # 最初のシートの結果に含める
+    results = []
+    try:
+        for sheet_name in sheet_names:
+            cells_before = budget.cells if budget is not None else 0
+            sheet_result = parse_sheet(wb[sheet_name], sheet_name, templates, budget, diagnostics)
+            sheet_result['spans'] = load_spans + sheet_result['spans']
+            sheet_result['cells_visited'] = budget.cells - cells_before if budget is not None else 0
+            load_spans = []
+            results.append(sheet_result)
+    finally:
+        wb.close()
+    return results
+
+
+# シート選別（トリアージ）
+# 表紙・条件書・グラフシート・非表示の作業シート等は parse_sheet（シート全体の走査）に回さない
+# シート名・寸法・表示状態・印刷範囲と先頭 SHEET_TRIAGE_SAMPLE_ROWS 行のサンプルから点数を付け、
+# 0点以上のシートを解析する（除外するのはシート名・非表示等の否定材料で負になったものだけ。
+# ヘッダーはシート全体から検出するため、サンプルに明細らしさが無いだけでは除外しない）
+SHEET_TRIAGE_SAMPLE_ROWS = max(1, int(os.getenv("SHEET_TRIAGE_SAMPLE_ROWS", "30")))
+# シート名に含まれていれば明細シートらしい / 明細以外らしい語
+SHEET_NAME_LINE_ITEM_WORDS = ['内訳', '明細', '見積', '代価', '積算', '数量']
+SHEET_NAME_NON_LINE_WORDS = ['表紙', '鏡', '条件', '目次', '注意', '特記', '送付', '案内', 'メモ', '作業', 'グラフ']
+# 判定材料ごとの点数
+SHEET_TRIAGE_POINTS = {
+    'header_row': 3,  # サンプル内にキー列2つ以上の行がある
+    'header_keyword': 1,  # サンプル内にキー列を含む行がある
+    'numeric_cells': 1,  # サンプル内に数値セルが3つ以上ある
+    'line_item_name': 2,
+    'long_print_area': 1,  # 印刷範囲がサンプルの2倍より長い
+    'non_line_name': -2,
+    'hidden': -2,
+}
+SHEET_TRIAGE_LABELS = {
+    'chartsheet': 'グラフシート',
+    'too_narrow': '列が1列以下',
+    'header_row': 'ヘッダー行あり',
+    'header_keyword': 'ヘッダー語あり',
+    'numeric_cells': '数値あり',
+    'line_item_name': '明細らしいシート名',
+    'long_print_area': '印刷範囲が長い',
+    'non_line_name': '表紙・条件書等のシート名',
+    'hidden': '非表示シート',
+    'forced': '全シート解析指定',
+}
+
+
+def triage_sheet(sheet, sheet_name: str, force: bool = False, budget: Optional[ParseBudget] = None) -> dict:
+    """
+    シートを解析するか判定（セルは先頭 SHEET_TRIAGE_SAMPLE_ROWS 行だけ読む）
+    force: True の場合は点数に関わらず解析する（解析できないグラフシート等は除く）
+    戻り値: {'name', 'decision': 'parse' / 'skip', 'score', 'signals', 'print_area'}
+    """
+    triage = {'name': sheet_name, 'decision': 'skip', 'score': 0, 'signals': [], 'print_area': None}
+
+    # セルを持たないシート・列が足りないシートは解析しても明細にならない
+    if isinstance(sheet, Chartsheet):
+        triage['signals'].append('chartsheet')
+        return triage
+    if sheet.max_column is not None and sheet.max_column < 2:
+        triage['signals'].append('too_narrow')
+        return triage
+
+    signals = []
+    if any(word in sheet_name for word in SHEET_NAME_LINE_ITEM_WORDS):
+        signals.append('line_item_name')
+    if any(word in sheet_name for word in SHEET_NAME_NON_LINE_WORDS):
+        signals.append('non_line_name')
+    if sheet.sheet_state != 'visible':
+        signals.append('hidden')
+
+    print_ranges = getattr(getattr(sheet, '_print_area', None), 'ranges', None) or []
+    if print_ranges:
+        triage['print_area'] = ','.join(r.coord for r in print_ranges)
+        if max(r.max_row for r in print_ranges) > SHEET_TRIAGE_SAMPLE_ROWS * 2:
+            signals.append('long_print_area')
+
+    # 先頭行のサンプル（結合セルは解決しない。ヘッダー語の有無が分かれば足りる）
+    max_col = min(sheet.max_column or 20, 30)
+    best_key_count = 0
+    numeric_cells = 0
+    rows_read = 0
+    # （通常モードの openpyxl は範囲外を読むとセルが作られるため、行数が分かっていればそこまで）
+    sample_rows = min(SHEET_TRIAGE_SAMPLE_ROWS, sheet.max_row or SHEET_TRIAGE_SAMPLE_ROWS)
+    for row in sheet.iter_rows(min_row=1, max_row=sample_rows, max_col=max_col, values_only=True):
+        rows_read += 1
+        header_map = try_map_header_row([str(v).strip() if v is not None else '' for v in row])
+        best_key_count = max(best_key_count, sum(1 for k in HEADER_KEY_COLUMNS if k in header_map))
+        numeric_cells += sum(1 for v in row if isinstance(v, (int, float)) and not isinstance(v, bool))
+    if budget is not None:
+        budget.charge(rows_read * max_col)
+    if best_key_count >= 2:
+        signals.append('header_row')
+    elif best_key_count == 1:
+        signals.append('header_keyword')
+    if numeric_cells >= 3:
+        signals.append('numeric_cells')
+
+    triage['signals'] = signals
+    triage['score'] = sum(SHEET_TRIAGE_POINTS[s] for s in signals)
+    if force:
+        triage['signals'].append('forced')
+    triage['decision'] = 'parse' if triage['score'] >= 0 or force else 'skip'
+    return triage
+
+
+def triage_skip_entry(triage: dict) -> dict:
+    """解析しなかったシートの sheets_skipped 項目"""
+    labels = [SHEET_TRIAGE_LABELS.get(s, s) for s in triage['signals']]
+    return {
+        'name': triage['name'],
+        'reason': f"解析対象外と判定（{'、'.join(labels) or '判定材料なし'}）",
+        'candidates': [],
+        'triage': True,
+    }
+
+
+def merge_sheet_result(result: dict, sheet_name: str, sheet_result: dict):
+    """シートの解析結果をブック全体の結果に追加（シート順に呼ぶこと）"""
+    if sheet_result['lines']:
+        result['lines'].extend(sheet_result['lines'])
+        result['sheets_processed'].append({
+            'name': sheet_name,
+            'line_count': len(sheet_result['lines']),
+            'header_row': sheet_result['header_row'],
+            'detected_columns': list(sheet_result['header_map'].keys()),
+        })
+        if sheet_result.get('layout'):
+            result['layouts'][sheet_name] = sheet_result['layout']
+        # 検出されたヘッダーを記録
+        if not result['detected_headers']:
+            result['detected_headers'] = sheet_result['header_map']
+    else:
+        result['sheets_skipped'].append({
+            'name': sheet_name,
+            'reason': sheet_result.get('skip_reason', 'ヘッダー未検出'),
+            'candidates': sheet_result.get('all_candidates', [])[:3],  # 上位3候補
+        })
+    if 'diagnostics' in result:
+        # diagnostics 指定時は全シートの候補診断・セクション情報を返す
+        result['diagnostics'][sheet_name] = {
+            'candidates': sheet_result['all_candidates'],
+            'sections': sheet_result['sections'],
+        }
+
+
+def parse_excel_to_lines(
+    file_path,
+    reader: Optional[str] = None,
+    workers: Optional[int] = None,
+    progress_callback=None,
+    trace: Optional[ImportTrace] = None,
+    templates=None,
+    budget: Optional[ParseBudget] = None,
+    full_parse: bool = False,
+    diagnostics: bool = False,
+) -> dict:
     """
     Excelファイルを解析して統一明細形式で抽出
     診断情報付きで返す
+    file_path: ファイルパス、またはバイナリのファイルオブジェクト（アップロードをディスクに書かずに解析する場合）
+    reader: 読込バックエンド（WORKBOOK_READERS、未指定時は detect_workbook_reader で選ぶ）
+            openpyxl_read_only はストリーミングで読むため、メモリ使用量がブックサイズではなくシート幅に比例する
+    workers: シート並列解析のプロセス数（未指定時は EXCEL_PARSE_WORKERS、1 で逐次）
+    progress_callback: シートごとに (シート名, 完了シート数, 全シート数, 抽出行数) で呼ばれる
+    trace: 指定時はブック読込・シート解析の計測スパンを追加する
+    templates: 学習済みヘッダーテンプレート（HeaderTemplateIndex）
+    budget: リソース上限（未指定時は IMPORT_MAX_* の既定値）。超過時は明細を返さず
+            reason=budget_exceeded、キャンセル時は reason=cancelled とする
+    full_parse: True の場合はシート選別（triage_sheet）で除外せず全シートを解析する
+    diagnostics: True の場合は明細を抽出できたシートも含めて diagnostics（シートごとの候補診断）を返す
     """
     result = {
         'lines': [],
@@ -613,35 +1550,106 @@ def parse_excel_to_lines(file_path: Path) -> dict:
         'missing_columns': [],
         'parse_errors': [],
         'value_stats': {},  # 欠損率統計
+        'total_amount': 0,  # 金額合計
         'reason': None,  # 0件時の理由コード
+        'layouts': {},  # 抽出できたシートのヘッダーレイアウト（テンプレート学習用）
+        'triage': [],  # シートごとの選別結果（triage_sheet 参照）
     }
+    if diagnostics:
+        result['diagnostics'] = {}
+    sheet_columns = []
+    if trace is None:
+        trace = ImportTrace()
+    if budget is None:
+        budget = ParseBudget()
+
+    if workers is None:
+        workers = EXCEL_PARSE_WORKERS
+    if not is_workbook_path(file_path):
+        workers = 1  # ファイルオブジェクトはワーカープロセスへ渡せないため逐次解析
 
     try:
-        wb = openpyxl.load_workbook(file_path, data_only=True)
-
-        for sheet_name in wb.sheetnames:
-            sheet = wb[sheet_name]
-            sheet_result = parse_sheet(sheet, sheet_name)
-
-            if sheet_result['lines']:
-                result['lines'].extend(sheet_result['lines'])
-                result['sheets_processed'].append({
-                    'name': sheet_name,
-                    'line_count': len(sheet_result['lines']),
-                    'header_row': sheet_result['header_row'],
-                    'detected_columns': list(sheet_result['header_map'].keys()),
-                })
-                # 検出されたヘッダーを記録
-                if not result['detected_headers']:
-                    result['detected_headers'] = sheet_result['header_map']
-            else:
-                result['sheets_skipped'].append({
-                    'name': sheet_name,
-                    'reason': sheet_result.get('skip_reason', 'ヘッダー未検出'),
-                    'candidates': sheet_result.get('all_candidates', [])[:3],  # 上位3候補
-                })
-
-        wb.close()
+        if reader is None:
+            reader = detect_workbook_reader(file_path)
+        load_span = trace.start('workbook_load', reader=reader)
+        wb = open_workbook(file_path, reader)
+        trace.finish(load_span, sheets=len(wb.sheetnames))
+        try:
+            budget.check_sheets(len(wb.sheetnames))
+        except BudgetExceeded:
+            wb.close()
+            raise
+
+        # シート選別: 解析するシートだけを parse_sheet に回す
+        sheet_names = list(wb.sheetnames)
+        triage_span = trace.start('sheet_triage', sheets=len(sheet_names))
+        try:
+            for sheet_name in sheet_names:
+                result['triage'].append(triage_sheet(wb[sheet_name], sheet_name, full_parse, budget))
+        except Exception:
+            wb.close()
+            raise
+        parse_names = [t['name'] for t in result['triage'] if t['decision'] == 'parse']
+        trace.finish(triage_span, parse=len(parse_names))
+
+        if workers > 1 and len(parse_names) > 1:
+            # シートを workers 組に振り分けてプロセスプールで並列解析し、シート順に結果を統合
+            # （1組ごとにブックを1回開く。大きいシートが偏らないよう順に1枚ずつ配る）
+            wb.close()
+            pool = get_parse_pool()
+            batch_count = min(workers, len(parse_names))
+            futures = {}
+            for batch_idx in range(batch_count):
+                batch = parse_names[batch_idx::batch_count]
+                future = pool.submit(
+                    parse_sheets_in_worker, str(file_path), batch, reader, templates, budget, diagnostics
+                )
+                for pos, sheet_name in enumerate(batch):
+                    futures[sheet_name] = (future, pos)
+            try:
+                for idx, triage in enumerate(result['triage'], start=1):
+                    sheet_name = triage['name']
+                    future, pos = futures.get(sheet_name, (None, None))
+                    if future is None:
+                        result['sheets_skipped'].append(triage_skip_entry(triage))
+                        if progress_callback:
+                            progress_callback(sheet_name, idx, len(sheet_names), 0)
+                        continue
+                    # 待つ間もキャンセル・期限を確認（ワーカーへはキャンセルが届かないため）
+                    while True:
+                        budget.check()
+                        try:
+                            sheet_result = future.result(timeout=BUDGET_POLL_SECONDS)[pos]
+                            break
+                        except FuturesTimeoutError:
+                            continue
+                    budget.charge(sheet_result['cells_visited'])
+                    merge_sheet_result(result, sheet_name, sheet_result)
+                    sheet_columns.append(sheet_result['columns'])
+                    trace.extend(sheet_result['spans'])
+                    if progress_callback:
+                        progress_callback(sheet_name, idx, len(sheet_names), len(sheet_result['lines']))
+            finally:
+                for future, _ in futures.values():
+                    future.cancel()
+        else:
+            try:
+                for idx, triage in enumerate(result['triage'], start=1):
+                    sheet_name = triage['name']
+                    if triage['decision'] != 'parse':
+                        result['sheets_skipped'].append(triage_skip_entry(triage))
+                        if progress_callback:
+                            progress_callback(sheet_name, idx, len(sheet_names), 0)
+                        continue
+                    sheet = wb[sheet_name]
+                    sheet_result = parse_sheet(sheet, sheet_name, templates, budget, diagnostics)
+                    merge_sheet_result(result, sheet_name, sheet_result)
+                    sheet_columns.append(sheet_result['columns'])
+                    trace.extend(sheet_result['spans'])
+                    if progress_callback:
+                        progress_callback(sheet_name, idx, len(sheet_names), len(sheet_result['lines']))
+            finally:
+                wb.close()
 
         # 必須カラムチェック
         if result['lines']:
@@ -650,28 +1658,21 @@ def parse_excel_to_lines(file_path: Path) -> dict:
                 if col not in result['detected_headers']:
                     result['missing_columns'].append(col)
 
-            # 欠損率統計を計算
-            total = len(result['lines'])
-            stats = {
-                'qty_missing': sum(1 for l in result['lines'] if l.get('qty') is None),
-                'unit_missing': sum(1 for l in result['lines'] if not l.get('unit')),
-                'unit_price_missing': sum(1 for l in result['lines'] if l.get('unit_price') is None),
-                'amount_missing': sum(1 for l in result['lines'] if l.get('amount') is None),
-            }
-            result['value_stats'] = {
-                'total_lines': total,
-                'qty_missing_rate': f"{stats['qty_missing'] / total * 100:.1f}%" if total > 0 else "0%",
-                'unit_missing_rate': f"{stats['unit_missing'] / total * 100:.1f}%" if total > 0 else "0%",
-                'unit_price_missing_rate': f"{stats['unit_price_missing'] / total * 100:.1f}%" if total > 0 else "0%",
-                'amount_missing_rate': f"{stats['amount_missing'] / total * 100:.1f}%" if total > 0 else "0%",
-            }
+            # 欠損率統計・金額合計を列配列からまとめて計算
+            columns = LineColumns.concat(sheet_columns)
+            total = len(columns)
+            result['value_stats'] = columns.value_stats()
+            result['total_amount'] = columns.total_amount()
 
             # ログ出力
-            print(f"[Excel解析] {file_path.name}: {total}行取込")
-            print(f"  数量欠損: {result['value_stats']['qty_missing_rate']}")
-            print(f"  単位欠損: {result['value_stats']['unit_missing_rate']}")
-            print(f"  単価欠損: {result['value_stats']['unit_price_missing_rate']}")
-            print(f"  金額欠損: {result['value_stats']['amount_missing_rate']}")
+            logger.info(
+                "[Excel解析] %s: %s行取込 数量欠損=%s 単位欠損=%s 単価欠損=%s 金額欠損=%s",
+                workbook_source_name(file_path), total,
+                result['value_stats']['qty_missing_rate'],
+                result['value_stats']['unit_missing_rate'],
+                result['value_stats']['unit_price_missing_rate'],
+                result['value_stats']['amount_missing_rate'],
+            )
 
         else:
             # 0件の理由を判定
@@ -679,50 +1680,68 @@ def parse_excel_to_lines(file_path: Path) -> dict:
                 result['reason'] = 'parse_error'
             elif not result['sheets_processed'] and not result['sheets_skipped']:
                 result['reason'] = 'empty_workbook'
-            elif all(s.get('reason', '').startswith('ヘッダー行が見つかりません') for s in result['sheets_skipped']):
+            elif all(s.get('triage') for s in result['sheets_skipped']):
+                result['reason'] = 'no_line_item_sheets'
+            elif all(s.get('reason', '').startswith('ヘッダー行が見つかりません')
+                     for s in result['sheets_skipped'] if not s.get('triage')):
                 result['reason'] = 'header_not_found'
             elif any('必須カラム' in s.get('reason', '') for s in result['sheets_skipped']):
                 result['reason'] = 'required_columns_missing'
             else:
                 result['reason'] = 'no_data_rows'
 
+    except (BudgetExceeded, ImportCancelled) as e:
+        # 途中までの明細は返さない（parse_errors があるため解析キャッシュにも載らない）
+        result.update(lines=[], sheets_processed=[], layouts={}, value_stats={}, total_amount=0, missing_columns=[])
+        result['parse_errors'].append(str(e))
+        if isinstance(e, BudgetExceeded):
+            result['reason'] = 'budget_exceeded'
+            result['budget'] = {'kind': e.kind, 'limit': e.limit, 'used': e.used}
+            logger.warning("Excel解析を打ち切り: %s: %s", workbook_source_name(file_path), e)
+        else:
+            result['reason'] = 'cancelled'
+            logger.info("Excel解析をキャンセル: %s", workbook_source_name(file_path))
+
+    except UnsupportedWorkbookFormat as e:
+        result['parse_errors'].append(str(e))
+        result['reason'] = 'unsupported_format'
+
     except Exception as e:
         result['parse_errors'].append(f"Excel解析エラー: {str(e)}")
         result['reason'] = 'parse_error'
-        import traceback
-        print(f"Excel解析エラー: {traceback.format_exc()}")
+        logger.exception("Excel解析エラー: %s", workbook_source_name(file_path))
 
     return result
 
 
-def get_merged_cell_value(sheet, row_idx: int, col_idx: int) -> str:
-    """
-    結合セルの場合、左上セルの値を返す
-    """
-    cell = sheet.cell(row=row_idx, column=col_idx + 1)  # 1-indexed
-    if cell.value is not None:
-        return str(cell.value).strip()
-
-    # 結合セルかチェック
-    for merged_range in sheet.merged_cells.ranges:
-        if (merged_range.min_row <= row_idx <= merged_range.max_row and
-            merged_range.min_col <= col_idx + 1 <= merged_range.max_col):
-            # 左上セルの値を取得
-            top_left = sheet.cell(row=merged_range.min_row, column=merged_range.min_col)
-            return str(top_left.value or '').strip()
-
-    return ''
-
-
-def get_row_values_with_merge(sheet, row_idx: int, max_col: int = 20) -> list:
+def get_merged_ranges(sheet, budget: Optional[ParseBudget] = None) -> list:
     """
-    行の値を取得（結合セルを考慮）
+    シートの結合範囲を (min_row, min_col, max_row, max_col) のリストで返す
+    読み取り専用モードのシートは merged_cells を持たないため、シートXMLの
+    mergeCell 要素をストリーム解析して取得する（セルオブジェクトは生成しない）
+    budget: 指定時は走査したXML要素数をセル数として加算する
     """
-    values = []
-    for col_idx in range(max_col):
-        val = get_merged_cell_value(sheet, row_idx, col_idx)
-        values.append(val)
-    return values
+    if isinstance(sheet, ReaderSheet):
+        return sheet.merged_ranges()
+    if hasattr(sheet, 'merged_cells'):
+        return [(r.min_row, r.min_col, r.max_row, r.max_col) for r in sheet.merged_cells.ranges]
+
+    ranges = []
+    merge_tag = f'{{{SHEET_MAIN_NS}}}mergeCell'
+    visited = 0
+    with sheet._get_source() as src:
+        for _, element in iterparse(src):
+            visited += 1
+            if budget is not None and visited >= BUDGET_CHECK_INTERVAL_CELLS:
+                budget.charge(visited)
+                visited = 0
+            if element.tag == merge_tag:
+                ref = element.get('ref')
+                if ref and ':' in ref:
+                    min_col, min_row, max_col, max_row = range_boundaries(ref)
+                    ranges.append((min_row, min_col, max_row, max_col))
+            element.clear()
+    return ranges
 
 
 def try_map_header_row(values: list) -> dict:
@@ -731,540 +1750,2089 @@ def try_map_header_row(values: list) -> dict:
     """
     header_map = {}
     for col_idx, val in enumerate(values):
-        if not val:
+        if not val or HEADER_MATCHER.is_plain_number(val):
             continue
-        for field in HEADER_SYNONYMS.keys():
-            if find_header_column(val, field):
-                if field not in header_map:
-                    header_map[field] = col_idx
-                break
+        field = HEADER_MATCHER.match_field(val)
+        if field is not None and field not in header_map:
+            header_map[field] = col_idx
     return header_map
 
 
-def parse_sheet(sheet, sheet_name: str) -> dict:
+class SheetGrid:
     """
-    シートを解析して明細行を抽出
-    - 結合セル対応
-    - 2段ヘッダー対応（r行とr+1行を合成）
-    - contains方式のマッチング
-    - キー列が2つ以上でヘッダー採用（名称なしでもOK）
-    - 複数ヘッダーセクション対応（1シート内に複数の表がある場合）
+    シートのセル値グリッド
+    values_only で先頭から1回だけ読み、行番号 → セル値タプルで引けるように保持する
+    （セルオブジェクトは作らない）。行は必要になった所まで遅延して読み進める
+    ヘッダー探索とデータ抽出はどちらもこのグリッドを参照するため、シートの再読込は発生しない
+    結合セルは resolve_merges 後、text_row が左上セルの値で埋める
+    （結合範囲は行の昇順に有効化・失効させるため、text_row は行番号の昇順で呼ぶこと）
     """
-    print(f"\n[parse_sheet] シート解析開始: {sheet_name}")
 
-    result = {
-        'lines': [],
-        'header_row': None,
-        'header_rows': [],  # 2段ヘッダーの場合 [r, r+1]
-        'header_map': {},
-        'skip_reason': None,
-        'all_candidates': [],  # 検出候補の診断用
-        'sections': [],  # 検出した全セクション情報
-    }
+    def __init__(self, sheet, max_col: int, budget: Optional[ParseBudget] = None):
+        self.max_col = max_col
+        self._budget = budget  # 読んだ行ごとに max_col セル分を加算
+        self._rows_iter = sheet.iter_rows(min_row=1, max_col=max_col, values_only=True)
+        self._rows = []  # 読込済みの行（self._base 行目から）
+        self._base = 1
+        self._exhausted = False
+        self._merge_queue = deque()  # 未到達の結合範囲（開始行の昇順）
+        self._active_merges = []  # 現在行を含む結合範囲 (終了行, 開始行, 開始列, 終了列, 左上セルの文字列)
+        self._merged_range_count = 0
+
+    @property
+    def loaded_rows(self) -> int:
+        """読込済みの最終行番号"""
+        return self._base + len(self._rows) - 1
+
+    def _load_until(self, row_idx: int) -> bool:
+        """row_idx 行目まで読み進める（シートがそれより短ければ False）"""
+        while self.loaded_rows < row_idx:
+            if self._exhausted:
+                return False
+            row = next(self._rows_iter, None)
+            if row is None:
+                self._exhausted = True
+                return False
+            self._rows.append(row)
+            if self._budget is not None:
+                self._budget.charge(self.max_col)
+        return True
+
+    def row(self, row_idx: int) -> tuple:
+        """row_idx 行目の生のセル値（シート外・解放済みは空タプル）"""
+        if row_idx < self._base or not self._load_until(row_idx):
+            return ()
+        return self._rows[row_idx - self._base]
+
+    def resolve_merges(self, sheet):
+        """シートの結合範囲（列は max_col まで）を読み込み、以降の text_row で解決する"""
+        ranges = sorted(
+            (min_row, min_col, max_row, min(max_col, self.max_col))
+            for min_row, min_col, max_row, max_col in get_merged_ranges(sheet, self._budget)
+            if min_col <= self.max_col
+        )
+        self._merge_queue = deque(ranges)
+        self._active_merges = []
+        self._merged_range_count = len(ranges)
+
+    @property
+    def merged_range_count(self) -> int:
+        return self._merged_range_count
+
+    def _advance_merges(self, row_idx: int):
+        """row_idx 行目を含む結合範囲だけを有効にする（左上セルの値は有効化時に控える）"""
+        if any(merge[0] < row_idx for merge in self._active_merges):
+            self._active_merges = [merge for merge in self._active_merges if merge[0] >= row_idx]
+        while self._merge_queue and self._merge_queue[0][0] <= row_idx:
+            min_row, min_col, max_row, max_col = self._merge_queue.popleft()
+            if max_row < row_idx:
+                continue
+            tl_raw = self.row(min_row)
+            tl_value = tl_raw[min_col - 1] if min_col - 1 < len(tl_raw) else None
+            self._active_merges.append((max_row, min_row, min_col, max_col, str(tl_value or '').strip()))
+
+    def text_row(self, row_idx: int) -> list:
+        """行の値を文字列で取得（結合セルの場合は左上セルの値）"""
+        raw = self.row(row_idx)
+        values = [
+            str(value).strip() if value is not None else ''
+            for value in (raw[col_idx] if col_idx < len(raw) else None for col_idx in range(self.max_col))
+        ]
+        if self._merge_queue or self._active_merges:
+            self._advance_merges(row_idx)
+            for _, min_row, min_col, max_col, tl_text in self._active_merges:
+                for col in range(min_col, max_col + 1):
+                    if row_idx == min_row and col == min_col:
+                        continue  # 左上セル自身
+                    if col - 1 >= len(raw) or raw[col - 1] is None:
+                        values[col - 1] = tl_text
+        return values
+
+    def iter_rows(self, min_row: int, max_row: Optional[int] = None):
+        """min_row〜max_row 行目（省略時はシート末尾まで）の (行番号, 生のセル値タプル) を順に返す"""
+        row_idx = min_row
+        while max_row is None or row_idx <= max_row:
+            if not self._load_until(row_idx):
+                return
+            yield row_idx, self._rows[row_idx - self._base]
+            row_idx += 1
+
+    def discard_before(self, row_idx: int):
+        """row_idx 行目より前の行を解放（前進のみで読む区間のメモリを抑える）"""
+        drop = min(row_idx - self._base, len(self._rows))
+        if drop > 0:
+            del self._rows[:drop]
+            self._base += drop
 
-    # キーカラム（これらが2つ以上あればヘッダー行と判定）
-    # nameなしでも qty+unit_price や qty+amount でOK
-    key_columns = ['name', 'qty', 'unit_price', 'amount']
 
-    # ヘッダー行を探す（最大100行まで - 複数セクション対応のため拡大）
-    max_header_search = 100
-    max_col = min(sheet.max_column or 20, 30)
+# =====================================
+# 抽出行の後処理（列指向・NumPy）
+# =====================================
 
-    print(f"  max_col={max_col}, max_header_search={max_header_search}")
+class LineColumns:
+    """
+    抽出行の数値列（qty / unit_price / amount）を NumPy 配列で保持する列指向の構造
+    欠損（None）と NaN を区別するため、値配列（欠損は0）と有無マスクの組で持つ
+    自動計算（逆算）・合計・欠損率を行ループなしの配列演算で求める
+    """
 
-    # 全行のキャッシュ（結合セル対応）
-    row_cache = {}
-    for row_idx in range(1, max_header_search + 2):  # +1 for 2-row header
-        try:
-            row_cache[row_idx] = get_row_values_with_merge(sheet, row_idx, max_col)
-        except Exception as e:
-            print(f"  [警告] 行{row_idx}の読取エラー: {e}")
-            row_cache[row_idx] = [''] * max_col
+    FIELDS = ('qty', 'unit_price', 'amount')
+
+    def __init__(self, values: dict, present: dict, unit_missing: np.ndarray):
+        self.values = values
+        self.present = present
+        self.unit_missing = unit_missing
+
+    def __len__(self) -> int:
+        return len(self.unit_missing)
+
+    @classmethod
+    def from_lines(cls, lines: list) -> 'LineColumns':
+        values = {}
+        present = {}
+        for field in cls.FIELDS:
+            raw = np.array([line[field] for line in lines], dtype=object)
+            mask = raw != None  # noqa: E711（要素ごとの None 判定）
+            values[field] = np.where(mask, raw, 0.0).astype(np.float64)
+            present[field] = np.asarray(mask, dtype=bool)
+        unit_missing = np.array([not line['unit'] for line in lines], dtype=bool)
+        return cls(values, present, unit_missing)
+
+    @classmethod
+    def concat(cls, parts: list) -> 'LineColumns':
+        if not parts:
+            return cls.from_lines([])
+        return cls(
+            {f: np.concatenate([p.values[f] for p in parts]) for f in cls.FIELDS},
+            {f: np.concatenate([p.present[f] for p in parts]) for f in cls.FIELDS},
+            np.concatenate([p.unit_missing for p in parts]),
+        )
 
-    # ヘッダー候補を全て収集
-    header_candidates = []
+    def take(self, mask: np.ndarray) -> 'LineColumns':
+        return LineColumns(
+            {f: v[mask] for f, v in self.values.items()},
+            {f: p[mask] for f, p in self.present.items()},
+            self.unit_missing[mask],
+        )
 
-    for row_idx in range(1, max_header_search + 1):
-        values = row_cache.get(row_idx, [])
+    def derive_missing(self) -> tuple:
+        """
+        数量・単価・金額の自動計算（逆算）を行単位の規則どおり順に適用
+        1. amount が空で qty と unit_price があれば amount = round(qty * unit_price, 0)
+        2. qty が空で amount と unit_price(>0) があれば qty = round(amount / unit_price, 2)
+        3. unit_price が空で amount と qty(>0) があれば unit_price = round(amount / qty, 0)
+        4. amount(>0) だけある場合は qty=1, unit_price=amount（単位が空なら「式」）
+        戻り値: (値を補完した行のマスク, 単位を「式」にする行のマスク)
+        """
+        q, p, a = self.values['qty'], self.values['unit_price'], self.values['amount']
+        has_q, has_p, has_a = self.present['qty'], self.present['unit_price'], self.present['amount']
+
+        # inf / NaN を含むセルは Python の float 演算と同じく inf / NaN のまま通す
+        with np.errstate(all='ignore'):
+            m1 = ~has_a & has_q & has_p
+            a[m1] = np.rint(q[m1] * p[m1])
+            has_a |= m1
+
+            m2 = ~has_q & has_a & has_p & (p > 0)
+            if m2.any():
+                # 小数第2位の丸めは Python の round と同じ結果にするため要素ごとに行う
+                q[m2] = [round(v, 2) for v in (a[m2] / p[m2]).tolist()]
+                has_q |= m2
+
+            m3 = ~has_p & has_a & has_q & (q > 0)
+            p[m3] = np.rint(a[m3] / q[m3])
+            has_p |= m3
+
+        m4 = ~has_q & ~has_p & has_a & (a > 0)
+        q[m4] = 1.0
+        p[m4] = a[m4]
+        has_q |= m4
+        has_p |= m4
+        unit_fill = m4 & self.unit_missing
+        self.unit_missing &= ~unit_fill
+
+        return m1 | m2 | m3 | m4, unit_fill
+
+    def total_amount(self):
+        """金額合計（従来の sum(amount or 0) と同じ加算順・型）"""
+        a = self.values['amount']
+        nonzero = self.present['amount'] & (a != 0)
+        if not nonzero.any():
+            return 0
+        # 逐次加算（cumsum）で Python の sum と同じ丸め誤差にする
+        with np.errstate(all='ignore'):
+            return float(np.cumsum(np.where(nonzero, a, 0.0))[-1])
+
+    def value_stats(self) -> dict:
+        """欠損率統計"""
+        total = len(self)
+        missing = {
+            'qty_missing': total - int(np.count_nonzero(self.present['qty'])),
+            'unit_missing': int(np.count_nonzero(self.unit_missing)),
+            'unit_price_missing': total - int(np.count_nonzero(self.present['unit_price'])),
+            'amount_missing': total - int(np.count_nonzero(self.present['amount'])),
+        }
+        stats = {'total_lines': total}
+        for key, count in missing.items():
+            stats[f"{key}_rate"] = f"{count / total * 100:.1f}%" if total > 0 else "0%"
+        return stats
 
-        # 空行はスキップ
-        if not any(values):
-            continue
 
-        # 単一行でヘッダーマッピング試行
-        header_map = try_map_header_row(values)
-        key_count = sum(1 for k in key_columns if k in header_map)
+def finalize_section_lines(candidates: list, named: list) -> tuple:
+    """
+    セクションの候補行に自動計算を適用し、名称か金額（0以外）がある行だけを残す
+    candidates: 候補行（qty/unit_price/amount は補完前）
+    named: 候補行ごとに名称が空でないか
+    戻り値: (残した行のリスト, その LineColumns)
+    """
+    columns = LineColumns.from_lines(candidates)
+    derived, unit_fill = columns.derive_missing()
+
+    # 補完した行だけ dict に書き戻す
+    fields = LineColumns.FIELDS
+    values = {f: columns.values[f] for f in fields}
+    for idx in np.flatnonzero(derived).tolist():
+        line = candidates[idx]
+        for f in fields:
+            if columns.present[f][idx]:
+                line[f] = float(values[f][idx])
+    for idx in np.flatnonzero(unit_fill).tolist():
+        candidates[idx]['unit'] = '式'
+
+    keep = np.asarray(named, dtype=bool) | (columns.present['amount'] & (columns.values['amount'] != 0))
+    if keep.all():
+        return candidates, columns
+    return [candidates[idx] for idx in np.flatnonzero(keep).tolist()], columns.take(keep)
+
+
+# キーカラム（これらが2つ以上あればヘッダー行と判定）
+# nameなしでも qty+unit_price や qty+amount でOK
+HEADER_KEY_COLUMNS = ['name', 'qty', 'unit_price', 'amount']
+# 先頭から何行までを診断候補の記録・テンプレート照合の対象にするか（ヘッダー検出自体はシート全体）
+HEADER_WINDOW_ROWS = 100
+
+
+def header_row_candidate(row_idx: int, header_map: dict, next_map: dict) -> Optional[dict]:
+    """
+    row_idx 行目のヘッダー候補（候補でなければ None）
+    単一行でキー列が1つのみの場合は次の行（next_map）と合成した2段ヘッダーを試す
+    """
+    key_count = sum(1 for k in HEADER_KEY_COLUMNS if k in header_map)
 
-        # 候補として記録（診断用に先頭10セル値も保存）
-        raw_cells = [v[:15] for v in values[:10] if v]  # 先頭10セル、各15文字まで
-        result['all_candidates'].append({
+    # キーカラムが2つ以上ある行をヘッダー候補とする
+    if key_count >= 2:
+        return {
             'row': row_idx,
-            'columns': list(header_map.keys()),
+            'rows': [row_idx],
+            'map': header_map,
             'key_count': key_count,
-            'raw_cells': raw_cells[:5],  # 診断用に5セルまで
-        })
+            'total_count': len(header_map),
+            'is_two_row': False
+        }
+    if key_count != 1:
+        return None
 
-        # デバッグ: キー列が1つ以上見つかった行を表示
-        if key_count >= 1:
-            print(f"  行{row_idx}: キー{key_count}個 {list(header_map.keys())} raw={raw_cells[:3]}")
-
-        # キーカラムが2つ以上ある行をヘッダー候補として記録
-        if key_count >= 2:
-            header_candidates.append({
-                'row': row_idx,
-                'rows': [row_idx],
-                'map': header_map,
-                'key_count': key_count,
-                'total_count': len(header_map),
-                'is_two_row': False
-            })
+    # 2段ヘッダー試行: 単一行が弱い（キー列1つのみ）場合、次の行と合成
+    next_key_count = sum(1 for k in HEADER_KEY_COLUMNS if k in next_map)
 
-        # 2段ヘッダー試行: 単一行が弱い（キー列1つのみ）場合、次の行と合成
-        elif key_count == 1 and row_idx < max_header_search:
-            next_values = row_cache.get(row_idx + 1, [])
-            next_map = try_map_header_row(next_values)
-            next_key_count = sum(1 for k in key_columns if k in next_map)
-
-            # 次の行のキー列が多い場合、次の行をベースにして現在の行を補完
-            if next_key_count >= key_count:
-                combined_map = dict(next_map)  # 次の行をベース
-                for field, col_idx in header_map.items():
-                    if field not in combined_map:
-                        combined_map[field] = col_idx
-            else:
-                combined_map = dict(header_map)  # 現在の行をベース
-                for field, col_idx in next_map.items():
-                    if field not in combined_map:
-                        combined_map[field] = col_idx
-
-            combined_key_count = sum(1 for k in key_columns if k in combined_map)
-
-            if combined_key_count >= 2:
-                header_candidates.append({
-                    'row': row_idx,
-                    'rows': [row_idx, row_idx + 1],
-                    'map': combined_map,
-                    'key_count': combined_key_count,
-                    'total_count': len(combined_map),
-                    'is_two_row': True
-                })
+    # 次の行のキー列が多い場合、次の行をベースにして現在の行を補完
+    if next_key_count >= key_count:
+        combined_map = dict(next_map)  # 次の行をベース
+        for field, col_idx in header_map.items():
+            if field not in combined_map:
+                combined_map[field] = col_idx
+    else:
+        combined_map = dict(header_map)  # 現在の行をベース
+        for field, col_idx in next_map.items():
+            if field not in combined_map:
+                combined_map[field] = col_idx
 
-    # ヘッダー候補がない場合
-    if not header_candidates:
-        top_candidates = sorted(result['all_candidates'], key=lambda x: x['key_count'], reverse=True)[:5]
-        diag_lines = []
-        for c in top_candidates:
-            raw_str = ', '.join(c.get('raw_cells', [])[:3])
-            diag_lines.append(f"行{c['row']}: キー{c['key_count']}個 {c['columns']} [{raw_str}]")
-        result['skip_reason'] = f"ヘッダー行が見つかりません（キー列2つ以上必要）。\n" + "\n".join(diag_lines)
-        print(f"  ✗ ヘッダー未検出: {sheet_name}")
-        print(f"    上位候補:")
-        for dl in diag_lines[:3]:
-            print(f"      {dl}")
-        return result
+    combined_key_count = sum(1 for k in HEADER_KEY_COLUMNS if k in combined_map)
+    if combined_key_count < 2:
+        return None
+    return {
+        'row': row_idx,
+        'rows': [row_idx, row_idx + 1],
+        'map': combined_map,
+        'key_count': combined_key_count,
+        'total_count': len(combined_map),
+        'is_two_row': True
+    }
 
-    # 連続するヘッダー候補をフィルタ（より多いkey_countを優先）
-    # 同じ行、または連続行のヘッダーは重複除去
-    filtered_headers = []
-    header_candidates.sort(key=lambda x: x['row'])
-
-    for candidate in header_candidates:
-        # 既存のヘッダーと重複チェック（行番号が近いか）
-        is_duplicate = False
-        for i, existing in enumerate(filtered_headers):
-            existing_rows = set(existing['rows'])
-            candidate_rows = set(candidate['rows'])
-            # 行が重複するか、連続している場合
-            if existing_rows & candidate_rows or max(existing_rows) + 1 >= min(candidate_rows):
-                # より多くのキー列を持つ方を採用
-                if candidate['key_count'] > existing['key_count'] or (
-                    candidate['key_count'] == existing['key_count'] and
-                    candidate['total_count'] > existing['total_count']
-                ) or (
-                    candidate['key_count'] == existing['key_count'] and
-                    candidate['total_count'] == existing['total_count'] and
-                    not candidate['is_two_row'] and existing['is_two_row']  # 単一行優先
-                ):
-                    filtered_headers[i] = candidate
-                is_duplicate = True
-                break
-        if not is_duplicate:
-            filtered_headers.append(candidate)
 
-    print(f"  検出ヘッダー数: {len(filtered_headers)}")
-    for h in filtered_headers:
-        print(f"    行{h['rows']}: キー{h['key_count']}個 {list(h['map'].keys())}")
+def header_priority(header: dict) -> tuple:
+    """重複・連続するヘッダー候補の優先度（キー列数 → 列数 → 単一行優先）"""
+    return header['key_count'], header['total_count'], not header['is_two_row']
 
-    # 各セクションからデータを抽出
-    all_lines = []
 
-    for section_idx, header in enumerate(filtered_headers):
-        # 次のヘッダーの行番号を取得（終端判定用）
-        if section_idx + 1 < len(filtered_headers):
-            next_header_row = filtered_headers[section_idx + 1]['row']
-        else:
-            next_header_row = 1000  # 最後のセクションは1000行まで
+class HeaderSectionDetector:
+    """
+    ヘッダー候補を行の昇順に受け取り、重複・連続する候補のまとまりから1つを採用する
+    まとまりが確定した時点（以降の候補が連続し得なくなった時点）で採用したヘッダーを返すため、
+    シートを先頭から1回走査するだけでシート全体のセクションを検出できる
+    """
+
+    def __init__(self):
+        self._current = None  # 未確定のまとまりで現在採用しているヘッダー
+        self.cluster_start = None  # 未確定のまとまりの先頭行（この行以降はセクションへの振り分けを保留）
+
+    def feed(self, row_idx: int, candidate: Optional[dict]) -> Optional[dict]:
+        """row_idx 行目の候補（なければ None）を渡す。まとまりが確定したらそのヘッダーを返す"""
+        current = self._current
+        if current is None:
+            if candidate is not None:
+                self._current = candidate
+                self.cluster_start = row_idx
+            return None
+
+        reach = max(current['rows']) + 1
+        if candidate is not None and reach >= candidate['row']:
+            # 行が重複するか連続している → より優先度の高い方を採用
+            if header_priority(candidate) > header_priority(current):
+                self._current = candidate
+            return None
+        if row_idx < reach:
+            return None
+
+        # 以降の候補はこのまとまりに連続しない → 確定
+        self._current = None
+        self.cluster_start = None
+        if candidate is not None:
+            self._current = candidate
+            self.cluster_start = row_idx
+        return current
+
+    def finish(self) -> Optional[dict]:
+        """シート末尾で未確定のまとまりを確定する"""
+        current = self._current
+        self._current = None
+        self.cluster_start = None
+        return current
+
+
+def header_candidate_diagnostics(row_cache: dict) -> list:
+    """
+    ヘッダー候補の診断情報（照合範囲の空でない各行のキー列判定と先頭セル値）
+    明細を抽出できなかったシートと diagnostics 指定時だけ作る（row_cache は先頭の照合範囲のみ保持）
+    """
+    candidates = []
+    for row_idx in range(1, HEADER_WINDOW_ROWS + 1):
+        values = row_cache.get(row_idx, [])
+        if not any(values):
+            continue
+        header_map = try_map_header_row(values)
+        key_count = sum(1 for k in HEADER_KEY_COLUMNS if k in header_map)
+        # 候補として記録（診断用に先頭10セル値も保存）
+        raw_cells = [v[:15] for v in values[:10] if v]  # 先頭10セル、各15文字まで
+        candidates.append({
+            'row': row_idx,
+            'columns': list(header_map.keys()),
+            'key_count': key_count,
+            'raw_cells': raw_cells[:5],  # 診断用に5セルまで
+        })
+        # デバッグ: キー列が1つ以上見つかった行を表示
+        if key_count >= 1:
+            logger.debug("  行%s: キー%s個 %s raw=%s", row_idx, key_count, list(header_map.keys()), raw_cells[:3])
+    return candidates
+
+
+def row_signature(values: list) -> str:
+    """ヘッダー行の照合用シグネチャ（結合セル解決済みの文字列を連結、末尾の空セルは除く）"""
+    cells = list(values)
+    while cells and not cells[-1]:
+        cells.pop()
+    return '\x1f'.join(cells)
+
+
+def header_layout(headers: list, row_cache: dict) -> list:
+    """検出したヘッダーをテンプレートとして保存できる形（行番号・行シグネチャ・列マップ）にする"""
+    return [{
+        'rows': h['rows'],
+        'signatures': [row_signature(row_cache.get(r, [])) for r in h['rows']],
+        'map': h['map'],
+        'key_count': h['key_count'],
+        'total_count': h['total_count'],
+        'is_two_row': h['is_two_row'],
+    } for h in headers]
+
+
+def header_layout_fingerprint(client_name: str, layout: list) -> str:
+    """発注者 + ヘッダー行（行番号・シグネチャ）のSHA256（列マップはシグネチャから決まるため含めない）"""
+    key = json.dumps(
+        [client_name or '', [[h['rows'], h['signatures']] for h in layout]],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class HeaderTemplateIndex:
+    """
+    学習済みヘッダーテンプレートの照合用インデックス
+    先頭ヘッダー行の (行番号, シグネチャ) で引き、全ヘッダー行のシグネチャが一致したものを採用する
+    プロセスプールのワーカーへそのまま渡せるよう dict/list のみで保持する
+    """
+
+    def __init__(self, templates: list):
+        # templates: [{'id': テンプレートID, 'headers': header_layout() の結果}]
+        self._by_first_row = {}
+        for template in templates:
+            headers = template['headers']
+            if not headers:
+                continue
+            first = headers[0]
+            key = (first['rows'][0], first['signatures'][0])
+            self._by_first_row.setdefault(key, []).append(template)
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._by_first_row.values())
+
+    def match(self, row_cache: dict) -> Optional[dict]:
+        """
+        一致するテンプレートのヘッダー（parse_sheet の検出結果と同じ形）を返す
+        検証: テンプレートの全ヘッダー行が同じ行番号・同じシグネチャであること
+        複数一致した場合はセクション数の多いものを優先
+        """
+        best = None
+        for row_idx, values in row_cache.items():
+            if not any(values):
+                continue
+            for template in self._by_first_row.get((row_idx, row_signature(values)), ()):
+                valid = all(
+                    row_signature(row_cache.get(r, [])) == sig
+                    for h in template['headers']
+                    for r, sig in zip(h['rows'], h['signatures'])
+                )
+                if valid and (best is None or len(template['headers']) > len(best['headers'])):
+                    best = template
+        if best is None:
+            return None
+        return {
+            'template_id': best['id'],
+            'headers': [{
+                'row': h['rows'][0],
+                'rows': list(h['rows']),
+                'map': dict(h['map']),
+                'key_count': h['key_count'],
+                'total_count': h['total_count'],
+                'is_two_row': h['is_two_row'],
+            } for h in best['headers']],
+        }
 
-        header_row = max(header['rows'])  # 2段ヘッダーの場合は下の行
-        header_map = header['map']
 
+# extract_section_row の判定結果
+ROW_LINE = 'line'  # 明細候補
+ROW_EMPTY = 'empty'  # 名称・金額・単価いずれもない（セクション終端の判定に数える）
+ROW_SKIP = 'skip'  # 合計・小計・注記・見出し等の行
+
+
+def extract_section_row(cells: tuple, header_map: dict, sheet_name: str, row_idx: int) -> tuple:
+    """
+    セクションのデータ行（生のセル値）を明細候補に変換
+    戻り値: (ROW_LINE / ROW_EMPTY / ROW_SKIP, 明細候補, 名称があるか)
+    """
+    # 名称を取得
+    name = ''
+    if 'name' in header_map:
+        name_idx = header_map['name']
+        if name_idx < len(cells):
+            name = str(cells[name_idx] or '').strip()
+
+    # 金額を取得（先に取得して終端判定に使用）
+    amount = None
+    if 'amount' in header_map:
+        amount_idx = header_map['amount']
+        if amount_idx < len(cells):
+            amount = normalize_number(cells[amount_idx])
+
+    # 単価も確認（金額がなくても単価があればデータ行の可能性）
+    unit_price_val = None
+    if 'unit_price' in header_map:
+        up_idx = header_map['unit_price']
+        if up_idx < len(cells):
+            unit_price_val = normalize_number(cells[up_idx])
+
+    # 空行判定（名称・金額・単価いずれもない場合）
+    if not name and not amount and not unit_price_val:
+        return ROW_EMPTY, None, False
+
+    # 合計行や小計行をスキップ
+    # 名称を正規化（空白除去）してチェック
+    name_normalized = name.replace(' ', '').replace('　', '')
+    skip_exact = ['計', '小計', '合計', '総合計', '工事費計', '税込合計', '税抜合計',
+                  '本工事費計', '直接工事費計', '諸経費計', '一般管理費', '消費税',
+                  '内訳明細書', '明細書']
+    if name_normalized in skip_exact:
+        return ROW_SKIP, None, False
+    # 「○○計」パターン（ただし6文字以下の短い計のみ）
+    if name_normalized.endswith('計') and len(name_normalized) <= 7:
+        return ROW_SKIP, None, False
+    # 「○○総計」パターン
+    if '総計' in name_normalized:
+        return ROW_SKIP, None, False
+    # 消費税行をスキップ
+    if '消費税' in name or '税込' in name and '計' in name:
+        return ROW_SKIP, None, False
+    # 注意書き行をスキップ（※で始まる）
+    if name.startswith('※') or name.startswith('＊'):
+        return ROW_SKIP, None, False
+    # ヘッダータイトル行をスキップ（金額・数量・単価が全てない場合の「○○書」）
+    if name_normalized.endswith('書') and not amount and not unit_price_val:
+        return ROW_SKIP, None, False
+    # カテゴリヘッダー行をスキップ（「○○工事」で金額・単価がない）
+    if (name_normalized.endswith('工事') or name_normalized.endswith('工')) and not amount and not unit_price_val:
+        return ROW_SKIP, None, False
+
+    # 各カラムを取得
+    breakdown = ''
+    if 'breakdown' in header_map:
+        bd_idx = header_map['breakdown']
+        if bd_idx < len(cells):
+            breakdown = str(cells[bd_idx] or '').strip()
+
+    qty = None
+    qty_raw = None
+    if 'qty' in header_map:
+        qty_idx = header_map['qty']
+        if qty_idx < len(cells):
+            qty_raw = cells[qty_idx]
+            qty = normalize_number(qty_raw)
+
+    unit = ''
+    if 'unit' in header_map:
+        unit_idx = header_map['unit']
+        if unit_idx < len(cells):
+            unit = str(cells[unit_idx] or '').strip()
+
+    # "一式"/"1式" パターン処理（qty列）
+    qty_raw_str = str(qty_raw or '').strip() if qty_raw else ''
+    if '式' in qty_raw_str or qty_raw_str in ['一式', '1式', '１式']:
+        qty = 1.0
+        if not unit:
+            unit = '式'
+
+    unit_price = None
+    if 'unit_price' in header_map:
+        up_idx = header_map['unit_price']
+        if up_idx < len(cells):
+            unit_price = normalize_number(cells[up_idx])
+
+    note = ''
+    if 'note' in header_map:
+        note_idx = header_map['note']
+        if note_idx < len(cells):
+            note = str(cells[note_idx] or '').strip()
+
+    # "一式" パターン処理（name, breakdown, unit列もチェック）
+    # qty が空で、他の列に "一式" があれば qty=1, unit='式'
+    if qty is None:
+        check_texts = [name, breakdown, unit]
+        for txt in check_texts:
+            if txt and ('一式' in txt or '1式' in txt or '１式' in txt):
+                qty = 1.0
+                if not unit or unit in ['一式', '1式', '１式']:
+                    unit = '式'
+                break
+
+    # 自動計算（逆算）と「最低限nameかamountがあれば行を追加」の判定は
+    # セクション単位で finalize_section_lines がまとめて行う
+    return ROW_LINE, {
+        'sheet_name': sheet_name,
+        'row_no': row_idx,
+        'name': name or '（名称なし）',
+        'breakdown': breakdown,
+        'qty': qty,
+        'unit': unit,
+        'unit_price': unit_price,
+        'amount': amount,
+        'note': note,
+    }, bool(name)
+
+
+class SheetSection:
+    """
+    ヘッダー1つ分のセクション。データ行を行順に受け取って明細候補を集める
+    終端は空行の連続数で判定する（次のヘッダーがあるセクションは20行、最終セクションは10行）
+    走査中は最終セクションかどうか分からないため、空行10行以降の明細は仮置きにしておき
+    finalize で次のヘッダーの有無に応じて採否を決める
+    """
+
+    EMPTY_ROWS_LAST = 10
+    EMPTY_ROWS_NEXT = 20
+
+    def __init__(self, header: dict, sheet_name: str):
+        self.header = header
+        self.sheet_name = sheet_name
+        header_map = header['map']
         # 必須カラムチェック緩和: 名称なしでも qty+unit_price or qty+amount でOK
-        has_valid_columns = (
+        # （有効カラムのないヘッダーも前のセクションの終端にはなる）
+        self.valid = (
             'name' in header_map or
             'amount' in header_map or
             ('qty' in header_map and 'unit_price' in header_map)
         )
-        if not has_valid_columns:
-            print(f"    セクション{section_idx+1}スキップ: 有効カラムなし {list(header_map.keys())}")
-            continue
+        self.closed = not self.valid
+        self.lines = []
+        self.named = []
+        self.tentative_from = None  # 空行10行に達した時点の明細数（以降は仮置き）
+        self.empty_rows = 0
+        self.scanned_rows = 0
+
+    def feed(self, row_idx: int, cells: tuple):
+        """セクションのデータ行を1行追加（終端後は無視）"""
+        if self.closed:
+            return
+        self.scanned_rows += 1
+        status, line, named = extract_section_row(cells, self.header['map'], self.sheet_name, row_idx)
+        if status == ROW_EMPTY:
+            self.empty_rows += 1
+            if self.empty_rows >= self.EMPTY_ROWS_LAST and self.tentative_from is None:
+                self.tentative_from = len(self.lines)
+            if self.empty_rows >= self.EMPTY_ROWS_NEXT:
+                self.closed = True
+            return
+        self.empty_rows = 0
+        if status == ROW_LINE:
+            self.lines.append(line)
+            self.named.append(named)
+
+    def finalize(self, has_next_header: bool) -> tuple:
+        """セクションの明細を確定（戻り値は finalize_section_lines と同じ）"""
+        lines, named = self.lines, self.named
+        if not has_next_header and self.tentative_from is not None:
+            lines, named = lines[:self.tentative_from], named[:self.tentative_from]
+        return finalize_section_lines(lines, named)
+
+
+def parse_sheet(
+    sheet,
+    sheet_name: str,
+    templates: Optional[HeaderTemplateIndex] = None,
+    budget: Optional[ParseBudget] = None,
+    diagnostics: bool = False,
+) -> dict:
+    """
+    シートを解析して明細行を抽出
+    - 結合セル対応
+    - 2段ヘッダー対応（r行とr+1行を合成）
+    - contains方式のマッチング
+    - キー列が2つ以上でヘッダー採用（名称なしでもOK）
+    - 複数ヘッダーセクション対応（1シート内に複数の表がある場合、シート全体を先頭から1回走査して検出）
+    templates: 学習済みヘッダーテンプレート。一致すればテンプレートのヘッダー行はそのまま採用する
+               （照合範囲でテンプレートに無いヘッダー候補が見つかった場合と、1行も抽出できなかった場合は
+               通常の検出でやり直す）
+    budget: リソース上限。超過時は BudgetExceeded / ImportCancelled が送出される
+    diagnostics: True の場合は明細を抽出できても候補診断（all_candidates）とセクション情報を返す
+                 （False の場合、候補診断は抽出できなかったときだけ作る）
+    """
+    logger.debug("[parse_sheet] シート解析開始: %s", sheet_name)
+    if budget is not None:
+        budget.check()
+    trace = ImportTrace()
 
-        section_lines = []
-        empty_row_count = 0
-        # 次のヘッダーがある場合は大きめの許容値、最終セクションは小さめ
-        max_empty_rows = 20 if section_idx + 1 < len(filtered_headers) else 10
+    result = {
+        'lines': [],
+        'header_row': None,
+        'header_rows': [],  # 2段ヘッダーの場合 [r, r+1]
+        'header_map': {},
+        'skip_reason': None,
+        'all_candidates': [],  # 検出候補の診断用（header_candidate_diagnostics 参照）
+        'sections': [],  # 検出した全セクション情報（diagnostics 指定時のみ）
+        'columns': LineColumns.from_lines([]),  # 抽出行の数値列（ブック全体の集計用）
+        'spans': trace.spans,  # 計測スパン（ImportTrace 参照）
+        'layout': None,  # ヘッダーレイアウト（テンプレート学習用、header_layout 参照）
+    }
 
-        for row_idx, row in enumerate(sheet.iter_rows(min_row=header_row + 1, max_row=next_header_row - 1), start=header_row + 1):
-            cells = list(row)
+    max_col = min(sheet.max_column or 20, 30)
 
-            # 次のヘッダー行に達したら終了
-            if row_idx >= next_header_row:
-                break
+    logger.debug("  max_col=%s, header_window=%s", max_col, HEADER_WINDOW_ROWS)
 
-            # 名称を取得
-            name = ''
-            if 'name' in header_map:
-                name_idx = header_map['name']
-                if name_idx < len(cells):
-                    name = str(cells[name_idx].value or '').strip()
-
-            # 金額を取得（先に取得して終端判定に使用）
-            amount = None
-            if 'amount' in header_map:
-                amount_idx = header_map['amount']
-                if amount_idx < len(cells):
-                    amount = normalize_number(cells[amount_idx].value)
-
-            # 単価も確認（金額がなくても単価があればデータ行の可能性）
-            unit_price_val = None
-            if 'unit_price' in header_map:
-                up_idx = header_map['unit_price']
-                if up_idx < len(cells):
-                    unit_price_val = normalize_number(cells[up_idx].value)
-
-            # 空行判定（名称・金額・単価いずれもない場合）
-            if not name and not amount and not unit_price_val:
-                empty_row_count += 1
-                if empty_row_count >= max_empty_rows:
-                    break
-                continue
-            else:
-                empty_row_count = 0
-
-            # 合計行や小計行をスキップ
-            # 名称を正規化（空白除去）してチェック
-            name_normalized = name.replace(' ', '').replace('　', '')
-            skip_exact = ['計', '小計', '合計', '総合計', '工事費計', '税込合計', '税抜合計',
-                          '本工事費計', '直接工事費計', '諸経費計', '一般管理費', '消費税',
-                          '内訳明細書', '明細書']
-            if name_normalized in skip_exact:
-                continue
-            # 「○○計」パターン（ただし6文字以下の短い計のみ）
-            if name_normalized.endswith('計') and len(name_normalized) <= 7:
-                continue
-            # 「○○総計」パターン
-            if '総計' in name_normalized:
-                continue
-            # 消費税行をスキップ
-            if '消費税' in name or '税込' in name and '計' in name:
-                continue
-            # 注意書き行をスキップ（※で始まる）
-            if name.startswith('※') or name.startswith('＊'):
-                continue
-            # ヘッダータイトル行をスキップ（金額・数量・単価が全てない場合の「○○書」）
-            if name_normalized.endswith('書') and not amount and not unit_price_val:
-                continue
-            # カテゴリヘッダー行をスキップ（「○○工事」で金額・単価がない）
-            if (name_normalized.endswith('工事') or name_normalized.endswith('工')) and not amount and not unit_price_val:
-                continue
+    # シートのセル値は SheetGrid で先頭から1回だけ読む（ヘッダー検出・データ抽出で共用）
+    # window_load はテンプレート照合範囲の読込のみ（ヘッダー検出は row_extraction の走査内で行う）
+    window_span = trace.start('window_load', sheet=sheet_name)
+    grid = SheetGrid(sheet, max_col, budget)
+    grid.row(HEADER_WINDOW_ROWS + 1)  # テンプレート照合範囲（+1 は2段ヘッダー用）を読込
+    window_rows_loaded = grid.loaded_rows
+    trace.finish(window_span, rows=window_rows_loaded, cells=window_rows_loaded * max_col)
 
-            # 各カラムを取得
-            breakdown = ''
-            if 'breakdown' in header_map:
-                bd_idx = header_map['breakdown']
-                if bd_idx < len(cells):
-                    breakdown = str(cells[bd_idx].value or '').strip()
-
-            qty = None
-            qty_raw = None
-            if 'qty' in header_map:
-                qty_idx = header_map['qty']
-                if qty_idx < len(cells):
-                    qty_raw = cells[qty_idx].value
-                    qty = normalize_number(qty_raw)
-
-            unit = ''
-            if 'unit' in header_map:
-                unit_idx = header_map['unit']
-                if unit_idx < len(cells):
-                    unit = str(cells[unit_idx].value or '').strip()
-
-            # "一式"/"1式" パターン処理（qty列）
-            qty_raw_str = str(qty_raw or '').strip() if qty_raw else ''
-            if '式' in qty_raw_str or qty_raw_str in ['一式', '1式', '１式']:
-                qty = 1.0
-                if not unit:
-                    unit = '式'
+    # 結合セル解決（text_row が行の昇順に解決する）
+    merge_span = trace.start('merge_resolution', sheet=sheet_name)
+    grid.resolve_merges(sheet)
 
-            unit_price = None
-            if 'unit_price' in header_map:
-                up_idx = header_map['unit_price']
-                if up_idx < len(cells):
-                    unit_price = normalize_number(cells[up_idx].value)
-
-            note = ''
-            if 'note' in header_map:
-                note_idx = header_map['note']
-                if note_idx < len(cells):
-                    note = str(cells[note_idx].value or '').strip()
-
-            # "一式" パターン処理（name, breakdown, unit列もチェック）
-            # qty が空で、他の列に "一式" があれば qty=1, unit='式'
-            if qty is None:
-                check_texts = [name, breakdown, unit]
-                for txt in check_texts:
-                    if txt and ('一式' in txt or '1式' in txt or '１式' in txt):
-                        qty = 1.0
-                        if not unit or unit in ['一式', '1式', '１式']:
-                            unit = '式'
-                        break
-
-            # 自動計算（逆算）ロジック強化
-            # 1. amount が空で qty と unit_price があれば計算
-            if amount is None and qty is not None and unit_price is not None:
-                amount = round(qty * unit_price, 0)
-
-            # 2. qty が空で amount と unit_price があれば逆算
-            if qty is None and amount is not None and unit_price is not None and unit_price > 0:
-                qty = round(amount / unit_price, 2)  # 小数第2位まで
-
-            # 3. unit_price が空で amount と qty があれば逆算
-            if unit_price is None and amount is not None and qty is not None and qty > 0:
-                unit_price = round(amount / qty, 0)  # 単価は整数
-
-            # 4. amount だけある場合、qty=1 と仮定して unit_price を逆算
-            if qty is None and unit_price is None and amount is not None and amount > 0:
-                qty = 1.0
-                unit_price = amount
-                if not unit:
-                    unit = '式'
+    # テンプレート照合範囲の行（結合セル解決済みの文字列）
+    row_cache = {}
+    for row_idx in range(1, HEADER_WINDOW_ROWS + 2):
+        row_cache[row_idx] = grid.text_row(row_idx)
+    trace.finish(merge_span, rows=len(row_cache), cells=grid.merged_range_count)
+
+    layout_template = templates.match(row_cache) if templates else None
+    template_headers = {}
+    template_rows = set()
+    template_conflict = False  # 照合範囲にテンプレートに無いヘッダー候補があった
+    if layout_template:
+        # 学習済みテンプレートのヘッダー行と一致 → テンプレートのヘッダー行はそのまま採用
+        # （それ以外の行は候補判定を続け、候補があればテンプレートを使わずにやり直す）
+        template_headers = {h['row']: h for h in layout_template['headers']}
+        template_rows = {r for h in layout_template['headers'] for r in h['rows']}
+        logger.debug("  テンプレート適用: %s", layout_template['template_id'])
+
+    # ヘッダー検出とデータ抽出を先頭からの1回の走査で行う
+    # 読んだ行は pending に置き、ヘッダー候補のまとまりが確定した所でセクションへ振り分ける
+    # （まとまりより前の行は前のセクションのデータ、ヘッダー行は除外、以降は新しいセクション）
+    # row_extraction の時間にはヘッダー検出も含まれる
+    extract_span = trace.start('row_extraction', sheet=sheet_name)
+    detector = HeaderSectionDetector()
+    headers = []  # 確定したヘッダー（行順）
+    header_texts = {}  # ヘッダー行の文字列（レイアウトのシグネチャ用）
+    sections = []
+    pending = deque()  # 振り分け前の行 (行番号, 生のセル値, 文字列)
+    scanned_rows = 0
+    prev = None  # 候補判定待ちの直前の行 (行番号, 文字列, ヘッダーマップ)
+
+    def judge_row(row_idx: int, values: list, header_map: dict, next_map: dict):
+        """row_idx 行目のヘッダー候補を判定して検出器に渡し、確定したヘッダー・行を振り分ける"""
+        nonlocal template_conflict
+        if row_idx in template_rows:
+            candidate = template_headers.get(row_idx)
+        elif not any(values):
+            candidate = None  # 空行はスキップ
+        else:
+            candidate = header_row_candidate(row_idx, header_map, next_map)
+            if candidate is not None and template_headers and row_idx <= HEADER_WINDOW_ROWS + 1:
+                template_conflict = True
+
+        header = detector.feed(row_idx, candidate)
+        if header is not None:
+            add_header(header)
+        route_rows(detector.cluster_start if detector.cluster_start is not None else row_idx + 1)
+
+    def add_header(header: dict):
+        """確定したヘッダーより前の保留行を前のセクションへ渡し、新しいセクションを始める"""
+        route_rows(header['row'])
+        last_row = max(header['rows'])
+        while pending and pending[0][0] <= last_row:
+            row_idx, _, values = pending.popleft()
+            header_texts[row_idx] = values
+        headers.append(header)
+        sections.append(SheetSection(header, sheet_name))
+
+    def route_rows(before_row: int):
+        """before_row 行目より前の保留行を現在のセクションへ渡す（最初のヘッダーより前は捨てる）"""
+        while pending and pending[0][0] < before_row:
+            row_idx, cells, _ = pending.popleft()
+            if sections:
+                sections[-1].feed(row_idx, cells)
+
+    for row_idx, cells in grid.iter_rows(1):
+        scanned_rows += 1
+        values = row_cache[row_idx] if row_idx in row_cache else grid.text_row(row_idx)
+        if row_idx in template_rows:
+            header_map = {}  # テンプレートのヘッダー行
+        else:
+            header_map = try_map_header_row(values) if any(values) else {}
+        pending.append((row_idx, cells, values))
+        if prev is not None:
+            judge_row(*prev, header_map)
+            if template_conflict:
+                break
+        prev = (row_idx, values, header_map)
+        grid.discard_before(pending[0][0] if pending else row_idx + 1)  # 振り分け済みの行は以降参照しない
+    else:
+        if prev is not None:
+            judge_row(*prev, {})
+
+    if template_conflict:
+        # テンプレートに無いヘッダー（別セクション等）がある → 通常の検出でやり直す
+        logger.debug("  テンプレート外のヘッダー候補があるため再検出: %s", sheet_name)
+        trace.finish(extract_span, rows=scanned_rows, cells=scanned_rows * max_col, template_conflict=True)
+        retry = parse_sheet(sheet, sheet_name, budget=budget, diagnostics=diagnostics)
+        retry['spans'] = trace.spans + retry['spans']
+        return retry
+    header = detector.finish()
+    if header is not None:
+        add_header(header)
+    route_rows(scanned_rows + 1)
 
-            # 最低限nameかamountがあれば行を追加
-            if name or (amount is not None and amount != 0):
-                section_lines.append({
-                    'sheet_name': sheet_name,
-                    'row_no': row_idx,
-                    'name': name or '（名称なし）',
-                    'breakdown': breakdown,
-                    'qty': qty,
-                    'unit': unit,
-                    'unit_price': unit_price,
-                    'amount': amount,
-                    'note': note,
-                })
-
-        print(f"    セクション{section_idx+1}(行{header['rows']}): {len(section_lines)}行")
-        result['sections'].append({
-            'header_rows': header['rows'],
-            'header_map': list(header['map'].keys()),
-            'line_count': len(section_lines)
-        })
+    # ヘッダー候補がない場合
+    if not headers:
+        result['all_candidates'] = header_candidate_diagnostics(row_cache)
+        top_candidates = sorted(result['all_candidates'], key=lambda x: x['key_count'], reverse=True)[:5]
+        diag_lines = []
+        for c in top_candidates:
+            raw_str = ', '.join(c.get('raw_cells', [])[:3])
+            diag_lines.append(f"行{c['row']}: キー{c['key_count']}個 {c['columns']} [{raw_str}]")
+        result['skip_reason'] = f"ヘッダー行が見つかりません（キー列2つ以上必要）。\n" + "\n".join(diag_lines)
+        trace.finish(extract_span, rows=scanned_rows, cells=scanned_rows * max_col,
+                     candidates=len(result['all_candidates']), lines=0)
+        logger.debug("  ✗ ヘッダー未検出: %s", sheet_name)
+        logger.debug("    上位候補:")
+        for dl in diag_lines[:3]:
+            logger.debug("      %s", dl)
+        return result
+
+    result['layout'] = {
+        'template_id': layout_template['template_id'] if layout_template else None,
+        'headers': header_layout(headers, header_texts),
+    }
+    logger.debug("  検出ヘッダー数: %s", len(headers))
+
+    # 各セクションの明細を確定（最終セクションは空行10行、それ以外は20行で終端）
+    all_lines = []
+    all_columns = []
+    for section_idx, section in enumerate(sections):
+        header = section.header
+        logger.debug("    行%s: キー%s個 %s", header['rows'], header['key_count'], list(header['map'].keys()))
+        if not section.valid:
+            logger.debug("    セクション%sスキップ: 有効カラムなし %s", section_idx + 1, list(header['map'].keys()))
+            continue
+        section_lines, section_columns = section.finalize(section_idx + 1 < len(sections))
+        all_columns.append(section_columns)
+        logger.debug("    セクション%s(行%s): %s行", section_idx + 1, header['rows'], len(section_lines))
+        if diagnostics:
+            result['sections'].append({
+                'header_rows': header['rows'],
+                'header_map': list(header['map'].keys()),
+                'line_count': len(section_lines)
+            })
         all_lines.extend(section_lines)
 
     # 結果を設定
     result['lines'] = all_lines
-    if filtered_headers:
-        # 最初のヘッダーを代表として設定（後方互換）
-        result['header_row'] = filtered_headers[0]['row']
-        result['header_rows'] = filtered_headers[0]['rows']
-        result['header_map'] = filtered_headers[0]['map']
-
+    result['columns'] = LineColumns.concat(all_columns)
+    trace.finish(extract_span, rows=scanned_rows, cells=scanned_rows * max_col,
+                 headers=len(headers), lines=len(all_lines))
+    # 最初のヘッダーを代表として設定（後方互換）
+    result['header_row'] = headers[0]['row']
+    result['header_rows'] = headers[0]['rows']
+    result['header_map'] = headers[0]['map']
+
+    if not result['lines'] and layout_template:
+        # テンプレートが合わなかった（ヘッダーは一致したが明細が取れない）→ 通常の検出でやり直す
+        logger.debug("  テンプレート不一致のため再検出: %s", sheet_name)
+        retry = parse_sheet(sheet, sheet_name, budget=budget, diagnostics=diagnostics)
+        retry['spans'] = trace.spans + retry['spans']
+        return retry
+
+    if not result['lines'] or diagnostics:
+        result['all_candidates'] = header_candidate_diagnostics(row_cache)
     if not result['lines']:
         result['skip_reason'] = 'データ行が見つかりません（ヘッダー行の下にデータがありません）'
-        print(f"  ✗ データ行なし: {sheet_name}")
+        logger.debug("  ✗ データ行なし: %s", sheet_name)
     else:
-        print(f"  ✓ {len(result['lines'])}行のデータを抽出（{len(filtered_headers)}セクション）: {sheet_name}")
+        logger.debug("  ✓ %s行のデータを抽出（%sセクション）: %s", len(result['lines']), len(headers), sheet_name)
 
     return result
 
 
 
+# =====================================
+# Excel解析結果キャッシュ（ファイルのSHA256 + パーサーバージョン）
+# =====================================
+
+# 解析ロジックの出力が変わる変更をしたら上げる（古いキャッシュは参照されなくなる）
+PARSER_VERSION = "6"
+# キャッシュの最大合計サイズ（超えたら最終参照が古い順に削除）
+PARSE_CACHE_MAX_BYTES = int(os.getenv("PARSE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+parse_cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_parse_cache_lock = threading.Lock()
+
+
+def parse_cache_path(file_hash: str) -> Path:
+    """キャッシュファイルのパス"""
+    return PARSE_CACHE_DIR / f"{file_hash}_v{PARSER_VERSION}.json"
+
+
+def parse_cache_get(file_hash: str) -> Optional[dict]:
+    """キャッシュ済みの解析結果を返す（なければ None）"""
+    path = parse_cache_path(file_hash)
+    try:
+        with open(path, encoding='utf-8') as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        with _parse_cache_lock:
+            parse_cache_stats['misses'] += 1
+        return None
+
+    # 最終参照日時を更新（削除順の判定に使用）
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    with _parse_cache_lock:
+        parse_cache_stats['hits'] += 1
+    return result
+
+
+def parse_cache_put(file_hash: str, result: dict):
+    """解析結果をキャッシュに保存し、上限を超えた分を削除"""
+    path = parse_cache_path(file_hash)
+    tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("[解析キャッシュ] 保存失敗: %s", e)
+        tmp_path.unlink(missing_ok=True)
+        return
+
+    with _parse_cache_lock:
+        parse_cache_stats['stores'] += 1
+        evict_parse_cache()
+
+
+def evict_parse_cache():
+    """合計サイズが PARSE_CACHE_MAX_BYTES 以下になるまで古いキャッシュを削除"""
+    entries = []
+    total = 0
+    for entry in os.scandir(PARSE_CACHE_DIR):
+        if not entry.name.endswith('.json'):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= PARSE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        parse_cache_stats['evictions'] += 1
+
+
+def parse_excel_cached(
+    file_path,
+    file_hash: str,
+    progress_callback=None,
+    trace: Optional[ImportTrace] = None,
+    templates=None,
+    budget: Optional[ParseBudget] = None,
+    full_parse: bool = False,
+    diagnostics: bool = False,
+) -> tuple:
+    """
+    キャッシュを使って Excel を解析
+    同じ内容のファイルの再アップロードは openpyxl を開かずに結果を返す
+    （全シート解析・診断付きは別キー）
+    テンプレートを使った解析結果は保存しない（キャッシュは発注者をまたいで共有されるため、
+    ある発注者のテンプレートに依存した結果や template_id を他のアップロードへ返さない）
+    file_path はファイルパスまたはバイナリのファイルオブジェクト（parse_excel_to_lines 参照）
+    戻り値: (解析結果, キャッシュヒットしたか)
+    """
+    if trace is None:
+        trace = ImportTrace()
+    cache_key = file_hash + ('_full' if full_parse else '') + ('_diag' if diagnostics else '')
+    cache_span = trace.start('parse_cache')
+    cached = parse_cache_get(cache_key)
+    if cached is not None:
+        trace.finish(cache_span, hit=True, rows=len(cached['lines']))
+        return cached, True
+    trace.finish(cache_span, hit=False)
+
+    result = parse_excel_to_lines(
+        file_path, progress_callback=progress_callback, trace=trace, templates=templates, budget=budget,
+        full_parse=full_parse, diagnostics=diagnostics,
+    )
+    # 読込エラーは一時的な要因の可能性があるためキャッシュしない
+    used_template = any(layout.get('template_id') for layout in result['layouts'].values())
+    if not result['parse_errors'] and not used_template:
+        parse_cache_put(cache_key, result)
+    return result, False
+
+
+@app.get("/api/parse-cache/stats")
+async def get_parse_cache_stats():
+    """
+    解析結果キャッシュのヒット/ミス数とサイズ
+    """
+    entry_count = 0
+    total_bytes = 0
+    for entry in os.scandir(PARSE_CACHE_DIR):
+        if entry.name.endswith('.json'):
+            entry_count += 1
+            total_bytes += entry.stat().st_size
+
+    with _parse_cache_lock:
+        stats = dict(parse_cache_stats)
+    lookups = stats['hits'] + stats['misses']
+    return {
+        'status': 'success',
+        'parser_version': PARSER_VERSION,
+        **stats,
+        'hit_rate': f"{stats['hits'] / lookups * 100:.1f}%" if lookups > 0 else "0%",
+        'entries': entry_count,
+        'total_bytes': total_bytes,
+        'max_bytes': PARSE_CACHE_MAX_BYTES,
+    }
+
+
+# =====================================
+# 一括登録（バルクインサート）
+# =====================================
+# 明細など大量の行を ORM の unit of work を通さず、複数行 INSERT / executemany で登録する
+# （PostgreSQL では psycopg2 の insertmanyvalues で1バッチ1往復になる）
+
+BULK_INSERT_BATCH_SIZE = max(1, int(os.getenv("BULK_INSERT_BATCH_SIZE", "1000")))
+
+
+def bulk_insert(db: Session, model, rows: List[dict], batch_size: Optional[int] = None) -> dict:
+    """
+    辞書のリストを batch_size 件ずつまとめて INSERT
+    id / created_at 等のカラム default は SQLAlchemy Core が行ごとに補う
+    コミットは呼び出し側で行う
+    戻り値: {'table', 'rows', 'batches', 'batch_ms', 'total_ms'}
+    """
+    batch_size = batch_size or BULK_INSERT_BATCH_SIZE
+    table = model.__table__
+    stats = {'table': table.name, 'rows': len(rows), 'batches': 0, 'batch_ms': [], 'total_ms': 0.0}
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        t0 = time.perf_counter()
+        db.execute(insert(table), batch)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        stats['batches'] += 1
+        stats['batch_ms'].append(round(elapsed_ms, 2))
+        stats['total_ms'] += elapsed_ms
+
+    stats['total_ms'] = round(stats['total_ms'], 2)
+    if rows:
+        logger.debug("[bulk_insert] %s: %s行 / %sバッチ / %.1fms (バッチ別ms: %s)",
+                     table.name, len(rows), stats['batches'], stats['total_ms'], stats['batch_ms'])
+    return stats
+
+
+# IN (...) に渡す id の1回あたりの件数（古い SQLite のバインド変数上限 999 を超えないように）
+IN_CLAUSE_BATCH_SIZE = 500
+
+
+def iter_batches(items: list, batch_size: int = IN_CLAUSE_BATCH_SIZE):
+    """items を batch_size 件ずつに分けて返す（IN 句のバインド変数を上限内に収めるため）"""
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def bulk_update_by_id(db: Session, model, rows: List[dict], batch_size: Optional[int] = None) -> dict:
+    """
+    {'id': ..., カラム: 値} のリストを id 指定の UPDATE（executemany）で一括更新
+    全行が同じカラムを持つこと。コミットは呼び出し側で行う
+    戻り値: bulk_insert と同じ形式
+    """
+    batch_size = batch_size or BULK_INSERT_BATCH_SIZE
+    table = model.__table__
+    stats = {'table': table.name, 'rows': len(rows), 'batches': 0, 'batch_ms': [], 'total_ms': 0.0}
+    if not rows:
+        return stats
+
+    # bindparam 名はカラム名と衝突できないため b_ を付ける
+    columns = [k for k in rows[0] if k != 'id']
+    stmt = update(table).where(table.c.id == bindparam('b_id')).values(
+        {col: bindparam(f'b_{col}') for col in columns}
+    )
+    for start in range(0, len(rows), batch_size):
+        batch = [{f'b_{k}': v for k, v in row.items()} for row in rows[start:start + batch_size]]
+        t0 = time.perf_counter()
+        db.connection().execute(stmt, batch)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        stats['batches'] += 1
+        stats['batch_ms'].append(round(elapsed_ms, 2))
+        stats['total_ms'] += elapsed_ms
+
+    stats['total_ms'] = round(stats['total_ms'], 2)
+    logger.debug("[bulk_update] %s: %s行 / %sバッチ / %.1fms (バッチ別ms: %s)",
+                 table.name, len(rows), stats['batches'], stats['total_ms'], stats['batch_ms'])
+    return stats
+
+
+# =====================================
+# ヘッダーテンプレート（確定済みインポートから学習）
+# =====================================
+# 同じ発注者から同じ様式のブックが繰り返し届くため、確定したインポートのヘッダー行・列マップを
+# シートのレイアウトごとに保存し、次回の解析ではヘッダー候補探索を省略する
+
+# 発注者ごとの照合インデックス {client_name: ((件数, 最終更新), HeaderTemplateIndex)}
+_header_template_cache = {}
+_header_template_lock = threading.Lock()
+# テンプレートのテーブルが無い等の DB エラー（テンプレートなしで取込を続ける）
+HEADER_TEMPLATE_DB_ERRORS = (OperationalError, ProgrammingError)
+
+
+def load_header_templates(db: Session, client_name: str) -> Optional[HeaderTemplateIndex]:
+    """
+    発注者のテンプレートを照合インデックスで返す（件数・最終更新が変わらなければ再構築しない）
+    テーブルが読めない場合はログを出して None（テンプレートなしで解析）
+    """
+    query = db.query(HeaderTemplateModel).filter(HeaderTemplateModel.client_name == client_name)
+    try:
+        # 失敗しても取込のトランザクションを巻き込まないようセーブポイント内で読む
+        with db.begin_nested():
+            stamp = query.with_entities(
+                func.count(HeaderTemplateModel.id), func.max(HeaderTemplateModel.updated_at)
+            ).one()
+            stamp = (stamp[0], stamp[1])
+            with _header_template_lock:
+                cached = _header_template_cache.get(client_name)
+                if cached is not None and cached[0] == stamp:
+                    return cached[1]
+            rows = query.with_entities(HeaderTemplateModel.id, HeaderTemplateModel.headers_json).all()
+    except HEADER_TEMPLATE_DB_ERRORS as e:
+        logger.warning("[ヘッダーテンプレート] 読込に失敗したためテンプレートなしで解析: %s", e.orig)
+        return None
+
+    index = HeaderTemplateIndex([
+        {'id': row.id, 'headers': json.loads(row.headers_json)} for row in rows
+    ])
+    with _header_template_lock:
+        _header_template_cache[client_name] = (stamp, index)
+    return index
+
+
+def mark_header_templates_used(db: Session, layouts: dict):
+    """解析で使われたテンプレートの利用回数・最終利用日時を更新（コミットは呼び出し側）"""
+    used = {}
+    for layout in layouts.values():
+        if layout.get('template_id'):
+            used[layout['template_id']] = used.get(layout['template_id'], 0) + 1
+    now = datetime.utcnow()
+    if not used:
+        return
+    try:
+        with db.begin_nested():
+            for template_id, count in used.items():
+                # updated_at は照合インデックスの再構築判定に使うため変えない
+                db.query(HeaderTemplateModel).filter(HeaderTemplateModel.id == template_id).update({
+                    HeaderTemplateModel.hit_count: HeaderTemplateModel.hit_count + count,
+                    HeaderTemplateModel.last_used_at: now,
+                    HeaderTemplateModel.updated_at: HeaderTemplateModel.updated_at,
+                }, synchronize_session=False)
+    except HEADER_TEMPLATE_DB_ERRORS as e:
+        logger.warning("[ヘッダーテンプレート] 利用回数の更新に失敗: %s", e.orig)
+
+
+def learn_header_templates(db: Session, estimate_import, client_name: str) -> int:
+    """
+    確定するインポートのシートレイアウトをテンプレートとして登録（同じレイアウトは登録済みなら何もしない）
+    戻り値: 新規登録数（コミットは呼び出し側、テーブルが使えない場合はログを出して 0）
+    """
+    meta = json.loads(estimate_import.meta_json or '{}')
+    layouts = meta.get('layouts') or {}
+    if not layouts:
+        return 0
+
+    by_fingerprint = {}
+    for sheet_name, layout in layouts.items():
+        # 照合できるのは先頭の照合範囲内のヘッダーのみ（以降のセクションは取込時に検出する）
+        headers = [h for h in layout['headers'] if max(h['rows']) <= HEADER_WINDOW_ROWS + 1]
+        if not headers:
+            continue
+        fingerprint = header_layout_fingerprint(client_name, headers)
+        by_fingerprint.setdefault(fingerprint, (sheet_name, headers))
+
+    learned = 0
+    try:
+        # 失敗しても確定のトランザクションを巻き込まないようセーブポイント内で登録する
+        with db.begin_nested():
+            existing = {
+                row.fingerprint for row in db.query(HeaderTemplateModel.fingerprint).filter(
+                    HeaderTemplateModel.fingerprint.in_(list(by_fingerprint))
+                )
+            }
+            for fingerprint, (sheet_name, headers) in by_fingerprint.items():
+                if fingerprint in existing:
+                    continue
+                db.add(HeaderTemplateModel(
+                    fingerprint=fingerprint,
+                    client_name=client_name,
+                    sheet_name=sheet_name,
+                    headers_json=json.dumps(headers, ensure_ascii=False),
+                ))
+                learned += 1
+    except HEADER_TEMPLATE_DB_ERRORS as e:
+        logger.warning("[ヘッダーテンプレート] %s: 学習に失敗: %s", client_name, e.orig)
+        return 0
+    if learned:
+        logger.info("[ヘッダーテンプレート] %s: %s件を学習", client_name, learned)
+    return learned
+
+
+@app.get("/api/header-templates")
+async def get_header_templates(client_name: Optional[str] = None, db: Session = Depends(get_db)):
+    """
+    学習済みヘッダーテンプレート一覧（client_name 指定時はその発注者のみ）
+    """
+    query = db.query(HeaderTemplateModel)
+    if client_name:
+        query = query.filter(HeaderTemplateModel.client_name == client_name)
+    templates = query.order_by(HeaderTemplateModel.created_at.desc()).all()
+
+    return {
+        'status': 'success',
+        'templates': [
+            {
+                'id': t.id,
+                'client_name': t.client_name,
+                'sheet_name': t.sheet_name,
+                'headers': [
+                    {'rows': h['rows'], 'columns': list(h['map'].keys())}
+                    for h in json.loads(t.headers_json)
+                ],
+                'hit_count': t.hit_count or 0,
+                'created_at': t.created_at.isoformat() if t.created_at else None,
+                'last_used_at': t.last_used_at.isoformat() if t.last_used_at else None,
+            }
+            for t in templates
+        ],
+    }
+
+
+@app.delete("/api/header-templates/{template_id}")
+async def delete_header_template(template_id: str, db: Session = Depends(get_db)):
+    """
+    ヘッダーテンプレートを削除（誤ったレイアウトを学習した場合など）
+    """
+    existing = db.query(HeaderTemplateModel).filter(HeaderTemplateModel.id == template_id).first()
+    if not existing:
+        raise HTTPException(status_code=404, detail="テンプレートが見つかりません")
+
+    db.delete(existing)
+    db.commit()
+
+    return {"status": "success", "message": "削除しました"}
+
+
+# =====================================
+# 原価分類エンジン
+# =====================================
+# キーワードルールは上から順に判定し、最初に一致したカテゴリを返す
+# ルールを変更した場合は scripts/reclassify_estimate_lines.py で既存明細を再分類する
+
+# 見積明細（estimate_lines.category）用
+COST_CATEGORY_RULES = [
+    ('labor', ['労務', '人工', '作業員', '技術者', '人件', '日当']),
+    ('subcontract', ['外注', '下請', '業者', '協力']),
+    ('material', ['材料', '資材', '管', 'パイプ', 'コンクリート', 'アスファルト', '鋼材']),
+    ('machine', ['機械', '重機', 'リース', 'クレーン', 'バックホウ', 'ダンプ']),
+]
+
+# 原価記録（cost_records.category）用
+COST_ITEM_RULES = [
+    ('material', ['材料', '資材', '管', 'パイプ', 'コンクリート']),
+    ('labor', ['労務', '人工', '作業員', '技術者']),
+    ('equipment', ['機械', '重機', 'リース', 'クレーン']),
+    ('subcontract', ['外注', '下請', '業者']),
+]
+
+
+class CostClassifier:
+    """
+    キーワードルールをカテゴリごとの正規表現にコンパイルした分類器
+    結果は正規化した名称ごとにメモ化する
+    """
+
+    def __init__(self, rules: list, default: str = 'expense'):
+        self.default = default
+        self._patterns = [
+            (category, re.compile('|'.join(re.escape(kw) for kw in keywords)))
+            for category, keywords in rules
+        ]
+        self._classify_normalized = lru_cache(maxsize=8192)(self._match)
+
+    def _match(self, key: str) -> str:
+        for category, pattern in self._patterns:
+            if pattern.search(key):
+                return category
+        return self.default
+
+    def classify(self, name) -> str:
+        """名称からカテゴリを判定"""
+        if not name:
+            return self.default
+        return self._classify_normalized(str(name).strip().lower())
+
+    def classify_many(self, names) -> List[str]:
+        """名称のリストをまとめて判定（同じ名称は1回だけ判定）"""
+        results = {}
+        categories = []
+        for name in names:
+            if name not in results:
+                results[name] = self.classify(name)
+            categories.append(results[name])
+        return categories
+
+    def cache_clear(self):
+        self._classify_normalized.cache_clear()
+
+
+COST_CATEGORY_CLASSIFIER = CostClassifier(COST_CATEGORY_RULES)
+COST_ITEM_CLASSIFIER = CostClassifier(COST_ITEM_RULES)
+
+
 def classify_cost_category(name: str) -> str:
     """
     名称から原価カテゴリを推定
     """
-    name_lower = name.lower()
+    return COST_CATEGORY_CLASSIFIER.classify(name)
 
-    if any(kw in name_lower for kw in ['労務', '人工', '作業員', '技術者', '人件', '日当']):
-        return 'labor'
-    elif any(kw in name_lower for kw in ['外注', '下請', '業者', '協力']):
-        return 'subcontract'
-    elif any(kw in name_lower for kw in ['材料', '資材', '管', 'パイプ', 'コンクリート', 'アスファルト', '鋼材']):
-        return 'material'
-    elif any(kw in name_lower for kw in ['機械', '重機', 'リース', 'クレーン', 'バックホウ', 'ダンプ']):
-        return 'machine'
-    else:
-        return 'expense'
+
+def reclassify_estimate_lines(db: Session, chunk_size: Optional[int] = None, apply: bool = True) -> dict:
+    """
+    既存の estimate_lines の category を現在のルールで再分類
+    (id, name, category) だけを id 順のキーセットで chunk_size 件ずつ読み、
+    変更がある行だけを一括更新してチャンクごとにコミットする
+    戻り値: {'scanned', 'changed', 'chunks', 'by_category': {旧→新: 件数}}
+    """
+    chunk_size = chunk_size or BULK_INSERT_BATCH_SIZE
+    stats = {'scanned': 0, 'changed': 0, 'chunks': 0, 'by_category': {}}
+    last_id = None
+
+    while True:
+        query = db.query(
+            EstimateLineModel.id, EstimateLineModel.name, EstimateLineModel.category
+        ).order_by(EstimateLineModel.id)
+        if last_id is not None:
+            query = query.filter(EstimateLineModel.id > last_id)
+        rows = query.limit(chunk_size).all()
+        if not rows:
+            break
+
+        categories = COST_CATEGORY_CLASSIFIER.classify_many([row.name for row in rows])
+        changes = []
+        for row, category in zip(rows, categories):
+            if row.category != category:
+                changes.append({'id': row.id, 'category': category})
+                key = f"{row.category}→{category}"
+                stats['by_category'][key] = stats['by_category'].get(key, 0) + 1
+
+        if apply and changes:
+            bulk_update_by_id(db, EstimateLineModel, changes)
+            db.commit()
+
+        stats['scanned'] += len(rows)
+        stats['changed'] += len(changes)
+        stats['chunks'] += 1
+        last_id = rows[-1].id
+
+    return stats
+
+
+# =====================================
+# 差分再取込（前回確定分との行単位の差分）
+# =====================================
+# 改訂版の見積を再アップロードした場合、前回確定したインポートの明細と (シート名, 行番号, 名称) で突き合わせ、
+# 内容ハッシュが変わった行だけを更新・追加・削除する（estimate_lines が改訂ごとに増え続けないように）
+
+# 内容ハッシュの対象（突き合わせキー以外で、取込で決まる列）
+ESTIMATE_LINE_CONTENT_FIELDS = ['breakdown', 'qty', 'unit', 'unit_price', 'amount', 'note', 'category']
+
+
+def estimate_line_key(line) -> tuple:
+    """差分の突き合わせキー (シート名, 行番号, 名称)（dict / Row どちらも可）"""
+    get = line.get if isinstance(line, dict) else lambda k: getattr(line, k)
+    return (get('sheet_name'), get('row_no'), get('name'))
+
+
+def estimate_line_hash(line) -> str:
+    """明細内容のハッシュ（ESTIMATE_LINE_CONTENT_FIELDS のみ）"""
+    get = line.get if isinstance(line, dict) else lambda k: getattr(line, k)
+    content = json.dumps([get(field) for field in ESTIMATE_LINE_CONTENT_FIELDS], ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def latest_committed_import(db: Session, project_id: str):
+    """プロジェクトで最後に確定したインポート（差分の比較元）"""
+    return db.query(EstimateImportModel).filter_by(
+        project_id=project_id,
+        status='committed'
+    ).order_by(EstimateImportModel.uploaded_at.desc()).first()
+
+
+def diff_estimate_lines(db: Session, base_import_id: str, preview_lines: list) -> dict:
+    """
+    新しい解析結果と比較元インポートの明細の差分
+    戻り値: {'inserted': [新しい行], 'updated': [(比較元の行, 新しい行)], 'deleted': [比較元の行], 'unchanged': 件数}
+    比較元の行は id と突き合わせ・内容の列だけを読む
+    """
+    base_rows = db.query(
+        EstimateLineModel.id,
+        EstimateLineModel.sheet_name,
+        EstimateLineModel.row_no,
+        EstimateLineModel.name,
+        *[getattr(EstimateLineModel, field) for field in ESTIMATE_LINE_CONTENT_FIELDS],
+    ).filter(EstimateLineModel.import_id == base_import_id).all()
+
+    # 同じキーの行が重複していれば2行目以降は突き合わせ対象外（削除扱い）
+    base_by_key = {}
+    duplicates = []
+    for row in base_rows:
+        key = estimate_line_key(row)
+        if key in base_by_key:
+            duplicates.append(row)
+        else:
+            base_by_key[key] = row
+
+    diff = {'inserted': [], 'updated': [], 'deleted': duplicates, 'unchanged': 0}
+    for line in preview_lines:
+        base = base_by_key.pop(estimate_line_key(line), None)
+        if base is None:
+            diff['inserted'].append(line)
+        elif estimate_line_hash(base) != estimate_line_hash(line):
+            diff['updated'].append((base, line))
+        else:
+            diff['unchanged'] += 1
+    diff['deleted'].extend(base_by_key.values())
+    return diff
+
+
+def apply_estimate_line_diff(db: Session, estimate_import, kind: str, month: Optional[str]) -> dict:
+    """
+    差分ドラフトを比較元インポートへ反映（コミットは呼び出し側）
+    ドラフトには追加・変更後の行だけが入っている。変更行は内容を比較元の行へ写して削除し、
+    追加行は比較元インポートへ移す。削除行は比較元から消す
+    比較元の後に別のインポートが確定されていれば反映しない（409）
+    kind / month が比較元の明細と異なる場合も反映しない（409。変更行は比較元の種類・月のまま残るため）
+    反映後、比較元の line_count / total_amount / value_stats を明細から再計算する
+    戻り値: {'base_import_id', 'inserted', 'updated', 'deleted', 'inserted_ids'}
+    """
+    meta = json.loads(estimate_import.meta_json or '{}')
+    diff = meta['diff']
+    base_import = latest_committed_import(db, estimate_import.project_id)
+    if base_import is None or base_import.id != diff['base_import_id']:
+        raise HTTPException(status_code=409, detail="比較元のインポートが更新されています。再度アップロードしてください")
+
+    base_kinds = db.query(EstimateLineModel.kind, EstimateLineModel.month).filter(
+        EstimateLineModel.import_id == base_import.id
+    ).distinct().all()
+    if base_kinds:
+        kinds = {row.kind for row in base_kinds}
+        months = {row.month for row in base_kinds}
+        if kinds != {kind} or (month and months != {month}):
+            raise HTTPException(
+                status_code=409,
+                detail=f"比較元の明細（種類: {'/'.join(sorted(str(k) for k in kinds))}）と異なる種類・月では"
+                       f"差分を反映できません。通常の取込として再度アップロードしてください"
+            )
+        if not month and len(months) == 1:
+            month = next(iter(months))  # 追加行も比較元と同じ月にする
+
+    staged = db.query(
+        EstimateLineModel.id,
+        EstimateLineModel.sheet_name,
+        EstimateLineModel.row_no,
+        EstimateLineModel.name,
+        *[getattr(EstimateLineModel, field) for field in ESTIMATE_LINE_CONTENT_FIELDS],
+    ).filter(EstimateLineModel.import_id == estimate_import.id).all()
+    staged_by_key = {estimate_line_key(row): row for row in staged}
+
+    # 変更: 比較元の行（並び順・種類・月はそのまま）へ内容を写し、ドラフト側の行は削除
+    updates = []
+    consumed_ids = []
+    for base_id, sheet_name, row_no, name in diff['updates']:
+        row = staged_by_key.pop((sheet_name, row_no, name), None)
+        if row is None:
+            continue
+        updates.append({'id': base_id, **{field: getattr(row, field) for field in ESTIMATE_LINE_CONTENT_FIELDS}})
+        consumed_ids.append(row.id)
+    bulk_update_by_id(db, EstimateLineModel, updates)
+    for batch in iter_batches(consumed_ids):
+        db.query(EstimateLineModel).filter(
+            EstimateLineModel.id.in_(batch)
+        ).delete(synchronize_session=False)
+
+    # 追加: 比較元インポートへ移す
+    inserted_ids = [row.id for row in staged_by_key.values()]
+    if inserted_ids:
+        values = {EstimateLineModel.import_id: base_import.id, EstimateLineModel.kind: kind}
+        if month:
+            values[EstimateLineModel.month] = month
+        for batch in iter_batches(inserted_ids):
+            db.query(EstimateLineModel).filter(
+                EstimateLineModel.id.in_(batch)
+            ).update(values, synchronize_session=False)
+
+    # 削除
+    deleted = 0
+    for batch in iter_batches(diff['deleted_ids']):
+        deleted += db.query(EstimateLineModel).filter(
+            EstimateLineModel.import_id == base_import.id,
+            EstimateLineModel.id.in_(batch)
+        ).delete(synchronize_session=False)
+
+    # 比較元の集計を反映後の明細で更新し、改訂履歴を残す
+    base_lines = [
+        row._asdict() for row in db.query(
+            EstimateLineModel.qty, EstimateLineModel.unit, EstimateLineModel.unit_price, EstimateLineModel.amount,
+        ).filter(EstimateLineModel.import_id == base_import.id)
+    ]
+    base_columns = LineColumns.from_lines(base_lines)
+    base_meta = json.loads(base_import.meta_json or '{}')
+    base_meta['line_count'] = len(base_lines)
+    base_meta['total_amount'] = base_columns.total_amount()
+    base_meta['value_stats'] = base_columns.value_stats() if base_lines else {}
+    base_meta.setdefault('revisions', []).append({
+        'import_id': estimate_import.id,
+        'filename': estimate_import.original_filename,
+        'inserted': len(inserted_ids),
+        'updated': len(updates),
+        'deleted': deleted,
+        'applied_at': datetime.utcnow().isoformat(),
+    })
+    base_import.meta_json = json.dumps(base_meta, ensure_ascii=False)
+
+    return {
+        'base_import_id': base_import.id,
+        'inserted': len(inserted_ids),
+        'updated': len(updates),
+        'deleted': deleted,
+        'inserted_ids': inserted_ids,
+    }
+
+
+# =====================================
+# 見積Excel取込（解析〜ドラフト作成）
+# =====================================
+
+def run_estimate_import(
+    db: Session,
+    project_id: str,
+    original_filename: str,
+    file_path: Path,
+    file_hash: str,
+    progress_callback=None,
+    incremental: bool = False,
+    budget: Optional[ParseBudget] = None,
+    full_parse: bool = False,
+    diagnostics: bool = False,
+) -> dict:
+    """
+    保存済みExcelを解析してドラフトのインポートを作成し、プレビューを返す
+    アップロードAPIとバックグラウンド取込ジョブで共用（同期処理）
+    progress_callback: シート解析ごとに呼ばれる（parse_excel_to_lines 参照）
+    incremental: True の場合、前回確定したインポートとの差分（追加・変更行）だけをドラフトに登録し、
+                 コミット時に比較元へ反映する（確定済みのインポートが無ければ通常の取込）
+    budget: 解析のリソース上限・キャンセル（未指定時は既定値）。解析後のキャンセルは ImportCancelled を送出
+    full_parse: True の場合はシート選別を行わず全シートを解析する
+    diagnostics: True の場合はプレビューに diagnostics（シートごとの候補診断・セクション情報）を含める
+    """
+    trace = ImportTrace()
+
+    # 発注者の学習済みヘッダーテンプレート
+    project = db.query(ProjectModel).filter_by(id=project_id).first()
+    templates = load_header_templates(db, project.client_name) if project else None
+
+    # Excel解析（新形式: dictを返す）同一内容の再アップロードはキャッシュから
+    parse_result, cache_hit = parse_excel_cached(
+        file_path, file_hash, progress_callback=progress_callback, trace=trace, templates=templates,
+        budget=budget, full_parse=full_parse, diagnostics=diagnostics,
+    )
+    parsed_lines = parse_result['lines']
+
+    # 0件の場合は詳細な原因を返す
+    if not parsed_lines:
+        error_reasons = []
+        if parse_result['parse_errors']:
+            error_reasons.extend(parse_result['parse_errors'])
+        if parse_result['sheets_skipped']:
+            for skip in parse_result['sheets_skipped']:
+                reason_msg = f"シート「{skip['name']}」: {skip['reason']}"
+                # 候補行があれば追記
+                if skip.get('candidates'):
+                    top_cands = skip['candidates'][:2]
+                    cand_str = ', '.join([f"行{c['row']}({','.join(c['columns'][:3])})" for c in top_cands])
+                    reason_msg += f" [候補: {cand_str}]"
+                error_reasons.append(reason_msg)
+        if not error_reasons:
+            error_reasons.append('ヘッダー行（名称/数量/単価/金額が2つ以上揃う行）を検出できませんでした')
+
+        # 理由コードを日本語に変換
+        reason_labels = {
+            'parse_error': 'Excelファイルの読み込みエラー',
+            'unsupported_format': '対応していないファイル形式です',
+            'empty_workbook': '空のワークブック',
+            'header_not_found': 'ヘッダー行が見つかりません',
+            'no_line_item_sheets': '明細シートが見つかりません（表紙・条件書等のみ。full_parse=true で全シートを解析）',
+            'required_columns_missing': '必須カラム（名称/金額）がありません',
+            'no_data_rows': 'データ行がありません',
+            'budget_exceeded': '解析の上限（時間・セル数・シート数・メモリ）を超えました',
+            'cancelled': '取込がキャンセルされました',
+        }
+        reason_code = parse_result.get('reason', 'unknown')
+        trace.log_summary(original_filename)
+
+        preview = {
+            'lines': [],
+            'total_amount': 0,
+            'line_count': 0,
+            'sheets_processed': [],
+            'sheets_skipped': parse_result['sheets_skipped'],
+            'sheet_triage': parse_result.get('triage', []),
+            'missing_columns': parse_result['missing_columns'],
+            'error_reasons': error_reasons,
+            'reason': reason_code,
+            'reason_label': reason_labels.get(reason_code, reason_code),
+            'budget': parse_result.get('budget'),
+            'parse_cache': 'hit' if cache_hit else 'miss',
+        }
+        if 'diagnostics' in parse_result:
+            preview['diagnostics'] = parse_result['diagnostics']
+        return {
+            'status': 'warning',
+            'import_id': None,
+            'filename': original_filename,
+            'preview': preview,
+        }
+
+    # 解析後にキャンセルされていれば登録しない
+    if budget is not None and budget.cancelled:
+        raise ImportCancelled()
+
+    # カテゴリ付与（同じ名称はまとめて判定、解析結果の行にそのまま追加）
+    classify_span = trace.start('classification')
+    categories = COST_CATEGORY_CLASSIFIER.classify_many([line['name'] for line in parsed_lines])
+    for line, category in zip(parsed_lines, categories):
+        line['category'] = category
+    trace.finish(classify_span, rows=len(parsed_lines))
+
+    # 差分再取込: 前回確定分と突き合わせ、登録するのは追加・変更行のみ
+    diff = None
+    staged_lines = parsed_lines
+    base_import = latest_committed_import(db, project_id) if incremental else None
+    if base_import is not None:
+        diff_span = trace.start('diff')
+        diff = diff_estimate_lines(db, base_import.id, parsed_lines)
+        staged_lines = diff['inserted'] + [line for _, line in diff['updated']]
+        trace.finish(diff_span, rows=len(parsed_lines), changed=len(staged_lines) + len(diff['deleted']))
+
+    # EstimateImportレコード作成（draft状態）
+    insert_span = trace.start('db_insert')
+    meta = {
+        'sheets_processed': parse_result['sheets_processed'],
+        'sheets_skipped': parse_result['sheets_skipped'],
+        'detected_headers': {k: v for k, v in parse_result['detected_headers'].items()},
+        'line_count': len(parsed_lines),
+        'staged_count': len(staged_lines),  # ドラフトに登録した明細（差分再取込では追加・変更行のみ）
+        'total_amount': parse_result['total_amount'],
+        'value_stats': parse_result.get('value_stats', {}),
+        'layouts': parse_result.get('layouts', {}),  # 確定時にヘッダーテンプレートとして学習
+    }
+    if diff is not None:
+        # コミット時に apply_estimate_line_diff が使う
+        meta['diff'] = {
+            'base_import_id': base_import.id,
+            'inserted': len(diff['inserted']),
+            'updated': len(diff['updated']),
+            'deleted': len(diff['deleted']),
+            'unchanged': diff['unchanged'],
+            'updates': [[base.id, *estimate_line_key(line)] for base, line in diff['updated']],
+            'deleted_ids': [row.id for row in diff['deleted']],
+        }
+    estimate_import = EstimateImportModel(
+        project_id=project_id,
+        original_filename=original_filename,
+        storage_path=str(file_path),
+        file_hash=file_hash,
+        meta_json=json.dumps(meta),
+        status='draft'
+    )
+    db.add(estimate_import)
+    db.flush()  # IDを取得するため
+
+    # EstimateLineレコード一括作成（行の辞書に列を足してそのまま渡す）
+    for line in staged_lines:
+        line['import_id'] = estimate_import.id
+        line['kind'] = 'estimate'  # デフォルトは見積
+        line['sort_order'] = 0
+    insert_stats = bulk_insert(db, EstimateLineModel, staged_lines)
+    mark_header_templates_used(db, meta['layouts'])
+    trace.finish(insert_span, rows=len(staged_lines), batches=insert_stats['batches'])
+
+    # 段階ごとの所要時間をインポートに記録（コミットは記録後のため含まない）
+    meta['timings'] = trace.summary()
+    estimate_import.meta_json = json.dumps(meta)
+
+    commit_span = trace.start('commit')
+    db.commit()
+    trace.finish(commit_span, rows=len(staged_lines))
+    trace.log_summary(original_filename)
+
+    # 明細は先頭ページのみ返す（続きは GET /api/imports/{import_id}/lines、全件は lines.ndjson）
+    first_page = page_import_lines(db, estimate_import.id)
+    preview = {
+        'lines': first_page['lines'],
+        'next_cursor': first_page['next_cursor'],
+        'total_amount': parse_result['total_amount'],
+        'line_count': len(parsed_lines),
+        'staged_count': len(staged_lines),  # ページ取得できる明細の件数
+        'sheets_processed': parse_result['sheets_processed'],
+        'sheets_skipped': parse_result['sheets_skipped'],
+        'sheet_triage': parse_result.get('triage', []),
+        'missing_columns': parse_result['missing_columns'],
+        'detected_headers': parse_result.get('detected_headers', {}),
+        'value_stats': parse_result.get('value_stats', {}),
+        'parse_cache': 'hit' if cache_hit else 'miss',
+    }
+    if 'diagnostics' in parse_result:
+        preview['diagnostics'] = parse_result['diagnostics']
+    if diff is not None:
+        # 前回確定分との差分（件数と行の内容）
+        preview['diff'] = {
+            'base_import_id': base_import.id,
+            'inserted': len(diff['inserted']),
+            'updated': len(diff['updated']),
+            'deleted': len(diff['deleted']),
+            'unchanged': diff['unchanged'],
+            'inserted_lines': diff['inserted'],
+            'updated_lines': [
+                {
+                    'id': base.id,
+                    'before': {k: v for k, v in base._mapping.items() if k != 'id'},
+                    'after': line,
+                }
+                for base, line in diff['updated']
+            ],
+            'deleted_lines': [
+                {'id': row.id, 'sheet_name': row.sheet_name, 'row_no': row.row_no, 'name': row.name, 'amount': row.amount}
+                for row in diff['deleted']
+            ],
+        }
+
+    return {
+        'status': 'success',
+        'import_id': estimate_import.id,
+        'filename': original_filename,
+        'preview': preview,
+    }
 
 
 @app.post("/api/projects/{project_id}/imports/estimate")
 async def import_estimate(
     project_id: str,
     file: UploadFile = File(...),
+    incremental: bool = False,
+    full_parse: bool = False,
+    diagnostics: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     """
     見積/予算/原価Excelをアップロードしてプレビュー生成
     ドラフト状態のインポートレコードを作成し、import_idを返す
+    incremental=true: 改訂版の再取込。前回確定分との差分だけを登録し、preview.diff に差分を返す
+    full_parse=true: シート選別で除外されたシート（表紙・非表示シート等と判定）も解析する
+    diagnostics=full: 取込できた場合も preview.diagnostics にシートごとのヘッダー候補診断を返す
     """
     # プロジェクト存在確認
     project = db.query(ProjectModel).filter_by(id=project_id).first()
     if not project:
         raise HTTPException(status_code=404, detail="プロジェクトが見つかりません")
 
+    file_path = None
     try:
-        # ファイル内容を読み取り
-        content = await file.read()
-        file_hash = hashlib.sha256(content).hexdigest()
-
-        # ファイル保存
-        filename = f"{uuid.uuid4()}_{file.filename}"
-        file_path = UPLOAD_DIR / filename
-        with open(file_path, "wb") as f:
-            f.write(content)
-
-        # Excel解析（新形式: dictを返す）
-        parse_result = parse_excel_to_lines(file_path)
-        parsed_lines = parse_result['lines']
-
-        # 0件の場合は詳細な原因を返す
-        if not parsed_lines:
-            error_reasons = []
-            if parse_result['parse_errors']:
-                error_reasons.extend(parse_result['parse_errors'])
-            if parse_result['sheets_skipped']:
-                for skip in parse_result['sheets_skipped']:
-                    reason_msg = f"シート「{skip['name']}」: {skip['reason']}"
-                    # 候補行があれば追記
-                    if skip.get('candidates'):
-                        top_cands = skip['candidates'][:2]
-                        cand_str = ', '.join([f"行{c['row']}({','.join(c['columns'][:3])})" for c in top_cands])
-                        reason_msg += f" [候補: {cand_str}]"
-                    error_reasons.append(reason_msg)
-            if not error_reasons:
-                error_reasons.append('ヘッダー行（名称/数量/単価/金額が2つ以上揃う行）を検出できませんでした')
-
-            # 理由コードを日本語に変換
-            reason_labels = {
-                'parse_error': 'Excelファイルの読み込みエラー',
-                'empty_workbook': '空のワークブック',
-                'header_not_found': 'ヘッダー行が見つかりません',
-                'required_columns_missing': '必須カラム（名称/金額）がありません',
-                'no_data_rows': 'データ行がありません',
-            }
-            reason_code = parse_result.get('reason', 'unknown')
-
-            return {
-                'status': 'warning',
-                'import_id': None,
-                'filename': file.filename,
-                'preview': {
-                    'lines': [],
-                    'total_amount': 0,
-                    'line_count': 0,
-                    'sheets_processed': [],
-                    'sheets_skipped': parse_result['sheets_skipped'],
-                    'missing_columns': parse_result['missing_columns'],
-                    'error_reasons': error_reasons,
-                    'reason': reason_code,
-                    'reason_label': reason_labels.get(reason_code, reason_code),
-                }
-            }
+        # ファイル保存（内容アドレスで重複排除、書き込みながらハッシュ計算）
+        file_path, file_hash, _ = await store_upload_file(file)
 
-        # EstimateImportレコード作成（draft状態）
-        estimate_import = EstimateImportModel(
-            project_id=project_id,
-            original_filename=file.filename,
-            storage_path=str(file_path),
-            file_hash=file_hash,
-            meta_json=json.dumps({
-                'sheets_processed': parse_result['sheets_processed'],
-                'sheets_skipped': parse_result['sheets_skipped'],
-                'detected_headers': {k: v for k, v in parse_result['detected_headers'].items()},
-                'line_count': len(parsed_lines)
-            }),
-            status='draft'
+        # 解析・明細登録はイベントループを塞がないようスレッドで実行
+        return await run_in_threadpool(
+            run_estimate_import, db, project_id, file.filename, file_path, file_hash,
+            incremental=incremental, full_parse=full_parse, diagnostics=diagnostics == 'full',
         )
-        db.add(estimate_import)
-        db.flush()  # IDを取得するため
-
-        # EstimateLineレコード作成
-        for line in parsed_lines:
-            category = classify_cost_category(line['name'])
-            estimate_line = EstimateLineModel(
-                import_id=estimate_import.id,
-                sheet_name=line['sheet_name'],
-                row_no=line['row_no'],
-                kind='estimate',  # デフォルトは見積
-                name=line['name'],
-                breakdown=line['breakdown'],
-                qty=line['qty'],
-                unit=line['unit'],
-                unit_price=line['unit_price'],
-                amount=line['amount'],
-                note=line['note'],
-                category=category
-            )
-            db.add(estimate_line)
 
-        db.commit()
+    except HTTPException:
+        raise
+    except Exception as e:
+        db.rollback()
+        logger.exception("Import error: %s", file.filename)
+        raise HTTPException(status_code=500, detail=f"インポートエラー: {str(e)}")
+    finally:
+        # インポートが作られなかった（0件・エラー）場合は参照が無いので削除される
+        if file_path is not None:
+            release_blob(db, file_path)
 
-        # プレビューデータ作成
-        preview_lines = []
-        for line in parsed_lines:
-            preview_lines.append({
-                'sheet_name': line['sheet_name'],
-                'row_no': line['row_no'],
-                'name': line['name'],
-                'breakdown': line['breakdown'],
-                'qty': line['qty'],
-                'unit': line['unit'],
-                'unit_price': line['unit_price'],
-                'amount': line['amount'],
-                'note': line['note'],
-                'category': classify_cost_category(line['name'])
-            })
 
-        return {
-            'status': 'success',
-            'import_id': estimate_import.id,
-            'filename': file.filename,
-            'preview': {
-                'lines': preview_lines,
-                'total_amount': sum(l['amount'] or 0 for l in parsed_lines),
-                'line_count': len(parsed_lines),
-                'sheets_processed': parse_result['sheets_processed'],
-                'sheets_skipped': parse_result['sheets_skipped'],
-                'missing_columns': parse_result['missing_columns'],
-                'detected_headers': parse_result.get('detected_headers', {}),
-                'value_stats': parse_result.get('value_stats', {}),
-            }
-        }
+# =====================================
+# バックグラウンド取込ジョブ
+# =====================================
+
+# 実行待ち・実行中のジョブの状態（cancelling は実行中にキャンセル要求を受けたもの）
+IMPORT_JOB_ACTIVE_STATUSES = ['queued', 'running', 'cancelling']
+
+# 取込ジョブを実行するスレッド数（解析の並列度は EXCEL_PARSE_WORKERS）
+IMPORT_JOB_WORKERS = max(1, int(os.getenv("IMPORT_JOB_WORKERS", "2")))
+
+_import_job_pool = ThreadPoolExecutor(max_workers=IMPORT_JOB_WORKERS, thread_name_prefix="import-job")
+
+# 未完了ジョブのキャンセル要求 {job_id: threading.Event}（POST /api/import-jobs/{job_id}/cancel で set）
+# キャンセル要求が別のワーカープロセスに届いた場合に備え、DB の status='cancelling' も確認する
+_import_job_cancel_events = {}
+# 実行中ジョブが DB のキャンセル要求を確認する間隔（秒）
+IMPORT_JOB_CANCEL_POLL_SECONDS = 1.0
+
+
+class ImportJobCancelSignal:
+    """
+    取込ジョブのキャンセル要求（ParseBudget の cancel_event として渡す）
+    このプロセスの Event に加え、IMPORT_JOB_CANCEL_POLL_SECONDS ごとにジョブの status を DB で確認する
+    """
+
+    def __init__(self, job_id: str, event: Optional[threading.Event] = None):
+        self.job_id = job_id
+        self.event = event or threading.Event()
+        self._polled_at = 0.0
+
+    def is_set(self) -> bool:
+        if self.event.is_set():
+            return True
+        now = time.monotonic()
+        if now - self._polled_at < IMPORT_JOB_CANCEL_POLL_SECONDS:
+            return False
+        self._polled_at = now
+        # ジョブのセッション（進捗を書き込み中）とは別のセッションで読む
+        db = SessionLocal()
+        try:
+            status = db.query(ImportJobModel.status).filter(ImportJobModel.id == self.job_id).scalar()
+        finally:
+            db.close()
+        if status == 'cancelling':
+            self.event.set()
+        return self.event.is_set()
+
+
+def import_job_owner() -> str:
+    """ジョブを実行するプロセスの識別子（ホスト名:PID）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def is_import_job_owner_gone(owner: Optional[str]) -> bool:
+    """
+    ジョブを実行していたプロセスが終了しているか
+    別ホストのプロセスは確認できないため終了していない扱い（owner の無い旧ジョブは終了扱い）
+    """
+    if not owner:
+        return True
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        return True  # 起動したばかりのこのプロセスのジョブは無い（再起動で PID が再利用された）
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
 
+@app.on_event("startup")
+def init_import_jobs():
+    """
+    ジョブ・ヘッダーテンプレートのテーブルを作成し、実行プロセスが終了した未完了ジョブを失敗扱いにする
+    （ジョブはプロセス内のスレッドで実行するため、再起動をまたいで継続できない）
+    各ワーカープロセスが起動時に実行するため、稼働中の他のワーカーのジョブは対象にしない
+    """
+    ImportJobModel.__table__.create(bind=engine, checkfirst=True)
+    HeaderTemplateModel.__table__.create(bind=engine, checkfirst=True)
+    # owner 列の無い既存テーブルには列を追加する
+    from sqlalchemy import inspect, text
+    columns = {c['name'] for c in inspect(engine).get_columns(ImportJobModel.__tablename__)}
+    if 'owner' not in columns:
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {ImportJobModel.__tablename__} ADD COLUMN owner VARCHAR(255)"))
+
+    db = SessionLocal()
+    try:
+        jobs = db.query(ImportJobModel.id, ImportJobModel.owner).filter(
+            ImportJobModel.status.in_(IMPORT_JOB_ACTIVE_STATUSES)
+        ).all()
+        gone_ids = [job_id for job_id, owner in jobs if is_import_job_owner_gone(owner)]
+        if gone_ids:
+            db.query(ImportJobModel).filter(
+                ImportJobModel.id.in_(gone_ids),
+                ImportJobModel.status.in_(IMPORT_JOB_ACTIVE_STATUSES),
+            ).update({
+                'status': 'failed',
+                'error': 'サーバー再起動により中断されました',
+                'finished_at': datetime.utcnow(),
+            }, synchronize_session=False)
+            db.commit()
+    finally:
+        db.close()
+
+
+def run_import_job(job_id: str, full_parse: bool = False):
+    """
+    取込ジョブを実行（ワーカースレッドで呼ばれる）
+    シートごとの進捗を progress_json に記録し、完了時にプレビューを result_json に保存
+    full_parse: シート選別を行わず全シートを解析する（create_import_job の指定）
+    """
+    db = SessionLocal()
+    try:
+        # 待機中のときだけ開始する（別プロセスのキャンセル要求と競合しないよう条件付きで更新）
+        started = db.query(ImportJobModel).filter(
+            ImportJobModel.id == job_id, ImportJobModel.status == 'queued'
+        ).update({'status': 'running', 'started_at': datetime.utcnow()}, synchronize_session=False)
+        db.commit()
+        if not started:
+            return  # 開始前にキャンセルされた
+        job = db.query(ImportJobModel).filter_by(id=job_id).first()
+
+        progress = {'sheets_done': 0, 'sheets_total': None, 'sheets': []}
+
+        def on_sheet_parsed(sheet_name: str, done: int, total: int, line_count: int):
+            progress['sheets_done'] = done
+            progress['sheets_total'] = total
+            progress['sheets'].append({'name': sheet_name, 'line_count': line_count})
+            job.progress_json = json.dumps(progress, ensure_ascii=False)
+            db.commit()
+
+        cancel_event = ImportJobCancelSignal(job_id, _import_job_cancel_events.get(job_id))
+        result = run_estimate_import(
+            db, job.project_id, job.original_filename, Path(job.storage_path), job.file_hash,
+            progress_callback=on_sheet_parsed,
+            budget=ParseBudget(cancel_event=cancel_event), full_parse=full_parse,
+        )
+
+        job.status = 'cancelled' if result['preview'].get('reason') == 'cancelled' else 'succeeded'
+        job.import_id = result.get('import_id')
+        job.result_json = json.dumps(result, ensure_ascii=False)
+        job.finished_at = datetime.utcnow()
+        db.commit()
+
+    except ImportCancelled:
+        db.rollback()
+        job = db.query(ImportJobModel).filter_by(id=job_id).first()
+        if job:
+            job.status = 'cancelled'
+            job.finished_at = datetime.utcnow()
+            db.commit()
     except Exception as e:
         db.rollback()
-        import traceback
-        print(f"Import error: {traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=f"インポートエラー: {str(e)}")
+        logger.exception("Import job error: %s", job_id)
+        job = db.query(ImportJobModel).filter_by(id=job_id).first()
+        if job:
+            job.status = 'failed'
+            job.error = f"インポートエラー: {str(e)}"
+            job.finished_at = datetime.utcnow()
+            db.commit()
+    finally:
+        _import_job_cancel_events.pop(job_id, None)
+        # ジョブ完了でジョブからの参照は外れる（インポートが作られていれば残る）
+        job = db.query(ImportJobModel).filter_by(id=job_id).first()
+        if job:
+            release_blob(db, job.storage_path)
+        db.close()
+
+
+@app.post("/api/projects/{project_id}/import-jobs", status_code=202)
+async def create_import_job(
+    project_id: str,
+    file: UploadFile = File(...),
+    full_parse: bool = False,
+    db: Session = Depends(get_db)
+):
+    """
+    見積/予算/原価Excelをアップロードし、取込ジョブを登録
+    解析・明細登録はバックグラウンドで行い、job_id をすぐに返す
+    進捗と結果は GET /api/import-jobs/{job_id} で取得
+    full_parse=true: シート選別で除外されたシートも解析する
+    """
+    project = db.query(ProjectModel).filter_by(id=project_id).first()
+    if not project:
+        raise HTTPException(status_code=404, detail="プロジェクトが見つかりません")
+
+    file_path, file_hash, _ = await store_upload_file(file)
+
+    job = ImportJobModel(
+        project_id=project_id,
+        original_filename=file.filename,
+        storage_path=str(file_path),
+        file_hash=file_hash,
+        status='queued',
+        owner=import_job_owner(),  # ジョブはこのプロセスのスレッドで実行する
+    )
+    try:
+        db.add(job)
+        db.commit()
+    finally:
+        # 以降はジョブレコードがファイルを参照する
+        release_blob(db, file_path)
+
+    _import_job_cancel_events[job.id] = threading.Event()
+    _import_job_pool.submit(run_import_job, job.id, full_parse)
+
+    return {
+        'status': 'accepted',
+        'job_id': job.id,
+        'filename': file.filename,
+    }
+
+
+@app.get("/api/import-jobs/{job_id}")
+async def get_import_job(job_id: str, db: Session = Depends(get_db)):
+    """
+    取込ジョブの状態・シートごとの進捗・完了時のプレビューを取得
+    """
+    job = db.query(ImportJobModel).filter_by(id=job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+
+    return {
+        'status': 'success',
+        'job': {
+            'id': job.id,
+            'project_id': job.project_id,
+            'state': job.status,
+            'filename': job.original_filename,
+            'import_id': job.import_id,
+            'progress': json.loads(job.progress_json) if job.progress_json else None,
+            'result': json.loads(job.result_json) if job.result_json else None,
+            'error': job.error,
+            'created_at': job.created_at.isoformat() if job.created_at else None,
+            'started_at': job.started_at.isoformat() if job.started_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        }
+    }
+
+
+@app.post("/api/import-jobs/{job_id}/cancel")
+async def cancel_import_job(job_id: str, db: Session = Depends(get_db)):
+    """
+    取込ジョブをキャンセル
+    待機中のジョブはすぐに cancelled、実行中のジョブは status=cancelling にし、解析中の確認点で
+    打ち切られ cancelled になる（解析が終わりドラフト登録に進んでいた場合は完了する）
+    ジョブを実行しているワーカープロセスが別でも、DB の status で要求が伝わる
+    """
+    job = db.query(ImportJobModel).filter_by(id=job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    if job.status not in IMPORT_JOB_ACTIVE_STATUSES:
+        raise HTTPException(status_code=400, detail="ジョブは既に終了しています")
+
+    # 状態は条件付きで更新する（ジョブの開始・完了と同時でも上書きしない）
+    cancelled = db.query(ImportJobModel).filter(
+        ImportJobModel.id == job_id, ImportJobModel.status == 'queued'
+    ).update({'status': 'cancelled', 'finished_at': datetime.utcnow()}, synchronize_session=False)
+    if not cancelled:
+        db.query(ImportJobModel).filter(
+            ImportJobModel.id == job_id, ImportJobModel.status == 'running'
+        ).update({'status': 'cancelling'}, synchronize_session=False)
+    db.commit()
+    event = _import_job_cancel_events.get(job_id)
+    if event is not None:
+        event.set()
+    db.refresh(job)
+
+    return {
+        'status': 'success',
+        'job_id': job_id,
+        'state': job.status,
+        'cancel_requested': True,
+    }
 
 
 class CommitRequest(BaseModel):
@@ -1282,6 +3850,7 @@ async def commit_import(
     """
     ドラフト状態のインポートを確定
     kind=actualの場合はcost_recordsへ同期
+    差分再取込のドラフトは比較元インポートへ反映する（status=merged、同期は追加行のみ）
     """
     # インポートレコード取得
     estimate_import = db.query(EstimateImportModel).filter_by(id=import_id).first()
@@ -1296,44 +3865,196 @@ async def commit_import(
         kind = request.kind if request else 'estimate'
         month = request.month if request else None
 
-        lines = db.query(EstimateLineModel).filter_by(import_id=import_id).all()
+        trace = ImportTrace()
+        update_span = trace.start('db_insert')
+        meta = json.loads(estimate_import.meta_json or '{}')
+        if 'diff' in meta:
+            # 差分再取込: 追加・変更・削除を比較元インポートへ反映
+            applied = apply_estimate_line_diff(db, estimate_import, kind, month)
+            line_count = applied['inserted'] + applied['updated']
+            # 同期対象は追加行のみ（id は IN 句の上限内に分けて引く）
+            line_queries = [
+                db.query(EstimateLineModel).filter(EstimateLineModel.id.in_(batch))
+                for batch in iter_batches(applied['inserted_ids'])
+            ]
+            new_status = 'merged'
+        else:
+            applied = None
+            lines_query = db.query(EstimateLineModel).filter_by(import_id=import_id)
+            line_queries = [lines_query]
 
-        for line in lines:
-            line.kind = kind
+            # 明細のkind/monthを一括更新
+            values = {EstimateLineModel.kind: kind}
             if month:
-                line.month = month
+                values[EstimateLineModel.month] = month
+            line_count = lines_query.update(values, synchronize_session=False)
+            new_status = 'committed'
 
-        # kind=actualの場合はcost_recordsへ同期
+        # kind=actualの場合はcost_recordsへ一括同期
         if kind == 'actual':
-            for line in lines:
-                cost_record = CostRecordModel(
-                    project_id=estimate_import.project_id,
-                    category=line.category or 'expense',
-                    item_name=line.name,
-                    quantity=line.qty,
-                    unit=line.unit,
-                    unit_price=line.unit_price,
-                    amount=line.amount
-                )
-                db.add(cost_record)
+            lines = [
+                line for query in line_queries for line in query.with_entities(
+                    EstimateLineModel.category,
+                    EstimateLineModel.name,
+                    EstimateLineModel.qty,
+                    EstimateLineModel.unit,
+                    EstimateLineModel.unit_price,
+                    EstimateLineModel.amount,
+                ).all()
+            ]
+            bulk_insert(db, CostRecordModel, [
+                {
+                    'project_id': estimate_import.project_id,
+                    'category': line.category or 'expense',
+                    'item_name': line.name,
+                    'quantity': line.qty,
+                    'unit': line.unit,
+                    'unit_price': line.unit_price,
+                    'amount': line.amount,
+                }
+                for line in lines
+            ])
+
+        trace.finish(update_span, rows=line_count)
+
+        # 確定したレイアウトを発注者のヘッダーテンプレートとして学習
+        project = db.query(ProjectModel).filter_by(id=estimate_import.project_id).first()
+        if project:
+            learn_header_templates(db, estimate_import, project.client_name)
 
         # ステータス更新
-        estimate_import.status = 'committed'
+        commit_span = trace.start('commit')
+        estimate_import.status = new_status
         db.commit()
+        trace.finish(commit_span, rows=line_count)
+        trace.log_summary(f"commit {import_id}")
 
-        return {
+        response = {
             'status': 'success',
             'message': '保存しました',
             'import_id': import_id,
             'kind': kind,
-            'line_count': len(lines)
+            'line_count': line_count
         }
+        if applied is not None:
+            response['diff'] = {k: v for k, v in applied.items() if k != 'inserted_ids'}
+        return response
 
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"コミットエラー: {str(e)}")
 
 
+# インポート明細のプレビュー（カーソルページング・NDJSON）
+# アップロード応答には集計と先頭ページだけを返し、残りは保存済みのドラフト明細から読む
+# 並びは確定後の明細一覧と同じ (sort_order, row_no)、同順位は id で決める
+
+# 1ページの行数（アップロード応答の先頭ページも同じ）
+PREVIEW_PAGE_SIZE = max(1, int(os.getenv("PREVIEW_PAGE_SIZE", "50")))
+PREVIEW_PAGE_MAX = 1000
+
+# プレビューで返す列
+PREVIEW_LINE_FIELDS = [
+    'id', 'sheet_name', 'row_no', 'name', 'breakdown', 'qty', 'unit', 'unit_price', 'amount', 'note', 'category',
+]
+
+
+def encode_line_cursor(row) -> str:
+    """行の並びキーをカーソル文字列にする"""
+    return json.dumps([row.sort_order or 0, row.row_no or 0, row.id], separators=(',', ':'))
+
+
+def page_import_lines(db: Session, import_id: str, cursor: Optional[str] = None, limit: Optional[int] = None) -> dict:
+    """
+    インポートの明細をカーソル位置から limit 件（キーセット方式、OFFSET を使わない）
+    戻り値: {'lines': [...], 'next_cursor': 次ページのカーソル（最終ページは None）}
+    """
+    limit = max(1, min(limit or PREVIEW_PAGE_SIZE, PREVIEW_PAGE_MAX))
+    sort_order = func.coalesce(EstimateLineModel.sort_order, 0)
+    row_no = func.coalesce(EstimateLineModel.row_no, 0)
+
+    query = db.query(
+        EstimateLineModel.sort_order,
+        *[getattr(EstimateLineModel, field) for field in PREVIEW_LINE_FIELDS],
+    ).filter(EstimateLineModel.import_id == import_id)
+    if cursor:
+        try:
+            after_sort, after_row, after_id = json.loads(cursor)
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="カーソルが不正です")
+        query = query.filter(
+            (sort_order > after_sort)
+            | ((sort_order == after_sort) & (row_no > after_row))
+            | ((sort_order == after_sort) & (row_no == after_row) & (EstimateLineModel.id > after_id))
+        )
+    rows = query.order_by(sort_order, row_no, EstimateLineModel.id).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        'lines': [{field: getattr(row, field) for field in PREVIEW_LINE_FIELDS} for row in rows],
+        'next_cursor': encode_line_cursor(rows[-1]) if has_more else None,
+    }
+
+
+@app.get("/api/imports/{import_id}/lines")
+async def get_import_lines(
+    import_id: str,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=PREVIEW_PAGE_MAX),
+    db: Session = Depends(get_db)
+):
+    """
+    インポート明細のページ取得（プレビュー表の追加読込用）
+    cursor: 前ページの next_cursor（省略時は先頭から）
+    limit: 1ページの行数（省略時は PREVIEW_PAGE_SIZE、最大 PREVIEW_PAGE_MAX）
+    line_count はページ取得できる明細の件数（差分再取込のドラフトでは追加・変更行のみ）
+    """
+    estimate_import = db.query(EstimateImportModel).filter_by(id=import_id).first()
+    if not estimate_import:
+        raise HTTPException(status_code=404, detail="インポートが見つかりません")
+
+    page = page_import_lines(db, import_id, cursor, limit)
+    meta = json.loads(estimate_import.meta_json or '{}')
+    return {
+        'status': 'success',
+        'import_id': import_id,
+        'line_count': meta.get('staged_count', meta.get('line_count')),
+        **page,
+    }
+
+
+@app.get("/api/imports/{import_id}/lines.ndjson")
+async def stream_import_lines(import_id: str, db: Session = Depends(get_db)):
+    """
+    インポート明細の全件を NDJSON（1行1明細）で逐次返す
+    ページ単位で読みながら送るため、件数が多くてもメモリに全件を持たない
+    """
+    estimate_import = db.query(EstimateImportModel).filter_by(id=import_id).first()
+    if not estimate_import:
+        raise HTTPException(status_code=404, detail="インポートが見つかりません")
+
+    def generate():
+        # レスポンス送信中も使うため、リクエストのセッションとは別に開く
+        stream_db = SessionLocal()
+        try:
+            cursor = None
+            while True:
+                page = page_import_lines(stream_db, import_id, cursor, PREVIEW_PAGE_MAX)
+                for line in page['lines']:
+                    yield json.dumps(line, ensure_ascii=False) + '\n'
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+        finally:
+            stream_db.close()
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+
 @app.get("/api/projects/{project_id}/estimate-lines")
 async def get_estimate_lines(
     project_id: str,
@@ -1434,15 +4155,25 @@ async def reorder_estimate_lines(
         raise HTTPException(status_code=400, detail="line_idsとsort_ordersの長さが一致しません")
 
     try:
-        updated_count = 0
+        # プロジェクトの所有確認（対象明細をまとめて1クエリで）
+        owned_ids = {
+            line_id for (line_id,) in db.query(EstimateLineModel.id).join(
+                EstimateImportModel, EstimateLineModel.import_id == EstimateImportModel.id
+            ).filter(
+                EstimateLineModel.id.in_(request.line_ids),
+                EstimateImportModel.project_id == project_id
+            )
+        }
+
+        # 同じidが複数回あれば最後の値を採用（従来と同じ）
+        sort_orders = {}
         for line_id, sort_order in zip(request.line_ids, request.sort_orders):
-            line = db.query(EstimateLineModel).filter_by(id=line_id).first()
-            if line:
-                # プロジェクトの所有確認
-                imp = db.query(EstimateImportModel).filter_by(id=line.import_id).first()
-                if imp and imp.project_id == project_id:
-                    line.sort_order = sort_order
-                    updated_count += 1
+            if line_id in owned_ids:
+                sort_orders[line_id] = sort_order
+        bulk_update_by_id(db, EstimateLineModel, [
+            {'id': line_id, 'sort_order': sort_order} for line_id, sort_order in sort_orders.items()
+        ])
+        updated_count = sum(1 for line_id in request.line_ids if line_id in owned_ids)
 
         db.commit()
 
@@ -1496,12 +4227,8 @@ async def upload_attachment(
     """
     添付ファイルをアップロード
     """
-    # ファイル保存
-    filename = f"{uuid.uuid4()}_{file.filename}"
-    file_path = UPLOAD_DIR / filename
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
+    # ファイル保存（内容アドレスで重複排除）
+    file_path, _, _ = await store_upload_file(file)
 
     # DBレコード作成
     attachment = AttachmentModel(
@@ -1511,8 +4238,11 @@ async def upload_attachment(
         filename=file.filename,
         storage_path=str(file_path)
     )
-    db.add(attachment)
-    db.commit()
+    try:
+        db.add(attachment)
+        db.commit()
+    finally:
+        release_blob(db, file_path)
 
     return {
         'status': 'success',
@@ -249,7 +249,7 @@ class EstimateImport(Base):
     storage_path = Column(String(500), nullable=False)
     file_hash = Column(String(64))  # SHA256
     meta_json = Column(Text)  # シート名、行数等のメタ情報
-    status = Column(String(50), default="draft")  # draft, committed
+    status = Column(String(50), default="draft")  # draft, committed, merged（差分再取込を比較元へ反映済み）
 
     # リレーション
     project = relationship("Project", back_populates="estimate_imports")
@@ -300,3 +300,38 @@ class Attachment(Base):
     # リレーション
     project = relationship("Project", back_populates="attachments")
     estimate_import = relationship("EstimateImport", back_populates="attachments")
+
+
+class ImportJob(Base):
+    """Excel取込ジョブ（バックグラウンド解析の状態管理）"""
+    __tablename__ = "import_jobs"
+
+    id = Column(String(36), primary_key=True, default=generate_uuid)
+    project_id = Column(String(36), ForeignKey("projects.id"), nullable=False)
+    import_id = Column(String(36), ForeignKey("estimate_imports.id"), nullable=True)  # 完了時のインポート
+    status = Column(String(20), default="queued")  # queued, running, cancelling, succeeded, failed, cancelled
+    original_filename = Column(String(255), nullable=False)
+    storage_path = Column(String(500), nullable=False)
+    file_hash = Column(String(64))  # SHA256
+    owner = Column(String(255))  # ジョブを実行するプロセス（ホスト名:PID）
+    progress_json = Column(Text)  # シートごとの進捗
+    result_json = Column(Text)  # 完了時のプレビュー（import_estimate と同じ形式）
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+class HeaderTemplate(Base):
+    """確定済みインポートから学習したシートのヘッダーレイアウト"""
+    __tablename__ = "header_templates"
+
+    id = Column(String(36), primary_key=True, default=generate_uuid)
+    fingerprint = Column(String(64), unique=True, nullable=False, index=True)  # ヘッダー行シグネチャのSHA256
+    client_name = Column(String(255))  # 学習元プロジェクトの発注者
+    sheet_name = Column(String(255))  # 学習元シート名
+    headers_json = Column(Text, nullable=False)  # [{signatures, rows, map, key_count, is_two_row}]
+    hit_count = Column(Integer, default=0)  # 解析で使われた回数
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    last_used_at = Column(DateTime)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+ヘッダー同義語マッチャーのベンチマーク
+uploads/ のサンプルブックのヘッダー探索範囲（先頭101行×30列）を対象に、
+従来方式（同義語をセルごとに再正規化）とコンパイル済みマッチャーを比較する
+
+Usage:
+    cd backend
+    python scripts/bench_header_matcher.py                 # uploads/ の全ブック
+    python scripts/bench_header_matcher.py --repeat 5 path/to/book.xlsx
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import openpyxl
+
+from main import (
+    HEADER_MATCHER,
+    HEADER_SYNONYMS,
+    SheetGrid,
+    try_map_header_row,
+    _normalize_header_str,
+)
+
+UPLOADS_DIR = Path(__file__).parent.parent / "uploads"
+
+# ヘッダー探索範囲（parse_sheet と同じ）
+MAX_HEADER_ROWS = 101
+MAX_COLS = 30
+
+
+# =====================================
+# 従来方式（比較用の参照実装）
+# =====================================
+
+def legacy_normalize_header_text(text) -> str:
+    """最適化前の normalize_header_text"""
+    if text is None:
+        return ''
+    s = str(text).strip()
+    if not s:
+        return ''
+    trans_table = str.maketrans(
+        'ＡＢＣＤＥＦＧＨＩＪＫＬＭＮＯＰＱＲＳＴＵＶＷＸＹＺａｂｃｄｅｆｇｈｉｊｋｌｍｎｏｐｑｒｓｔｕｖｗｘｙｚ０１２３４５６７８９',
+        'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+    )
+    s = s.translate(trans_table)
+    for c in '()（）【】[]「」『』〔〕<>＜＞{}｛｝：:・_-－ー／/\\＼、。，,.;；!！?？#＃*＊@＠~～^＾+＋=＝|｜':
+        s = s.replace(c, '')
+    s = re.sub(r'\s+', '', s)
+    for p in ['㎥', '㎡', 'm3', 'm2', 'M3', 'M2', '円', '¥', '￥',
+              '税込', '税抜', '込', '抜', 'kg', 'KG', 't', 'T',
+              '本', '個', '台', '式', '人', '日', '回', '枚', '件',
+              'm', 'M', 'ℓ', 'L', '号', '番']:
+        s = s.replace(p, '')
+    return s.lower()
+
+
+def legacy_find_header_column(header_text: str, field: str) -> bool:
+    """最適化前の find_header_column"""
+    normalized = legacy_normalize_header_text(header_text)
+    if not normalized:
+        return False
+    for synonym in HEADER_SYNONYMS.get(field, []):
+        syn_normalized = legacy_normalize_header_text(synonym)
+        if syn_normalized in normalized or normalized in syn_normalized:
+            return True
+    return False
+
+
+def legacy_try_map_header_row(values: list) -> dict:
+    """最適化前の try_map_header_row"""
+    header_map = {}
+    for col_idx, val in enumerate(values):
+        if not val:
+            continue
+        for field in HEADER_SYNONYMS.keys():
+            if legacy_find_header_column(val, field):
+                if field not in header_map:
+                    header_map[field] = col_idx
+                break
+    return header_map
+
+
+# =====================================
+# ベンチマーク
+# =====================================
+
+def load_header_rows(file_path: Path) -> list:
+    """ブックの全シートからヘッダー探索範囲の行（結合セル解決済み）を取得"""
+    rows = []
+    wb = openpyxl.load_workbook(file_path, data_only=True, read_only=True)
+    try:
+        for sheet in wb.worksheets:
+            max_col = min(sheet.max_column or 20, MAX_COLS)
+            grid = SheetGrid(sheet, max_col)
+            grid.row(MAX_HEADER_ROWS)
+            grid.resolve_merges(sheet)
+            for row_idx in range(1, grid.loaded_rows + 1):
+                rows.append(grid.text_row(row_idx))
+    finally:
+        wb.close()
+    return rows
+
+
+def clear_matcher_caches():
+    """セル単位キャッシュを初期化（キャッシュが温まった状態だけを計測しないため）"""
+    _normalize_header_str.cache_clear()
+    HEADER_MATCHER.match_field.cache_clear()
+
+
+def time_mapping(func, rows: list, repeat: int) -> tuple:
+    """全行のヘッダーマッピングを repeat 回実行し、(最短秒数, 結果) を返す"""
+    best = None
+    maps = None
+    for _ in range(repeat):
+        clear_matcher_caches()
+        start = time.perf_counter()
+        maps = [func(values) for values in rows]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, maps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ヘッダー同義語マッチャーのベンチマーク')
+    parser.add_argument('files', nargs='*', type=Path, help='対象ブック（省略時は uploads/*.xlsx）')
+    parser.add_argument('--repeat', type=int, default=3, help='計測回数（最短値を採用）')
+    args = parser.parse_args()
+
+    files = args.files or sorted(UPLOADS_DIR.glob('*.xlsx'))
+    if not files:
+        print('対象ブックがありません')
+        return 1
+
+    total_legacy = 0.0
+    total_compiled = 0.0
+    print(f"{'ファイル':<50} {'セル数':>7} {'従来(ms)':>10} {'新(ms)':>10} {'倍率':>7}")
+    for file_path in files:
+        rows = load_header_rows(file_path)
+        cell_count = sum(1 for values in rows for v in values if v)
+
+        legacy_sec, legacy_maps = time_mapping(legacy_try_map_header_row, rows, args.repeat)
+        compiled_sec, compiled_maps = time_mapping(try_map_header_row, rows, args.repeat)
+
+        if legacy_maps != compiled_maps:
+            print(f"✗ 結果不一致: {file_path.name}")
+            return 1
+
+        total_legacy += legacy_sec
+        total_compiled += compiled_sec
+        speedup = legacy_sec / compiled_sec if compiled_sec else float('inf')
+        print(f"{file_path.name[-50:]:<50} {cell_count:>7} {legacy_sec * 1000:>10.1f} {compiled_sec * 1000:>10.1f} {speedup:>6.1f}x")
+
+    speedup = total_legacy / total_compiled if total_compiled else float('inf')
+    print(f"\n合計: 従来 {total_legacy * 1000:.1f}ms / 新 {total_compiled * 1000:.1f}ms ({speedup:.1f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Excel取込ベンチマーク
+合成した見積ブック（シート数・行数・結合セル密度・2段ヘッダー・複数セクション・
+全角/単位付き数値を指定可能）で parse_excel_to_lines と parse_sheet を計測し、
+行/秒・ピークメモリ・処理段階ごとの時間を JSON に書き出す
+読込バックエンド（openpyxl 通常/読み取り専用・CSV・xlrd）ごとの行/秒も計測する
+（.xls は xlwt がインストールされている場合のみ生成）
+コミット間の比較は --compare に前回の JSON を渡す
+
+Usage:
+    cd backend
+    python scripts/bench_ingest.py                                  # 既定シナリオ一式
+    python scripts/bench_ingest.py --output bench.json --compare old.json
+    python scripts/bench_ingest.py --scenario custom --sheets 4 --rows 5000 \\
+        --sections 5 --merge-density 0.2 --two-row-header --number-format unit
+    python scripts/bench_ingest.py --profile                         # 関数別の時間（cProfile）も出力
+"""
+
+import argparse
+import cProfile
+import csv
+import json
+import platform
+import pstats
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import openpyxl
+
+from main import (
+    ImportTrace, PARSER_VERSION, READER_CSV, READER_OPENPYXL, READER_OPENPYXL_READ_ONLY, READER_XLRD,
+    parse_excel_to_lines, parse_sheet,
+)
+
+try:
+    import xlwt  # .xls の生成用（ベンチマーク専用、未インストールなら xlrd は計測しない）
+except ImportError:
+    xlwt = None
+
+# 既定シナリオ（名前: 生成パラメータ）
+SCENARIOS = {
+    'small': dict(sheets=1, rows=200, sections=1),
+    'medium': dict(sheets=3, rows=2000, sections=3),
+    'large': dict(sheets=8, rows=5000, sections=8),
+    'merged': dict(sheets=2, rows=2000, sections=3, merge_density=0.3),
+    'two_row_header': dict(sheets=2, rows=2000, sections=3, two_row_header=True),
+    'many_sections': dict(sheets=2, rows=2000, sections=20),
+    'fullwidth': dict(sheets=2, rows=2000, sections=3, number_format='fullwidth'),
+    'unit': dict(sheets=2, rows=2000, sections=3, number_format='unit'),
+}
+
+GENERATOR_DEFAULTS = dict(
+    sheets=1, rows=1000, sections=1, merge_density=0.0,
+    two_row_header=False, number_format='plain', seed=0,
+)
+
+ITEM_NAMES = ['掘削工', '埋戻し工', '型枠工', '鉄筋工', 'コンクリート打設', 'アスファルト舗装',
+              '労務費', '重機回送', '交通誘導員', '仮設材リース', '外注加工', '資材運搬']
+UNITS = ['㎡', '㎥', 'm', '本', '台', '人', '日', '式', 'kg', 't']
+FULLWIDTH = str.maketrans('0123456789.,', '０１２３４５６７８９．，')
+
+
+# =====================================
+# 合成ブック生成
+# =====================================
+
+def format_number(value: float, unit: str, number_format: str, rng: random.Random):
+    """数値セルの値（書式指定に応じて文字列化）"""
+    if number_format == 'fullwidth':
+        return f"{value:,.0f}".translate(FULLWIDTH)
+    if number_format == 'unit':
+        return rng.choice([f"{value:,.0f}{unit}", f"¥{value:,.0f}", f"{value:,.0f}円", f"{value:g}"])
+    return value
+
+
+def write_header(ws, row: int, two_row: bool) -> int:
+    """ヘッダー行を書き込み、データ開始行を返す"""
+    if two_row:
+        # 上段は名称のみ（キー列1つ）、下段に数量・単位・単価・金額
+        for col, text in enumerate(['名称', '規格', None, None, None, None, '備考'], start=1):
+            ws.cell(row=row, column=col, value=text)
+        for col, text in enumerate([None, None, '数量', '単位', '単価', '金額', None], start=1):
+            ws.cell(row=row + 1, column=col, value=text)
+        ws.merge_cells(start_row=row, start_column=1, end_row=row + 1, end_column=1)
+        return row + 2
+    for col, text in enumerate(['名称', '内訳', '数量', '単位', '単価', '金額', '備考'], start=1):
+        ws.cell(row=row, column=col, value=text)
+    return row + 1
+
+
+def generate_workbook(path: Path, sheets: int, rows: int, sections: int, merge_density: float,
+                      two_row_header: bool, number_format: str, seed: int) -> int:
+    """合成見積ブックを作成し、生成したデータ行数を返す"""
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    generated = 0
+
+    for sheet_idx in range(sheets):
+        ws = wb.create_sheet(f"内訳明細書{sheet_idx + 1}")
+        ws.cell(row=1, column=1, value='内訳明細書')
+        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=7)
+
+        row = 3
+        per_section = max(1, rows // max(1, sections))
+        for section_idx in range(sections):
+            ws.cell(row=row, column=1, value=f"{section_idx + 1}. 工種{section_idx + 1}")
+            row = write_header(ws, row + 1, two_row_header)
+            for _ in range(per_section):
+                qty = rng.randint(1, 500)
+                unit = rng.choice(UNITS)
+                unit_price = rng.randint(100, 200000)
+                ws.cell(row=row, column=1, value=rng.choice(ITEM_NAMES))
+                if rng.random() < merge_density:
+                    ws.merge_cells(start_row=row, start_column=1, end_row=row, end_column=2)
+                else:
+                    ws.cell(row=row, column=2, value=f"規格{rng.randint(1, 99)}")
+                ws.cell(row=row, column=3, value=format_number(qty, unit, number_format, rng))
+                ws.cell(row=row, column=4, value=unit)
+                ws.cell(row=row, column=5, value=format_number(unit_price, '', number_format, rng))
+                ws.cell(row=row, column=6, value=format_number(qty * unit_price, '', number_format, rng))
+                row += 1
+                generated += 1
+            # 小計行と空行でセクションを区切る
+            ws.cell(row=row, column=1, value='小計')
+            row += 3
+
+    wb.save(path)
+    wb.close()
+    return generated
+
+
+def convert_to_csv(src: Path, dst: Path):
+    """先頭シートを CSV に書き出す（CSV は1シートのみ）"""
+    wb = openpyxl.load_workbook(src, read_only=True)
+    try:
+        with open(dst, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            for row in wb.worksheets[0].iter_rows(values_only=True):
+                writer.writerow(['' if value is None else value for value in row])
+    finally:
+        wb.close()
+
+
+def convert_to_xls(src: Path, dst: Path):
+    """全シートを結合セルごと .xls に書き出す"""
+    wb = openpyxl.load_workbook(src)
+    book = xlwt.Workbook(encoding='utf-8')
+    for ws in wb.worksheets:
+        ws_out = book.add_sheet(ws.title)
+        merged = set()
+        for rng in ws.merged_cells.ranges:
+            value = ws.cell(row=rng.min_row, column=rng.min_col).value
+            ws_out.write_merge(rng.min_row - 1, rng.max_row - 1, rng.min_col - 1, rng.max_col - 1, value)
+            merged.update((r, c) for r in range(rng.min_row, rng.max_row + 1)
+                          for c in range(rng.min_col, rng.max_col + 1))
+        for row in ws.iter_rows():
+            for cell in row:
+                if cell.value is not None and (cell.row, cell.column) not in merged:
+                    ws_out.write(cell.row - 1, cell.column - 1, cell.value)
+    book.save(str(dst))
+    wb.close()
+
+
+# =====================================
+# 計測
+# =====================================
+
+def measure(func, repeat: int) -> dict:
+    """func を repeat 回実行し、最短時間・ピークメモリ（別実行）・戻り値を返す"""
+    best = None
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # tracemalloc は処理を遅くするため時間計測とは別に1回だけ実行
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak, 'value': value}
+
+
+def profile_functions(func, limit: int) -> list:
+    """cProfile で関数別の累積時間上位を返す"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    func()
+    profiler.disable()
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        if 'main.py' not in filename:
+            continue
+        rows.append({'function': name, 'line': line, 'calls': ncalls,
+                     'tottime_ms': round(tottime * 1000, 2), 'cumtime_ms': round(cumtime * 1000, 2)})
+    rows.sort(key=lambda r: r['cumtime_ms'], reverse=True)
+    return rows[:limit]
+
+
+def run_scenario(name: str, params: dict, workdir: Path, repeat: int, workers: int, profile: bool) -> dict:
+    """1シナリオ分のブックを生成して計測"""
+    path = workdir / f"{name}.xlsx"
+    generated = generate_workbook(path, **params)
+
+    # ブック全体（parse_excel_to_lines）
+    def run_book():
+        trace = ImportTrace()
+        result = parse_excel_to_lines(path, workers=workers, trace=trace)
+        return result, trace
+
+    book = measure(run_book, repeat)
+    result, trace = book['value']
+    line_count = len(result['lines'])
+
+    # シート単位（parse_sheet、ブックは開いた状態で計測）
+    wb = openpyxl.load_workbook(path, data_only=True, read_only=True)
+    try:
+        def run_sheets():
+            return [parse_sheet(wb[sheet_name], sheet_name) for sheet_name in wb.sheetnames]
+        sheets = measure(run_sheets, repeat)
+    finally:
+        wb.close()
+
+    report = {
+        'params': params,
+        'file_bytes': path.stat().st_size,
+        'rows_generated': generated,
+        'lines_extracted': line_count,
+        'parse_excel_to_lines': {
+            'seconds': round(book['seconds'], 4),
+            'rows_per_sec': round(generated / book['seconds'], 1) if book['seconds'] else None,
+            'peak_bytes': book['peak_bytes'],
+            'stages': trace.summary(),
+        },
+        'parse_sheet': {
+            'seconds': round(sheets['seconds'], 4),
+            'rows_per_sec': round(generated / sheets['seconds'], 1) if sheets['seconds'] else None,
+            'peak_bytes': sheets['peak_bytes'],
+        },
+    }
+    report['backends'] = measure_backends(path, workdir / name, repeat)
+    if profile:
+        report['functions'] = profile_functions(run_book, limit=25)
+    return report
+
+
+def measure_backends(path: Path, stem: Path, repeat: int) -> dict:
+    """読込バックエンドごとの parse_excel_to_lines の時間（行/秒は抽出行数あたり）"""
+    targets = [(READER_OPENPYXL, path), (READER_OPENPYXL_READ_ONLY, path)]
+    csv_path = stem.with_suffix('.csv')
+    convert_to_csv(path, csv_path)
+    targets.append((READER_CSV, csv_path))
+    if xlwt is not None:
+        xls_path = stem.with_suffix('.xls')
+        convert_to_xls(path, xls_path)
+        targets.append((READER_XLRD, xls_path))
+
+    backends = {}
+    for reader, target in targets:
+        def run():
+            return parse_excel_to_lines(target, reader=reader)
+        measured = measure(run, repeat)
+        lines = len(measured['value']['lines'])
+        backends[reader] = {
+            'file_bytes': target.stat().st_size,
+            'lines_extracted': lines,
+            'seconds': round(measured['seconds'], 4),
+            'rows_per_sec': round(lines / measured['seconds'], 1) if measured['seconds'] else None,
+            'peak_bytes': measured['peak_bytes'],
+        }
+    return backends
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_comparison(current: dict, previous: dict):
+    """前回結果との rows/sec・ピークメモリの比較を表示"""
+    print(f"\n比較: {previous.get('git_revision')} → {current.get('git_revision')}")
+    print(f"{'シナリオ':<16} {'行/秒(前)':>12} {'行/秒(今)':>12} {'変化':>8} {'メモリ変化':>10}")
+    for name, cur in current['scenarios'].items():
+        prev = previous.get('scenarios', {}).get(name)
+        if not prev:
+            continue
+        p, c = prev['parse_excel_to_lines'], cur['parse_excel_to_lines']
+        speed = c['rows_per_sec'] / p['rows_per_sec'] if p['rows_per_sec'] else float('inf')
+        mem = c['peak_bytes'] / p['peak_bytes'] if p['peak_bytes'] else float('inf')
+        print(f"{name:<16} {p['rows_per_sec']:>12,.0f} {c['rows_per_sec']:>12,.0f} {speed:>7.2f}x {mem:>9.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Excel取込ベンチマーク')
+    parser.add_argument('--scenario', action='append',
+                        help=f"実行するシナリオ（複数指定可、custom で下記パラメータを使用）: {', '.join(SCENARIOS)}")
+    parser.add_argument('--sheets', type=int, default=GENERATOR_DEFAULTS['sheets'])
+    parser.add_argument('--rows', type=int, default=GENERATOR_DEFAULTS['rows'], help='1シートのデータ行数')
+    parser.add_argument('--sections', type=int, default=GENERATOR_DEFAULTS['sections'], help='1シートのヘッダーセクション数')
+    parser.add_argument('--merge-density', type=float, default=GENERATOR_DEFAULTS['merge_density'],
+                        help='名称セルを結合する行の割合（0〜1）')
+    parser.add_argument('--two-row-header', action='store_true', help='2段ヘッダーにする')
+    parser.add_argument('--number-format', choices=['plain', 'fullwidth', 'unit'],
+                        default=GENERATOR_DEFAULTS['number_format'], help='数値セルの書式')
+    parser.add_argument('--seed', type=int, default=GENERATOR_DEFAULTS['seed'])
+    parser.add_argument('--repeat', type=int, default=3, help='計測回数（最短値を採用）')
+    parser.add_argument('--workers', type=int, default=1, help='parse_excel_to_lines のシート並列数')
+    parser.add_argument('--profile', action='store_true', help='関数別の時間（cProfile）も記録')
+    parser.add_argument('--output', type=Path, default=Path('bench_ingest.json'), help='結果JSONの出力先')
+    parser.add_argument('--compare', type=Path, help='比較する前回の結果JSON')
+    args = parser.parse_args()
+
+    names = args.scenario or list(SCENARIOS)
+    scenarios = {}
+    for name in names:
+        if name == 'custom':
+            scenarios[name] = dict(
+                sheets=args.sheets, rows=args.rows, sections=args.sections,
+                merge_density=args.merge_density, two_row_header=args.two_row_header,
+                number_format=args.number_format, seed=args.seed,
+            )
+        elif name in SCENARIOS:
+            scenarios[name] = {**GENERATOR_DEFAULTS, 'seed': args.seed, **SCENARIOS[name]}
+        else:
+            print(f"不明なシナリオ: {name}")
+            return 1
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': git_revision(),
+        'parser_version': PARSER_VERSION,
+        'python': platform.python_version(),
+        'openpyxl': openpyxl.__version__,
+        'xlwt': xlwt.__VERSION__ if xlwt is not None else None,
+        'workers': args.workers,
+        'repeat': args.repeat,
+        'scenarios': {},
+    }
+
+    print(f"{'シナリオ':<16} {'生成行':>8} {'抽出行':>8} {'秒':>8} {'行/秒':>10} {'ピークMB':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, params in scenarios.items():
+            result = run_scenario(name, params, Path(tmp), args.repeat, args.workers, args.profile)
+            report['scenarios'][name] = result
+            book = result['parse_excel_to_lines']
+            print(f"{name:<16} {result['rows_generated']:>8} {result['lines_extracted']:>8} "
+                  f"{book['seconds']:>8.3f} {book['rows_per_sec']:>10,.0f} {book['peak_bytes'] / 1024 / 1024:>9.1f}")
+            for reader, backend in result['backends'].items():
+                print(f"  {reader:<20} {backend['lines_extracted']:>8} {backend['seconds']:>8.3f} "
+                      f"{backend['rows_per_sec']:>10,.0f} {backend['peak_bytes'] / 1024 / 1024:>9.1f}")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+アップロードファイルの内容アドレス保存への移行スクリプト
+uploads/ 直下の {uuid}_{元ファイル名} 形式のファイルを SHA256 で
+uploads/blobs/ab/cd/<sha256><拡張子> へ移し、同じ内容のファイルは1つにまとめる
+EstimateImport / Attachment / ImportJob の storage_path も新しいパスへ書き換える
+安全設計: dry-run（デフォルト）で確認後、--apply で実行
+
+Usage:
+    cd backend
+    python scripts/migrate_uploads_to_blobs.py                    # 移行内容を表示（デフォルト）
+    python scripts/migrate_uploads_to_blobs.py --apply            # 実行
+    python scripts/migrate_uploads_to_blobs.py --apply --delete-orphans  # 参照の無いファイルも削除
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import SessionLocal
+from models import (
+    EstimateImport as EstimateImportModel,
+    Attachment as AttachmentModel,
+    ImportJob as ImportJobModel,
+)
+from main import UPLOAD_DIR, BLOB_DIR, UPLOAD_CHUNK_SIZE, blob_path, remove_blob_if_unreferenced
+
+# storage_path を持つテーブル
+STORAGE_MODELS = [
+    ('estimate_imports', EstimateImportModel),
+    ('attachments', AttachmentModel),
+    ('import_jobs', ImportJobModel),
+]
+
+
+def file_sha256(path: Path) -> str:
+    """ファイルの SHA256（チャンク単位で読み込み）"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def plan_migration() -> list:
+    """uploads/ 直下のファイルごとに (元パス, 保存先, SHA256, サイズ) を返す"""
+    plan = []
+    for path in sorted(UPLOAD_DIR.iterdir()):
+        if not path.is_file():
+            continue
+        file_hash = file_sha256(path)
+        plan.append((path, blob_path(file_hash, path.suffix), file_hash, path.stat().st_size))
+    return plan
+
+
+def print_summary(plan: list, session, mode: str):
+    """移行内容のサマリーを表示"""
+    print(f"\n{'='*60}")
+    print(f"  アップロードファイル移行 [{mode}]")
+    print(f"{'='*60}\n")
+
+    by_hash = {}
+    for path, dest, file_hash, size in plan:
+        by_hash.setdefault(file_hash, []).append((path, size))
+
+    total_bytes = sum(size for _, _, _, size in plan)
+    saved_bytes = sum(size for files in by_hash.values() for _, size in files[1:])
+    print(f"[files] {len(plan)} 件 → {len(by_hash)} 件（{total_bytes:,} bytes）")
+    for file_hash, files in by_hash.items():
+        if len(files) > 1:
+            print(f"  - {file_hash[:12]}... 重複 {len(files)} 件")
+            for path, _ in files:
+                print(f"      {path.name}")
+    print(f"[saved] {saved_bytes:,} bytes\n")
+
+    for table, model in STORAGE_MODELS:
+        count = session.query(model).filter(
+            model.storage_path.in_([str(path) for path, _, _, _ in plan])
+        ).count() if plan else 0
+        print(f"[{table}] storage_path 書き換え {count} 件")
+    print()
+
+
+def apply_migration(plan: list, session) -> dict:
+    """
+    ファイルを保存先へコピーして storage_path を書き換え、コミット後に元ファイルを削除する
+    1ファイルずつコミットするため、途中で中断しても再実行で続きから移行できる
+    （コミット前に中断した場合は元ファイルが残り、コミット後なら保存先が既にあるため重複として扱われる）
+    """
+    counts = {'moved': 0, 'deduplicated': 0}
+    for path, dest, _, _ in plan:
+        if dest.exists():
+            counts['deduplicated'] += 1
+        else:
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, dest)
+            counts['moved'] += 1
+
+        for table, model in STORAGE_MODELS:
+            updated = session.query(model).filter(
+                model.storage_path == str(path)
+            ).update({model.storage_path: str(dest)}, synchronize_session=False)
+            counts[table] = counts.get(table, 0) + updated
+        session.commit()
+        path.unlink()
+    return counts
+
+
+def delete_orphans(session) -> int:
+    """どのレコードからも参照されていない保存ファイルを削除"""
+    deleted = 0
+    for path in BLOB_DIR.glob('??/??/*'):
+        if not path.is_file() or path.suffix == '.lock':
+            continue
+        # 稼働中の API が仮押さえしているファイルは削除しない
+        if remove_blob_if_unreferenced(session, path):
+            print(f"[DELETE] {path}")
+            deleted += 1
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='アップロードファイルの内容アドレス保存への移行')
+    parser.add_argument('--dry-run', action='store_true', default=True,
+                        help='移行内容を表示するのみ（デフォルト）')
+    parser.add_argument('--apply', action='store_true',
+                        help='実際に移行を実行')
+    parser.add_argument('--delete-orphans', action='store_true',
+                        help='移行後、参照の無い保存ファイルを削除（--apply 時のみ）')
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        plan = plan_migration()
+
+        if args.apply:
+            print_summary(plan, session, mode="APPLY - 実行")
+            print("移行を実行中...\n")
+            counts = apply_migration(plan, session)
+            if args.delete_orphans:
+                counts['orphans_deleted'] = delete_orphans(session)
+
+            print(f"\n{'='*60}")
+            print("  移行完了")
+            print(f"{'='*60}")
+            for key, count in counts.items():
+                print(f"  {key}: {count} 件")
+            print(f"{'='*60}\n")
+        else:
+            print_summary(plan, session, mode="DRY-RUN - 確認のみ")
+            if plan:
+                print("実際に移行するには --apply オプションを付けて実行してください:")
+                print("  python scripts/migrate_uploads_to_blobs.py --apply")
+            else:
+                print("移行対象のファイルはありません。")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
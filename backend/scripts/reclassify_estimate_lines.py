@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+見積明細の原価カテゴリ再分類スクリプト
+COST_CATEGORY_RULES を変更した後、既存の estimate_lines.category を現在のルールで更新する
+明細は (id, 名称, カテゴリ) だけをチャンク単位で読み、変更のある行だけを一括更新する
+安全設計: dry-run（デフォルト）で変更件数を確認後、--apply で実行
+
+Usage:
+    cd backend
+    python scripts/reclassify_estimate_lines.py                  # 変更件数を表示（デフォルト）
+    python scripts/reclassify_estimate_lines.py --apply          # 実行
+    python scripts/reclassify_estimate_lines.py --apply --chunk-size 5000
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import SessionLocal
+from main import reclassify_estimate_lines
+
+
+def print_summary(stats: dict, mode: str):
+    """再分類結果のサマリーを表示"""
+    print(f"\n{'='*60}")
+    print(f"  原価カテゴリ再分類 [{mode}]")
+    print(f"{'='*60}\n")
+    print(f"[scanned] {stats['scanned']} 件（{stats['chunks']} チャンク）")
+    print(f"[changed] {stats['changed']} 件")
+    for key, count in sorted(stats['by_category'].items(), key=lambda kv: -kv[1]):
+        print(f"  - {key}: {count} 件")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='見積明細の原価カテゴリ再分類')
+    parser.add_argument('--dry-run', action='store_true', default=True,
+                        help='変更件数を表示するのみ（デフォルト）')
+    parser.add_argument('--apply', action='store_true',
+                        help='実際に更新を実行')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='1チャンクの行数（省略時は BULK_INSERT_BATCH_SIZE）')
+    args = parser.parse_args()
+
+    session = SessionLocal()
+    try:
+        if args.apply:
+            stats = reclassify_estimate_lines(session, chunk_size=args.chunk_size, apply=True)
+            print_summary(stats, mode="APPLY - 実行")
+        else:
+            stats = reclassify_estimate_lines(session, chunk_size=args.chunk_size, apply=False)
+            print_summary(stats, mode="DRY-RUN - 確認のみ")
+            if stats['changed']:
+                print("実際に更新するには --apply オプションを付けて実行してください:")
+                print("  python scripts/reclassify_estimate_lines.py --apply")
+            else:
+                print("カテゴリの変更はありません。")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
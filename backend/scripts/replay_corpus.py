@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+実ブックのゴールデンコーパス再生
+コーパスディレクトリ内の全ブックを parse_excel_to_lines で解析し、
+行数・金額合計・検出ヘッダー・明細全体のハッシュと、ファイルごとの時間・ピークメモリを記録して
+保存済みのベースラインと比較する（解析結果が1件でも変われば終了コード1）
+ファイルは内容の SHA256 で照合するため、uploads/ の移行やファイル名の変更の影響を受けない
+
+Usage:
+    cd backend
+    python scripts/replay_corpus.py                          # uploads/ をベースラインと比較
+    python scripts/replay_corpus.py --update-baseline        # ベースラインを作り直す
+    python scripts/replay_corpus.py --corpus path/to/books --baseline other.json --slowest 5
+"""
+
+import argparse
+import hashlib
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from main import PARSER_VERSION, parse_excel_to_lines
+
+BACKEND_DIR = Path(__file__).parent.parent
+DEFAULT_CORPUS = BACKEND_DIR / "uploads"
+DEFAULT_BASELINE = Path(__file__).parent / "corpus_baseline.json"
+EXCEL_SUFFIXES = {'.xlsx', '.xlsm'}
+
+# 出力が同一かを判定する項目（時間・メモリは比較のみで不一致扱いにしない）
+OUTPUT_KEYS = ['line_count', 'total_amount', 'detected_headers', 'sheets', 'reason', 'lines_sha256']
+
+
+def file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def find_workbooks(corpus: Path) -> list:
+    """コーパス内のブック（サブディレクトリ含む、一時ファイルは除く）"""
+    return sorted(
+        path for path in corpus.rglob('*')
+        if path.is_file() and path.suffix.lower() in EXCEL_SUFFIXES and 'tmp' not in path.parts
+    )
+
+
+def replay_file(path: Path, measure_memory: bool) -> dict:
+    """1ファイルを解析して記録項目を返す"""
+    start = time.perf_counter()
+    result = parse_excel_to_lines(path)
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if measure_memory:
+        # tracemalloc は処理を遅くするため時間計測とは別に実行
+        tracemalloc.start()
+        parse_excel_to_lines(path)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    lines_json = json.dumps(result['lines'], ensure_ascii=False, sort_keys=True)
+    return {
+        'line_count': len(result['lines']),
+        'total_amount': result['total_amount'],
+        'detected_headers': result['detected_headers'],
+        'sheets': [[s['name'], s['line_count']] for s in result['sheets_processed']],
+        'reason': result['reason'],
+        'lines_sha256': hashlib.sha256(lines_json.encode('utf-8')).hexdigest(),
+        'ms': round(elapsed * 1000, 1),
+        'peak_bytes': peak,
+    }
+
+
+def normalize(record: dict) -> dict:
+    """JSON 往復後と同じ形にそろえる（タプル・NaN 等の表現差を比較に持ち込まない）"""
+    return json.loads(json.dumps(record, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='実ブックのゴールデンコーパス再生')
+    parser.add_argument('--corpus', type=Path, default=DEFAULT_CORPUS, help='ブックのディレクトリ')
+    parser.add_argument('--baseline', type=Path, default=DEFAULT_BASELINE, help='ベースラインJSON')
+    parser.add_argument('--update-baseline', action='store_true', help='今回の結果でベースラインを上書き')
+    parser.add_argument('--no-memory', action='store_true', help='ピークメモリを計測しない（約2倍速）')
+    parser.add_argument('--slowest', type=int, default=10, help='遅いファイルを何件表示するか')
+    args = parser.parse_args()
+
+    workbooks = find_workbooks(args.corpus)
+    if not workbooks:
+        print(f"ブックがありません: {args.corpus}")
+        return 1
+
+    baseline = {}
+    if args.baseline.exists() and not args.update_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f).get('files', {})
+
+    files = {}
+    mismatches = []
+    for path in workbooks:
+        file_hash = file_sha256(path)
+        if file_hash in files:
+            continue  # 同じ内容のファイルは1回だけ
+        record = normalize({'path': str(path.relative_to(args.corpus)), **replay_file(path, not args.no_memory)})
+        files[file_hash] = record
+
+        expected = baseline.get(file_hash)
+        if expected is None:
+            status = '新規'
+        else:
+            diff_keys = [k for k in OUTPUT_KEYS if expected.get(k) != record.get(k)]
+            status = '一致' if not diff_keys else f"不一致({','.join(diff_keys)})"
+            if diff_keys:
+                mismatches.append((record['path'], diff_keys, expected, record))
+        ratio = ''
+        if expected and expected.get('ms'):
+            ratio = f" {expected['ms'] / record['ms']:.2f}x" if record['ms'] else ''
+        print(f"{status:<8} {record['line_count']:>6}行 {record['ms']:>9.1f}ms{ratio}  {record['path'][-60:]}")
+
+    missing = [rec['path'] for h, rec in baseline.items() if h not in files]
+
+    # 遅いレイアウト
+    print(f"\n遅いファイル（上位{args.slowest}件）:")
+    for record in sorted(files.values(), key=lambda r: r['ms'], reverse=True)[:args.slowest]:
+        peak = f"{record['peak_bytes'] / 1024 / 1024:.1f}MB" if record['peak_bytes'] else '-'
+        print(f"  {record['ms']:>9.1f}ms {peak:>8} {record['line_count']:>6}行  {record['path'][-60:]}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'parser_version': PARSER_VERSION, 'files': files}, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"\nベースラインを保存しました: {args.baseline}（{len(files)}件）")
+        return 0
+
+    if missing:
+        print(f"\nベースラインにあってコーパスに無いファイル: {len(missing)}件")
+        for path in missing:
+            print(f"  {path}")
+
+    if mismatches:
+        print(f"\n✗ 解析結果の不一致 {len(mismatches)}件:")
+        for path, keys, expected, actual in mismatches:
+            print(f"  {path}")
+            for key in keys:
+                print(f"    {key}: ベースライン={str(expected.get(key))[:200]} 今回={str(actual.get(key))[:200]}")
+        return 1
+
+    print(f"\n✓ {len(files)}件すべてベースラインと一致" if baseline else f"\n{len(files)}件を解析（ベースラインなし）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+normalize_number の等価性チェック
+最適化前の実装（参照実装）とファジングしたコーパスで結果を突き合わせる
+コーパスは見積書に出る値（"1式", "１，２３４円", "(500)", "42㎡" 等）の部品を
+ランダムに組み合わせて生成する
+
+Usage:
+    cd backend
+    python scripts/verify_normalize_number.py                # 20万件
+    python scripts/verify_normalize_number.py --count 1000000 --seed 42
+"""
+
+import argparse
+import math
+import random
+import re
+import sys
+from pathlib import Path
+from typing import Optional
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from main import normalize_number
+
+
+def legacy_normalize_number(value) -> Optional[float]:
+    """最適化前の normalize_number（参照実装）"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    s = str(value).strip()
+    if not s:
+        return None
+
+    trans_table = str.maketrans('０１２３４５６７８９．，－＋', '0123456789.,-+')
+    s = s.translate(trans_table)
+    s = re.sub(r'\s+', '', s)
+    for currency in ['¥', '￥', '$', '＄', '円', '€', '\\']:
+        s = s.replace(currency, '')
+    s = s.replace(',', '').replace('、', '')
+
+    s = s.strip()
+    if s.startswith('(') and s.endswith(')'):
+        s = '-' + s[1:-1]
+    if s.startswith('（') and s.endswith('）'):
+        s = '-' + s[1:-1]
+
+    if '式' in s:
+        s = s.replace('式', '').strip()
+        if not s or s in ['一', '１', '1', '']:
+            return 1.0
+
+    s = s.replace('一', '1')
+
+    unit_patterns = [
+        '㎡', '㎥', 'm2', 'm3', 'M2', 'M3',
+        'km', 'cm', 'mm', 'm', 'ｍ', 'M',
+        'kg', 'KG', 'Kg', 't', 'T', 'g',
+        'ℓ', 'L', 'l', 'ml', 'ML',
+        '個', '本', '台', '件', '人', '回', '日', '時間', '枚', '組', '箇所', '基', '棟', '戸',
+        'セット', 'SET', 'set', 'ケース', 'ロット',
+    ]
+    for unit in unit_patterns:
+        s = s.replace(unit, '')
+
+    s = s.strip()
+    if not s:
+        return None
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+# コーパスの部品（見積書に現れる数値・単位・記号と、境界を突く文字）
+FRAGMENTS = [
+    '0', '1', '2', '3', '5', '9', '12', '100', '1234', '０', '１', '２', '９', '１２３',
+    '.', '．', ',', '，', '、', '-', '－', '+', '＋', '(', ')', '（', '）',
+    ' ', '　', '\t', '\n', '¥', '￥', '$', '＄', '円', '€', '\\',
+    '式', '一', '一式', '1式', '１式',
+    '㎡', '㎥', 'm2', 'm3', 'M2', 'M3', 'km', 'cm', 'mm', 'm', 'ｍ', 'M',
+    'kg', 'KG', 'Kg', 't', 'T', 'g', 'ℓ', 'L', 'l', 'ml', 'ML',
+    '個', '本', '台', '件', '人', '回', '日', '時間', '枚', '組', '箇所', '基', '棟', '戸',
+    'セット', 'SET', 'set', 'ケース', 'ロット',
+    'e', 'E', 'e3', 'inf', 'nan', '_', 'x', '約', '㎏',
+]
+
+
+def random_value(rng: random.Random):
+    """コーパスの1値を生成（大半は文字列、一部は数値・None）"""
+    roll = rng.random()
+    if roll < 0.05:
+        return rng.choice([None, 0, 1, -3, 2.5, True, float('nan')])
+    if roll < 0.10:
+        return rng.uniform(-1e7, 1e7)
+    return ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 6)))
+
+
+def same_result(a, b) -> bool:
+    """NaN 同士も一致とみなす比較"""
+    if a is None or b is None:
+        return a is b
+    if math.isnan(a) and math.isnan(b):
+        return True
+    return a == b and math.copysign(1.0, a) == math.copysign(1.0, b)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='normalize_number の等価性チェック')
+    parser.add_argument('--count', type=int, default=200000, help='生成する値の数')
+    parser.add_argument('--seed', type=int, default=0, help='乱数シード')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mismatches = []
+    for _ in range(args.count):
+        value = random_value(rng)
+        # 2回呼んでメモ化後の結果も確認する
+        for _ in range(2):
+            expected = legacy_normalize_number(value)
+            actual = normalize_number(value)
+            if not same_result(expected, actual):
+                mismatches.append((value, expected, actual))
+                break
+
+    if mismatches:
+        print(f"✗ 不一致 {len(mismatches)}件（先頭10件）:")
+        for value, expected, actual in mismatches[:10]:
+            print(f"  {value!r}: 参照={expected!r} 新={actual!r}")
+        return 1
+
+    print(f"✓ {args.count}件すべて一致 (seed={args.seed})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+起動時処理のチェック
+一時 DB（取込ジョブ・ヘッダーテンプレート導入前のテーブルのみ）に対して
+アプリに登録された startup ハンドラを実行し、init_import_jobs が登録されていること、
+import_jobs / header_templates テーブルと import_jobs.owner 列が作成されることを確認する
+
+Usage:
+    cd backend
+    python scripts/verify_startup.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 本番の DB に触れないよう main の読込前に一時 DB を指定
+_tmp_dir = tempfile.mkdtemp(prefix='verify_startup_')
+os.environ['DATABASE_URL'] = f"sqlite:///{Path(_tmp_dir) / 'verify.db'}"
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import inspect, text
+
+from database import engine
+from models import Base
+from main import app, init_import_jobs
+
+# 起動時処理で作成されるテーブル
+STARTUP_TABLES = ['import_jobs', 'header_templates']
+
+
+def main():
+    errors = []
+    handlers = list(app.router.on_startup)
+    if init_import_jobs not in handlers:
+        errors.append(f"startup ハンドラに init_import_jobs がありません: {[h.__name__ for h in handlers]}")
+
+    # 導入前のテーブルと owner 列の無い import_jobs を用意して startup ハンドラを実行
+    Base.metadata.create_all(
+        bind=engine,
+        tables=[t for t in Base.metadata.sorted_tables if t.name not in STARTUP_TABLES],
+    )
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE import_jobs (id VARCHAR(36) PRIMARY KEY, project_id VARCHAR(36) NOT NULL, "
+            "import_id VARCHAR(36), status VARCHAR(20), original_filename VARCHAR(255) NOT NULL, "
+            "storage_path VARCHAR(500) NOT NULL, file_hash VARCHAR(64), progress_json TEXT, "
+            "result_json TEXT, error TEXT, created_at DATETIME, started_at DATETIME, finished_at DATETIME)"
+        ))
+    for handler in handlers:
+        result = handler()
+        if asyncio.iscoroutine(result):
+            asyncio.run(result)
+
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in STARTUP_TABLES:
+        if table not in tables:
+            errors.append(f"テーブルが作成されていません: {table}")
+    if 'import_jobs' in tables and 'owner' not in {c['name'] for c in inspector.get_columns('import_jobs')}:
+        errors.append("import_jobs.owner 列が追加されていません")
+
+    if errors:
+        print(f"✗ 起動時処理の不備 {len(errors)}件:")
+        for error in errors:
+            print(f"  {error}")
+        return 1
+
+    print(f"✓ startup ハンドラ {len(handlers)}件を実行し、{', '.join(STARTUP_TABLES)} を確認")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -52,9 +52,11 @@ interface ValueStats {
 }
 
 interface Preview {
-  lines: PreviewLine[];
+  lines: PreviewLine[];  // 先頭ページのみ（続きは /api/imports/{id}/lines?cursor=）
+  next_cursor?: string | null;
   total_amount: number;
   line_count: number;
+  staged_count?: number;  // ページ取得できる明細の件数（差分再取込では追加・変更行のみ）
   sheets_processed?: SheetInfo[];
   sheets_skipped?: SheetInfo[];
   missing_columns?: string[];
@@ -759,9 +761,9 @@ const EstimateUpload: React.FC = () => {
                   </tr>
                 </tfoot>
               </table>
-              {preview.lines.length > 50 && (
+              {(preview.staged_count ?? preview.line_count) > Math.min(preview.lines.length, 50) && (
                 <div style={{ textAlign: 'center', padding: '1rem', color: '#6b7280', fontSize: '0.875rem' }}>
-                  ... 他 {preview.lines.length - 50} 件
+                  ... 他 {(preview.staged_count ?? preview.line_count) - Math.min(preview.lines.length, 50)} 件
                 </div>
               )}
             </div>